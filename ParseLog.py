@@ -2,7 +2,6 @@
 
 # dependencies
 # pip install python-can==3.3.2
-# pip install quantities
 # python python-j1939/setup.py install (from https://github.com/milhead2/python-j1939)
 
 # system modules
@@ -18,7 +17,10 @@ from pprint import pprint
 import j1939
 
 # local modules
-from lib.nmea2000 import Nmea2000Reader, Nmea2000State, NmeaLogger, PgnPrinter
+from lib.nmea2000 import Nmea2000Reader, Nmea2000State, NmeaLogger, PgnPrinter, DecodeCanId
+from lib.logparser import ParseLogLine, ReadLogFile, ParseLogParallel
+from lib.capture import CaptureReader, ConvertLog
+from lib.datalog import ExportCsv
 
 #
 # parse NMEA 2000 data and run it through our system
@@ -27,50 +29,141 @@ from lib.nmea2000 import Nmea2000Reader, Nmea2000State, NmeaLogger, PgnPrinter
 # Rx 478700 09 f5 03 05 f8 00 00 ff ff ff ff ff
 # ignored-- header----- data-------------------
 #
-def parseLog():
+def parseLog(filenames):
     consumers = [ PgnPrinter() ]
     reader = Nmea2000Reader(consumers)
 
-    for line in fileinput.input():
-        line = line.rstrip()
-        if not line: continue
-
-        words = line.split()
-        if words[0] == "Rx" or words[0] == "Tx":
-            # parse Raymarine log
-            identifier = int(''.join(words[2:6]), 16)
-            data = bytearray.fromhex(''.join(words[6:]))
-            arbitration_id = j1939.ArbitrationID()
-            arbitration_id.can_id = identifier
+    for (identifier, data, timestamp) in readLogs(filenames):
+        #canId = DecodeCanId(identifier)
+        #print("%-3i: pgn=%-6i" % (canId.source_address, canId.pgn))
+
+        reader.HandlePacket(identifier, data, timestamp)
+
+#
+# Read frames from log files using mmap, or from stdin if there aren't
+# any files (or the file is -).  Capture files (.n2k) are read with
+# CaptureReader.
+#
+def readLogs(filenames):
+    for filename in filenames or ['-']:
+        if filename == '-':
+            for line in sys.stdin:
+                parsed = ParseLogLine(line)
+                if parsed is not None:
+                    yield parsed
+        elif filename.endswith('.n2k'):
+            for frame in CaptureReader(filename).Frames():
+                yield frame
         else:
-            # candump log
-            identifier = int(words[1], 16)
-            data = bytearray.fromhex(''.join(words[3:]))
+            for frame in ReadLogFile(filename):
+                yield frame
 
-        arbitration_id = j1939.ArbitrationID()
-        arbitration_id.can_id = identifier
+#
+# parse logs using one process per CPU (or processes).  The output is
+# the same as parseLog.
+#
+def parseLogParallel(filenames, processes=None):
+    for text in ParseLogParallel(filenames, processes):
+        print(text)
 
-        #print("%-3i: pgn=%-6i line=%s" % (arbitration_id.source_address, arbitration_id.pgn.value, line))
+#
+# decode whole logs at once with NumPy and print a summary of each PGN.
+# This is much faster than parseLog for long logs.
+#
+def parseLogBatch(filenames):
+    # numpy is only needed for batch mode
+    import numpy
+    from lib.batchdecoder import DecodeLog
 
-        reader.HandlePacket(arbitration_id, data)
+    for filename in filenames:
+        results = DecodeLog(filename)
+        for pgn in sorted(results.keys()):
+            columns = results[pgn]
+            print("pgn=%s(%i): records=%i sources=%s" % (columns.description, pgn, len(columns), ','.join(str(s) for s in sorted(set(columns.source.tolist())))))
+            for name in columns.columns:
+                values = columns.columns[name]
+                if name in columns.enums or values.dtype.kind != 'f' or numpy.all(numpy.isnan(values)):
+                    continue
+                print("  %s: min=%g mean=%g max=%g %s" % (name, numpy.nanmin(values), numpy.nanmean(values), numpy.nanmax(values), columns.units[name]))
 
-# parse NMEA 2000 network data from CAN bus
-def parseNetwork():
-    bus = j1939.Bus()
+#
+# convert a Raymarine or candump log into a capture file (see
+# lib/capture.py)
+#
+def convertLog(logFilename, captureFilename):
+    count = ConvertLog(logFilename, captureFilename)
+    print("wrote %i frames to %s" % (count, captureFilename))
+
+#
+# print the records for a PGN from a capture file, optionally between two
+# timestamps (in seconds).  Only the parts of the capture with the PGN in
+# that time range are read.
+#
+def queryCapture(captureFilename, pgn, start=None, end=None):
+    reader = Nmea2000Reader([ PgnPrinter() ])
+    CaptureReader(captureFilename).Replay(reader, pgns=[pgn], start=start, end=end)
+
+#
+# export a data log written by NmeaLogger (lib/datalog.py) as CSV
+#
+def exportLog(logFilename, csvFilename):
+    count = ExportCsv(logFilename, csvFilename)
+    print("wrote %i rows to %s" % (count, csvFilename))
+
+# parse NMEA 2000 network data from CAN bus.  With an interface the
+# frames are read straight from SocketCAN (lib/socketcan.py) instead of
+# through python-can.
+def parseNetwork(interface=None):
     consumers = [ PgnPrinter() ]
     reader = Nmea2000Reader(consumers)
+    if interface is not None:
+        from lib.socketcan import SocketCanReader
+        socketCan = SocketCanReader(interface, reader)
+        try:
+            socketCan.Run()
+        except KeyboardInterrupt:
+            socketCan.Close()
+        return
+
+    bus = j1939.Bus()
     try:
         for msg in bus:
             reader.HandlePacket(msg.arbitration_id, msg.data)
     except KeyboardInterrupt:
         bus.shutdown()
 
-if len(sys.argv) < 2:
-    pathname = os.path.dirname(sys.argv[0])        
-    fullpath = os.path.abspath(pathname)
-    print("starting in %s" % fullpath)
-    os.chdir(fullpath)
-    parseNetwork()
-else:
-    print("parselog");
-    parseLog()
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        pathname = os.path.dirname(sys.argv[0])        
+        fullpath = os.path.abspath(pathname)
+        print("starting in %s" % fullpath)
+        os.chdir(fullpath)
+        parseNetwork()
+    elif sys.argv[1].startswith("--socketcan"):
+        # --socketcan or --socketcan=vcan0
+        interface = 'can0'
+        if '=' in sys.argv[1]:
+            interface = sys.argv[1].split('=')[1]
+        parseNetwork(interface)
+    elif sys.argv[1] == "--batch":
+        parseLogBatch(sys.argv[2:])
+    elif sys.argv[1] == "--convert":
+        # --convert log capture.n2k
+        convertLog(sys.argv[2], sys.argv[3])
+    elif sys.argv[1] == "--query":
+        # --query capture.n2k pgn [start end]
+        times = [float(t) for t in sys.argv[4:6]] + [None, None]
+        queryCapture(sys.argv[2], int(sys.argv[3]), times[0], times[1])
+    elif sys.argv[1] == "--export":
+        # --export datalog.n2kl out.csv
+        exportLog(sys.argv[2], sys.argv[3])
+    elif sys.argv[1].startswith("--parallel"):
+        # --parallel or --parallel=N
+        processes = None
+        if '=' in sys.argv[1]:
+            processes = int(sys.argv[1].split('=')[1])
+        print("parselog");
+        parseLogParallel(sys.argv[2:], processes)
+    else:
+        print("parselog");
+        parseLog(sys.argv[1:])
@@ -0,0 +1,402 @@
+#!/usr/bin/python
+
+# system modules
+import os
+import mmap
+import collections
+# pip install numpy
+import numpy
+
+# local modules
+from lib.nmea2000 import GetPgnTable, Nmea2000Reader, PgnConsumer, FIELD_INTEGER, parseOut
+from lib.logparser import RAYMARINE_FIXED_LENGTH
+
+#
+# Batch decoding of NMEA 2000 logs with NumPy.  This is meant for post
+# processing of large logs, where decoding each frame through
+# Nmea2000Reader is too slow.
+#
+# The log is loaded into arrays of (timestamp, can_id, payload) and then
+# every single frame PGN is decoded a whole column at a time using the
+# PgnDecodePlan from PgnTable.  Fast packet PGNs still need to be
+# reassembled, so they are run through Nmea2000Reader and then turned into
+# columns.
+#
+# The result is a dict of PGN to PgnColumns
+#
+
+#
+# The decoded data for one PGN, stored as columns with one row per
+# record.
+#
+# pgn -- the PGN
+# description -- the description of the PGN from pgns.json
+# timestamp, source, priority, destination -- arrays with the header
+#   for each row.  The timestamp is from the log (in seconds), or the
+#   line number if the log doesn't have timestamps
+# columns -- dict of field name to array.  Numbers are stored as float64
+#   with NaN for unknown values.  Lookup table fields are stored as int64
+#   (-1 for unknown) and can be expanded with Lookup().  Anything else is
+#   an object array
+# units -- dict of field name to units
+# enums -- dict of field name to lookup table
+#
+class PgnColumns(object):
+    def __init__(self, pgn, plan):
+        self.pgn = pgn
+        self.description = plan.pgnRecord.get('Description')
+        self.timestamp = None
+        self.source = None
+        self.priority = None
+        self.destination = None
+        self.columns = collections.OrderedDict()
+        self.units = {}
+        self.enums = {}
+
+    def __len__(self):
+        if self.timestamp is None:
+            return 0
+        return len(self.timestamp)
+
+    # Expand a lookup table column into a list of names
+    def Lookup(self, name):
+        enumValues = self.enums[name]
+        out = []
+        for v in self.columns[name].tolist():
+            if v < 0:
+                out.append(None)
+            else:
+                out.append(enumValues.get(v, '"%d"' % v))
+        return out
+
+# bytes of the log to convert at a time, rounded up to the end of a line
+READ_BLOCK_SIZE = 1 << 23
+
+# value of each hex digit, 255 for anything else
+HEX_DIGITS = numpy.full(256, 255, dtype=numpy.uint8)
+for (i, c) in enumerate(b'0123456789abcdef'):
+    HEX_DIGITS[c] = i
+for (i, c) in enumerate(b'ABCDEF', 10):
+    HEX_DIGITS[c] = i
+
+# Raymarine timestamps longer than this go through ReadLogLines
+MAX_TIMESTAMP_DIGITS = 15
+
+#
+# Load a Raymarine or candump log into arrays.
+#
+# The file is read through mmap and converted a block at a time.  Lines
+# that are Raymarine lines with 8 bytes of data (see
+# logparser.IsFixedWidthLine) are checked and converted with array
+# operations straight from the file's bytes, anything else goes through
+# ReadLogLines.
+#
+# filename -- the log file
+# returns: (timestamp, can_id, payload, length)
+#   timestamp -- float64 seconds
+#   can_id -- uint32 29 bit CAN identifier
+#   payload -- uint8 array of (rows, 8)
+#   length -- uint8 number of valid bytes in each payload row
+#
+def ReadLog(filename):
+    blocks = []
+    with open(filename, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return ReadLogLines([])
+        # the mmap is closed when the last view of it goes away, closing it
+        # here would fail if an exception still holds one
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    buf = numpy.frombuffer(mm, dtype=numpy.uint8)
+    offset = 0
+    lineNumber = 0
+    while offset < size:
+        end = mm.find(b'\n', min(offset + READ_BLOCK_SIZE, size) - 1)
+        end = size if end < 0 else end + 1
+        (lines, block) = readBlock(buf, offset, end, lineNumber)
+        blocks.append(block)
+        lineNumber += lines
+        offset = end
+
+    return tuple(numpy.concatenate(columns) for columns in zip(*blocks))
+
+#
+# Convert the lines in buf[offset:end], see ReadLog
+#
+# lineNumber -- the line number of the first line, for candump logs
+# returns: (number of lines, (timestamp, can_id, payload, length))
+#
+def readBlock(buf, offset, end, lineNumber):
+    # start and end (without the line ending) of each line
+    newlines = offset + numpy.flatnonzero(buf[offset:end] == ord('\n'))
+    lineEnd = newlines
+    if end > offset and buf[end - 1] != ord('\n'):
+        lineEnd = numpy.append(newlines, end)
+    lineStart = numpy.concatenate(([ offset ], lineEnd[:-1] + 1))
+    lineEnd -= (lineEnd > lineStart) & (buf[numpy.maximum(lineEnd - 1, 0)] == ord('\r'))
+
+    # Rx 478700 09 f5 03 05 f8 00 00 ff ff ff ff ff
+    # the timestamp is the digits between the first 3 characters and the
+    # last 12 hex bytes
+    digits = lineEnd - lineStart - (3 + RAYMARINE_FIXED_LENGTH)
+    fixed = numpy.flatnonzero((digits >= 1) & (digits <= MAX_TIMESTAMP_DIGITS))
+    s = lineStart[fixed]
+    e = lineEnd[fixed]
+    ok = (((buf[s] == ord('R')) | (buf[s] == ord('T'))) & (buf[s + 1] == ord('x')) & (buf[s + 2] == ord(' ')))
+
+    columns = e[:, None] - RAYMARINE_FIXED_LENGTH + 3 * numpy.arange(12)
+    ok &= numpy.all(buf[columns] == ord(' '), axis=1)
+    high = HEX_DIGITS[buf[columns + 1]]
+    low = HEX_DIGITS[buf[columns + 2]]
+    ok &= numpy.all((high | low) < 16, axis=1)
+    raw = (high << 4) | low
+    del columns, high, low
+
+    digits = digits[fixed]
+    timestamp = numpy.zeros(len(fixed), dtype=numpy.float64)
+    last = e - RAYMARINE_FIXED_LENGTH - 1
+    for k in range(int(digits.max()) if len(digits) else 0):
+        present = k < digits
+        digit = buf[numpy.where(present, last - k, s)] - ord('0')
+        ok &= ~present | (digit <= 9)
+        timestamp += numpy.where(present, digit, 0) * float(10 ** k)
+
+    fixedLines = fixed[ok]
+    raw = raw[ok]
+    header = raw[:, 0:4].astype(numpy.uint32)
+    fixedBlock = (timestamp[ok] / 1000.0,
+        (header[:, 0] << 24) | (header[:, 1] << 16) | (header[:, 2] << 8) | header[:, 3],
+        numpy.ascontiguousarray(raw[:, 4:12]),
+        numpy.full(len(fixedLines), 8, dtype=numpy.uint8))
+
+    # everything else, except blank lines, is parsed a line at a time
+    other = numpy.ones(len(lineStart), dtype=bool)
+    other[fixedLines] = False
+    other &= lineEnd > lineStart
+    other = numpy.flatnonzero(other)
+    if len(other) == 0:
+        return (len(lineStart), fixedBlock)
+    lines = [ buf[a:b].tobytes().decode('ascii', 'ignore') for (a, b) in zip(lineStart[other].tolist(), lineEnd[other].tolist()) ]
+    (otherLines, otherBlock) = readLines(zip((lineNumber + other).tolist(), lines))
+
+    # put the two back in file order
+    order = numpy.argsort(numpy.concatenate((fixedLines, otherLines - lineNumber)), kind='stable')
+    return (len(lineStart), tuple(numpy.concatenate(pair)[order] for pair in zip(fixedBlock, otherBlock)))
+
+#
+# Load a log one line at a time, see ReadLog
+#
+def ReadLogLines(lines):
+    return readLines(enumerate(lines))[1]
+
+#
+# lines -- (line number, line) for each line
+# returns: (array of the line number of each row, (timestamp, can_id,
+#   payload, length))
+#
+def readLines(lines):
+    lineNumbers = []
+    timestamps = []
+    can_ids = []
+    payload = bytearray()
+    lengths = []
+
+    for lineNumber, line in lines:
+        words = line.split()
+        if not words: continue
+
+        if words[0] == "Rx" or words[0] == "Tx":
+            # parse Raymarine log
+            timestamp = int(words[1]) / 1000.0
+            identifier = int(''.join(words[2:6]), 16)
+            data = bytearray.fromhex(''.join(words[6:]))
+        else:
+            # candump log
+            timestamp = float(lineNumber)
+            identifier = int(words[1], 16)
+            data = bytearray.fromhex(''.join(words[3:]))
+
+        data = data[0:8]
+        lineNumbers.append(lineNumber)
+        timestamps.append(timestamp)
+        can_ids.append(identifier)
+        lengths.append(len(data))
+        payload.extend(data)
+        payload.extend(bytearray(8 - len(data)))
+
+    return (numpy.array(lineNumbers, dtype=numpy.int64),
+        (numpy.array(timestamps, dtype=numpy.float64),
+        numpy.array(can_ids, dtype=numpy.uint32),
+        numpy.frombuffer(bytes(payload), dtype=numpy.uint8).reshape(-1, 8),
+        numpy.array(lengths, dtype=numpy.uint8)))
+
+#
+# Split 29 bit CAN identifiers into their J1939 parts
+# returns: (pgn, priority, source, destination)
+#
+def SplitCanIds(can_id):
+    can_id = can_id.astype(numpy.uint32)
+    pf = (can_id >> 16) & 0xff
+    ps = (can_id >> 8) & 0xff
+    dp = (can_id >> 24) & 0x3
+    pdu2 = pf >= 240
+    pgn = (dp << 16) | (pf << 8) | numpy.where(pdu2, ps, 0)
+    priority = (can_id >> 26) & 0x7
+    source = can_id & 0xff
+    destination = numpy.where(pdu2, 0xff, ps)
+    return pgn, priority, source, destination
+
+#
+# Decode a log file.  See DecodeFrames.
+#
+def DecodeLog(filename, pgns=None):
+    return DecodeFrames(*ReadLog(filename), pgns=pgns)
+
+#
+# Decode arrays of frames (as returned by ReadLog) into a dict of PGN to
+# PgnColumns
+#
+# pgns -- if set only decode these PGNs
+#
+def DecodeFrames(timestamp, can_id, payload, length, pgns=None):
+    pgnTable = GetPgnTable()
+    pgn, priority, source, destination = SplitCanIds(can_id)
+
+    # the payload is padded so that fields that run off the end of a frame
+    # can be read without bounds checks, they are zeroed out below
+    padded = numpy.zeros((len(payload), 16), dtype=numpy.uint8)
+    padded[:, 0:8] = payload
+
+    results = {}
+    fastPacketPgns = []
+    for p in numpy.unique(pgn).tolist():
+        if pgns is not None and p not in pgns:
+            continue
+        plan = pgnTable.GetDecodePlan(p)
+        if plan is None:
+            continue
+        if plan.fastPacket:
+            fastPacketPgns.append(p)
+            continue
+
+        rows = pgn == p
+        columns = PgnColumns(p, plan)
+        columns.timestamp = timestamp[rows]
+        columns.source = source[rows]
+        columns.priority = priority[rows]
+        columns.destination = destination[rows]
+        DecodeColumns(plan, padded[rows], length[rows], columns)
+        results[p] = columns
+
+    if fastPacketPgns:
+        results.update(DecodeFastPackets(timestamp, can_id, payload, length, pgn, fastPacketPgns))
+
+    return results
+
+#
+# Decode every field in plan for an array of single frame payloads
+#
+# plan -- the PgnDecodePlan for the PGN
+# payload -- uint8 array of (rows, 16), zero padded
+# length -- number of valid bytes in each row
+# columns -- the PgnColumns to fill in
+#
+def DecodeColumns(plan, payload, length, columns):
+    for f in plan.fields:
+        if f.kind != FIELD_INTEGER:
+            # strings and oddly sized fields are decoded one at a time
+            values = numpy.empty(len(payload), dtype=object)
+            for i in range(len(payload)):
+                v = parseOut(bytes(payload[i, 0:length[i]]), f.bitOffset, f.bitLength, f.dataType, f.signed)
+                values[i] = None if v == f.unknownValue else v
+            columns.columns[f.name] = values
+            columns.units[f.name] = f.units
+            continue
+
+        # little endian integer of numBytes starting at startingByte
+        raw = numpy.zeros(len(payload), dtype=numpy.uint64)
+        for i in range(f.numBytes):
+            raw |= payload[:, f.startingByte + i].astype(numpy.uint64) << numpy.uint64(8 * i)
+
+        if f.signed and f.numBytes != 3:
+            # 3 byte numbers are always read as unsigned
+            bits = 8 * f.numBytes
+            raw = raw.view(numpy.int64)
+            if bits < 64:
+                raw = numpy.where(raw >= (1 << (bits - 1)), raw - (1 << bits), raw)
+
+        raw = raw >> f.shift
+        if f.mask != -1:
+            raw = raw & f.mask
+
+        # check for out of bounds
+        raw = numpy.where(length >= f.minLength, raw, 0)
+        unknown = raw == f.unknownValue
+
+        if f.enumValues is not None:
+            v = (raw & f.enumMask).astype(numpy.int64)
+            columns.columns[f.name] = numpy.where(unknown, -1, v)
+            columns.enums[f.name] = f.enumValues
+        else:
+            v = raw.astype(numpy.float64)
+            if f.resolution is not None:
+                v = v * f.resolution
+            v[unknown] = numpy.nan
+            columns.columns[f.name] = v
+        columns.units[f.name] = f.units
+
+#
+# Consumer that collects DataRecords for DecodeFastPackets
+#
+class RecordCollector(PgnConsumer):
+    def __init__(self, pgns):
+        self.__pgns = pgns
+        self.timestamp = None
+        self.records = collections.defaultdict(list)
+
+    def Subscriptions(self):
+        return self.__pgns
+
+    def ConsumePgn(self, pgn, dataRecord, pgnRecord):
+        self.records[pgn].append((self.timestamp, dataRecord))
+
+#
+# Fast packets have to be reassembled, so they run through
+# Nmea2000Reader.  The records are then converted to columns.
+#
+def DecodeFastPackets(timestamp, can_id, payload, length, pgn, pgns):
+    pgnTable = GetPgnTable()
+    collector = RecordCollector(pgns)
+    reader = Nmea2000Reader([collector])
+
+    rows = numpy.nonzero(numpy.isin(pgn, pgns))[0]
+    can_ids = can_id.tolist()
+    timestamps = timestamp.tolist()
+    for i in rows.tolist():
+        collector.timestamp = timestamps[i]
+        reader.HandlePacket(can_ids[i], bytearray(payload[i, 0:length[i]]), timestamps[i])
+
+    results = {}
+    for p in collector.records:
+        plan = pgnTable.GetDecodePlan(p)
+        records = collector.records[p]
+        columns = PgnColumns(p, plan)
+        columns.timestamp = numpy.array([t for (t, r) in records], dtype=numpy.float64)
+        columns.source = numpy.array([r.source_address for (t, r) in records], dtype=numpy.uint32)
+        columns.priority = numpy.array([r.priority for (t, r) in records], dtype=numpy.uint32)
+        columns.destination = numpy.array([r.destination_address for (t, r) in records], dtype=numpy.uint32)
+        for name in plan.names:
+            f = plan.fields[plan.fieldIndex[name]]
+            values = [r.GetValue(name) for (t, r) in records]
+            if f.kind == FIELD_INTEGER and f.enumValues is not None:
+                rawValues = [r.GetRawValue(name) for (t, r) in records]
+                columns.columns[name] = numpy.array([-1 if v is None else (raw & f.enumMask) for (v, raw) in zip(values, rawValues)], dtype=numpy.int64)
+                columns.enums[name] = f.enumValues
+            elif f.kind == FIELD_INTEGER:
+                columns.columns[name] = numpy.array([numpy.nan if v is None else v for v in values], dtype=numpy.float64)
+            else:
+                columns.columns[name] = numpy.array(values, dtype=object)
+            columns.units[name] = f.units
+        results[p] = columns
+
+    return results
@@ -0,0 +1,240 @@
+#!/usr/bin/python
+
+# system modules
+import os
+import json
+import math
+import struct
+
+# local modules
+from lib.nmea2000 import DecodeCanId
+from lib.logparser import ReadLogFile
+
+#
+# A compact binary format for NMEA 2000 captures, with an index so that
+# queries for a PGN or source over a time range only read the parts of
+# the file that they need.
+#
+# The capture file is a header followed by fixed width records:
+#   timestamp -- double, seconds (NaN if the log didn't have one)
+#   can_id -- uint32, the 29 bit CAN identifier
+#   dlc -- uint8, the number of valid bytes in data
+#   data -- 8 bytes, zero padded
+# This is 21 bytes per frame, compared with about 45 for a text log.
+#
+# Records are grouped into blocks of blockSize records.  The index is
+# stored next to the capture (capture + '.idx') as JSON:
+#   blockSize -- records per block
+#   count -- total number of records
+#   blocks -- [first timestamp, last timestamp] for each block, null if
+#     none of its frames have a timestamp
+#   pgns -- { pgn: { blocks, first, last, count } }
+#   sources -- { source address: { blocks, first, last, count } }
+#
+
+CAPTURE_MAGIC = b'N2KCAP\x00\x01'
+CAPTURE_RECORD = struct.Struct('<dIB8s')
+
+#
+# Index entry for a PGN or source
+#
+def newIndexEntry():
+    return { 'blocks': [], 'first': None, 'last': None, 'count': 0 }
+
+def updateIndexEntry(entry, block, timestamp):
+    if not entry['blocks'] or entry['blocks'][-1] != block:
+        entry['blocks'].append(block)
+    entry['count'] += 1
+    if timestamp is None:
+        return
+    if entry['first'] is None:
+        entry['first'] = timestamp
+    entry['last'] = timestamp
+
+#
+# Write a capture file.  Frames are buffered a block at a time.
+#
+class CaptureWriter(object):
+    #
+    # filename -- the capture file to create
+    # blockSize -- number of records per index block
+    #
+    def __init__(self, filename, blockSize=4096):
+        self.__filename = filename
+        self.__file = open(filename, 'wb')
+        self.__file.write(CAPTURE_MAGIC)
+        self.__blockSize = blockSize
+        self.__buffer = bytearray(blockSize * CAPTURE_RECORD.size)
+        self.__bufferCount = 0
+        self.__count = 0
+        self.__blocks = []
+        self.__pgns = {}
+        self.__sources = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.Close()
+
+    #
+    # Add a frame to the capture
+    #
+    # timestamp -- time in seconds, or None if it isn't known
+    # can_id -- the 29 bit CAN identifier
+    # data -- up to 8 bytes of data
+    #
+    def Write(self, timestamp, can_id, data):
+        block = self.__count // self.__blockSize
+        if block == len(self.__blocks):
+            self.__blocks.append(None)
+        if timestamp is not None:
+            blockRange = self.__blocks[block]
+            if blockRange is None:
+                self.__blocks[block] = [timestamp, timestamp]
+            else:
+                blockRange[0] = min(blockRange[0], timestamp)
+                blockRange[1] = max(blockRange[1], timestamp)
+
+        canId = DecodeCanId(can_id)
+        if canId.pgn not in self.__pgns:
+            self.__pgns[canId.pgn] = newIndexEntry()
+        updateIndexEntry(self.__pgns[canId.pgn], block, timestamp)
+        if canId.source_address not in self.__sources:
+            self.__sources[canId.source_address] = newIndexEntry()
+        updateIndexEntry(self.__sources[canId.source_address], block, timestamp)
+
+        CAPTURE_RECORD.pack_into(self.__buffer, self.__bufferCount * CAPTURE_RECORD.size,
+            math.nan if timestamp is None else timestamp, can_id, min(len(data), 8), bytes(data[0:8]))
+        self.__bufferCount += 1
+        self.__count += 1
+        if self.__bufferCount == self.__blockSize:
+            self.Flush()
+
+    # Write any buffered records to disk
+    def Flush(self):
+        self.__file.write(memoryview(self.__buffer)[0:self.__bufferCount * CAPTURE_RECORD.size])
+        self.__bufferCount = 0
+
+    # Finish the capture and write the index
+    def Close(self):
+        if self.__file is None:
+            return
+        self.Flush()
+        self.__file.close()
+        self.__file = None
+
+        index = {
+            'blockSize': self.__blockSize,
+            'count': self.__count,
+            'blocks': self.__blocks,
+            'pgns': self.__pgns,
+            'sources': self.__sources,
+        }
+        tmpFile = self.__filename + '.idx.tmp'
+        with open(tmpFile, 'w') as f:
+            json.dump(index, f)
+        os.replace(tmpFile, self.__filename + '.idx')
+
+#
+# Read a capture file, optionally only the frames for some PGNs or
+# sources in a time range.
+#
+class CaptureReader(object):
+    def __init__(self, filename):
+        self.__filename = filename
+        with open(filename, 'rb') as f:
+            if f.read(len(CAPTURE_MAGIC)) != CAPTURE_MAGIC:
+                raise ValueError('%s is not a capture file' % filename)
+
+        with open(filename + '.idx', 'r') as f:
+            index = json.load(f)
+        self.__blockSize = index['blockSize']
+        self.__count = index['count']
+        self.__blocks = index['blocks']
+        # JSON keys are always strings
+        self.__pgns = dict((int(k), v) for (k, v) in index['pgns'].items())
+        self.__sources = dict((int(k), v) for (k, v) in index['sources'].items())
+
+    def __len__(self):
+        return self.__count
+
+    # The PGNs in the capture, with their time range and count
+    @property
+    def Pgns(self):
+        return self.__pgns
+
+    # The sources in the capture, with their time range and count
+    @property
+    def Sources(self):
+        return self.__sources
+
+    #
+    # Read frames from the capture.  Only the blocks that might match are
+    # read from disk.
+    #
+    # pgns -- only return these PGNs (None for all)
+    # sources -- only return frames from these source addresses (None for all)
+    # start, end -- only return frames in this time range (inclusive).
+    #   Frames without a timestamp are never in a time range.
+    # returns: a generator of (can_id, data, timestamp), in capture order.
+    #   timestamp is None if it isn't known.
+    #
+    def Frames(self, pgns=None, sources=None, start=None, end=None):
+        blocks = set(range(len(self.__blocks)))
+        if pgns is not None:
+            blocks &= self.__indexBlocks(self.__pgns, pgns)
+        if sources is not None:
+            blocks &= self.__indexBlocks(self.__sources, sources)
+        if start is not None:
+            blocks = set(b for b in blocks if self.__blocks[b] is not None and self.__blocks[b][1] >= start)
+        if end is not None:
+            blocks = set(b for b in blocks if self.__blocks[b] is not None and self.__blocks[b][0] <= end)
+
+        blockBytes = self.__blockSize * CAPTURE_RECORD.size
+        with open(self.__filename, 'rb') as f:
+            for block in sorted(blocks):
+                f.seek(len(CAPTURE_MAGIC) + block * blockBytes)
+                for (timestamp, can_id, dlc, data) in CAPTURE_RECORD.iter_unpack(f.read(blockBytes)):
+                    if math.isnan(timestamp):
+                        if start is not None or end is not None:
+                            continue
+                        timestamp = None
+                    elif start is not None and timestamp < start:
+                        continue
+                    elif end is not None and timestamp > end:
+                        continue
+                    if pgns is not None or sources is not None:
+                        canId = DecodeCanId(can_id)
+                        if pgns is not None and canId.pgn not in pgns:
+                            continue
+                        if sources is not None and canId.source_address not in sources:
+                            continue
+                    yield (can_id, data[0:dlc], timestamp)
+
+    #
+    # Run frames from the capture through a Nmea2000Reader.  Takes the
+    # same filters as Frames.
+    #
+    def Replay(self, reader, pgns=None, sources=None, start=None, end=None):
+        for (can_id, data, timestamp) in self.Frames(pgns, sources, start, end):
+            reader.HandlePacket(can_id, data, timestamp)
+
+    def __indexBlocks(self, index, keys):
+        blocks = set()
+        for k in keys:
+            if k in index:
+                blocks.update(index[k]['blocks'])
+        return blocks
+
+#
+# Convert a Raymarine or candump log into a capture file
+# returns: the number of frames written
+#
+def ConvertLog(logFilename, captureFilename, blockSize=4096):
+    count = 0
+    with CaptureWriter(captureFilename, blockSize) as writer:
+        for (can_id, data, timestamp) in ReadLogFile(logFilename):
+            writer.Write(timestamp, can_id, data)
+            count += 1
+    return count
@@ -0,0 +1,320 @@
+#!/usr/bin/python
+
+# system modules
+import os
+import sys
+import csv
+import json
+import math
+import time
+import queue
+import struct
+import threading
+from array import array
+
+#
+# A compact columnar format for logging Nmea2000State, written in large
+# blocks so that an SD card sees few, big, append only writes.
+#
+# The file starts with DATALOG_MAGIC, then a header:
+#   length -- uint32, the length of the JSON that follows
+#   JSON -- { "columns": [ { "name", "units", "type" } ] }
+# A column's type is 'd' (double, NaN if unknown) for variables with units
+# or 's' (a string stored as a uint16 code, 0xffff if unknown) for the
+# rest.
+#
+# Then blocks of rows, each one is:
+#   BLOCK_HEADER -- magic, rows, dictionary length, payload length
+#   dictionary -- JSON list with the strings for each 's' column, in
+#     column order.  Codes are indexes into the column's list.
+#   payload -- the timestamps (doubles), then each column's values, all
+#     little endian
+# Every block stands alone, so a file that was cut off by a power failure
+# can be read up to the last complete block.
+#
+
+DATALOG_MAGIC = b'N2KLOG\x00\x01'
+BLOCK_HEADER = struct.Struct('<4sIII')
+BLOCK_MAGIC = b'BLK\x00'
+DATALOG_EXTENSION = '.n2kl'
+UNKNOWN_CODE = 0xffff
+NAN = float('nan')
+
+# when to call fsync on the log file
+FSYNC_NEVER = 0
+FSYNC_BLOCK = 1
+FSYNC_ROTATE = 2
+
+#
+# arrays are stored little endian
+#
+def arrayBytes(a):
+    if sys.byteorder != 'little':
+        a = array(a.typecode, a)
+        a.byteswap()
+    return a.tobytes()
+
+def bytesArray(typecode, b):
+    a = array(typecode)
+    a.frombytes(b)
+    if sys.byteorder != 'little':
+        a.byteswap()
+    return a
+
+#
+# The rows for one block, in typed arrays
+#
+# columns -- [ (name, units) ]
+#
+class DataLogBuffer(object):
+    def __init__(self, columns):
+        self.__columns = columns
+        self.__timestamps = array('d')
+        self.__values = []
+        # string: code, for each 's' column
+        self.__dictionaries = []
+        for (name, units) in columns:
+            if columnType(units) == 'd':
+                self.__values.append(array('d'))
+                self.__dictionaries.append(None)
+            else:
+                self.__values.append(array('H'))
+                self.__dictionaries.append({})
+
+    def __len__(self):
+        return len(self.__timestamps)
+
+    # The time of the first row, None if there are no rows
+    @property
+    def First(self):
+        if len(self.__timestamps) == 0:
+            return None
+        return self.__timestamps[0]
+
+    #
+    # Add a row
+    #
+    # timestamp -- time in seconds
+    # values -- the value of each column, None if it is unknown
+    #
+    def Append(self, timestamp, values):
+        self.__timestamps.append(timestamp)
+        for (column, dictionary, value) in zip(self.__values, self.__dictionaries, values):
+            if dictionary is None:
+                column.append(NAN if value is None else value)
+            elif value is None:
+                column.append(UNKNOWN_CODE)
+            else:
+                value = str(value)
+                code = dictionary.get(value)
+                if code is None:
+                    code = len(dictionary)
+                    dictionary[value] = code
+                column.append(code)
+
+    #
+    # Encode the rows as a block
+    #
+    def Encode(self):
+        dictionaries = []
+        for dictionary in self.__dictionaries:
+            if dictionary is not None:
+                dictionaries.append(sorted(dictionary, key=dictionary.get))
+        dictionary = json.dumps(dictionaries).encode('utf-8')
+        payload = [ arrayBytes(self.__timestamps) ] + [ arrayBytes(column) for column in self.__values ]
+        payloadLength = sum(len(p) for p in payload)
+        header = BLOCK_HEADER.pack(BLOCK_MAGIC, len(self.__timestamps), len(dictionary), payloadLength)
+        return b''.join([ header, dictionary ] + payload)
+
+def columnType(units):
+    return 'd' if units else 's'
+
+#
+# Write blocks to log files from a background thread, so that slow
+# writes (or an fsync) never hold up the caller.
+#
+# A new file is started every rotateSeconds, named from the time of its
+# first row.
+#
+# directory -- where to put the log files
+# columns -- [ (name, units) ]
+# prefix -- start of the file names (then the date and time)
+# rotateSeconds -- how long each file covers, None for one file
+# fsync -- one of FSYNC_NEVER, FSYNC_BLOCK or FSYNC_ROTATE
+# maxQueue -- the most blocks waiting to be written.  Write() drops
+#   blocks past this, so that a stuck card can't use up all of the memory.
+#
+class DataLogWriter(object):
+    def __init__(self, directory, columns, prefix='saildata-', rotateSeconds=3600, fsync=FSYNC_BLOCK, maxQueue=16):
+        self.__directory = directory
+        self.__columns = columns
+        self.__prefix = prefix
+        self.__rotateSeconds = rotateSeconds
+        self.__fsync = fsync
+        self.__queue = queue.Queue(maxQueue)
+        self.__file = None
+        self.__fileStart = None
+        self.__dropped = 0
+        self.__filenames = []
+
+        os.makedirs(directory, exist_ok=True)
+        self.__header = json.dumps({ 'columns': [
+            { 'name': name, 'units': units, 'type': columnType(units) } for (name, units) in columns ] }).encode('utf-8')
+
+        self.__thread = threading.Thread(target=self.worker)
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    # The number of blocks dropped because the queue was full
+    @property
+    def Dropped(self):
+        return self.__dropped
+
+    # The files written so far
+    @property
+    def Filenames(self):
+        return list(self.__filenames)
+
+    #
+    # Queue a DataLogBuffer to be written.  The buffer must not be changed
+    # afterwards.
+    #
+    def Write(self, buffer):
+        if len(buffer) == 0:
+            return
+        try:
+            self.__queue.put_nowait(buffer)
+        except queue.Full:
+            self.__dropped += 1
+
+    #
+    # Write everything that is queued and close the file
+    #
+    def Close(self):
+        self.__queue.put(None)
+        self.__thread.join()
+
+    #
+    # This is the main body of the writer thread
+    #
+    def worker(self):
+        while True:
+            buffer = self.__queue.get()
+            if buffer is None:
+                break
+            first = buffer.First
+            if self.__file is None or (self.__rotateSeconds is not None and first >= self.__fileStart + self.__rotateSeconds):
+                self.closeFile()
+                self.openFile(first)
+            self.__file.write(buffer.Encode())
+            self.__file.flush()
+            if self.__fsync == FSYNC_BLOCK:
+                os.fsync(self.__file.fileno())
+        self.closeFile()
+
+    def openFile(self, timestamp):
+        name = "%s%s" % (self.__prefix, time.strftime('%Y-%m-%d-%H-%M-%S', time.localtime(timestamp)))
+        filename = os.path.join(self.__directory, name + DATALOG_EXTENSION)
+        self.__file = open(filename, 'wb')
+        self.__file.write(DATALOG_MAGIC)
+        self.__file.write(struct.pack('<I', len(self.__header)))
+        self.__file.write(self.__header)
+        self.__fileStart = timestamp
+        self.__filenames.append(filename)
+
+    def closeFile(self):
+        if self.__file is None:
+            return
+        self.__file.flush()
+        if self.__fsync != FSYNC_NEVER:
+            os.fsync(self.__file.fileno())
+        self.__file.close()
+        self.__file = None
+
+#
+# Read a log file written by DataLogWriter
+#
+class DataLogReader(object):
+    def __init__(self, filename):
+        self.__filename = filename
+        with open(filename, 'rb') as f:
+            if f.read(len(DATALOG_MAGIC)) != DATALOG_MAGIC:
+                raise ValueError("%s is not a data log" % filename)
+            (length,) = struct.unpack('<I', f.read(4))
+            self.__header = json.loads(f.read(length).decode('utf-8'))
+            self.__dataStart = f.tell()
+
+    # [ (name, units) ]
+    @property
+    def Columns(self):
+        return [ (c['name'], c['units']) for c in self.__header['columns'] ]
+
+    #
+    # Iterate over the blocks in the file.  Each one is (timestamps,
+    # columns) where timestamps is an array of doubles and columns is a
+    # list with the values of each column (an array of doubles, or a list
+    # of strings with None for unknown).
+    #
+    def Blocks(self):
+        types = [ c['type'] for c in self.__header['columns'] ]
+        with open(self.__filename, 'rb') as f:
+            f.seek(self.__dataStart)
+            while True:
+                header = f.read(BLOCK_HEADER.size)
+                if len(header) < BLOCK_HEADER.size:
+                    break
+                (magic, rows, dictionaryLength, payloadLength) = BLOCK_HEADER.unpack(header)
+                if magic != BLOCK_MAGIC:
+                    break
+                dictionary = f.read(dictionaryLength)
+                payload = f.read(payloadLength)
+                # a block that was cut off
+                if len(dictionary) < dictionaryLength or len(payload) < payloadLength:
+                    break
+                dictionaries = iter(json.loads(dictionary.decode('utf-8')))
+
+                timestamps = bytesArray('d', payload[0:8 * rows])
+                offset = 8 * rows
+                columns = []
+                for t in types:
+                    if t == 'd':
+                        columns.append(bytesArray('d', payload[offset:offset + 8 * rows]))
+                        offset += 8 * rows
+                    else:
+                        strings = next(dictionaries)
+                        codes = bytesArray('H', payload[offset:offset + 2 * rows])
+                        columns.append([ None if code == UNKNOWN_CODE else strings[code] for code in codes ])
+                        offset += 2 * rows
+                yield (timestamps, columns)
+
+    #
+    # Iterate over the rows in the file as (timestamp, [ values ]), with
+    # None for unknown values
+    #
+    def Rows(self):
+        for (timestamps, columns) in self.Blocks():
+            for i in range(len(timestamps)):
+                values = []
+                for column in columns:
+                    value = column[i]
+                    if isinstance(value, float) and math.isnan(value):
+                        value = None
+                    values.append(value)
+                yield (timestamps[i], values)
+
+#
+# Export a data log as CSV, with a header of "name (units)".  Unknown
+# values are left empty.
+#
+# returns: the number of rows written
+#
+def ExportCsv(logFilename, csvFilename):
+    reader = DataLogReader(logFilename)
+    count = 0
+    with open(csvFilename, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow([ 'Time' ] + [ "%s (%s)" % (name, units) for (name, units) in reader.Columns ])
+        for (timestamp, values) in reader.Rows():
+            writer.writerow([ "%.3f" % timestamp ] + [ '' if v is None else v for v in values ])
+            count += 1
+    return count
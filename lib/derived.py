@@ -0,0 +1,144 @@
+#!/usr/bin/python
+
+# system modules
+import math
+import collections
+
+#
+# Channels that Nmea2000State computes from other state variables.  A
+# channel is only recomputed when one of its inputs changes.
+#
+# inputs -- the state variables that the channel is computed from
+# outputs -- dict of the variables that the channel sets to their units
+# fn -- called with a Nmea2000Snapshot, returns a dict of output values
+#   (None for unknown)
+#
+DerivedChannel = collections.namedtuple('DerivedChannel', ['inputs', 'outputs', 'fn'])
+
+TWO_PI = 2 * math.pi
+
+# Wind references (130306 Reference).  The two True references to the
+# boat are angles off the bow, over the ground and through the water.
+WIND_TRUE_NORTH = 'True (ground referenced to North)'
+WIND_MAGNETIC_NORTH = 'Magnetic (ground referenced to Magnetic North)'
+WIND_APPARENT = 'Apparent'
+WIND_TRUE_BOAT = 'True (boat referenced)'
+WIND_TRUE_WATER = 'True (water referenced)'
+
+#
+# The heading referenced to true north, or None
+#
+def trueHeading(state):
+    heading = state['Heading']
+    if heading is None:
+        return None
+    reference = state['HeadingReference']
+    if reference == 'True':
+        return heading
+    variation = state['Variation']
+    if reference == 'Magnetic' and variation is not None:
+        return (heading + variation) % TWO_PI
+    return None
+
+#
+# True wind (referenced to the water) from apparent wind, boat speed and
+# heading.
+#
+# TrueWindAngle -- angle off the bow
+# TrueWindSpeed -- speed
+# TrueWindDirection -- direction the wind is coming from, from true north
+# MagneticWindDirection -- direction from magnetic north
+#
+def trueWind(state):
+    out = { 'TrueWindAngle': None, 'TrueWindSpeed': None, 'TrueWindDirection': None, 'MagneticWindDirection': None }
+    angle = state['WindAngle']
+    speed = state['WindSpeed']
+    reference = state['WindReference']
+    variation = state['Variation']
+    if angle is None or speed is None:
+        return out
+
+    if reference == WIND_TRUE_NORTH:
+        out['TrueWindDirection'] = angle
+        out['TrueWindSpeed'] = speed
+        if variation is not None:
+            out['MagneticWindDirection'] = (angle - variation) % TWO_PI
+        return out
+    if reference == WIND_MAGNETIC_NORTH:
+        out['MagneticWindDirection'] = angle
+        out['TrueWindSpeed'] = speed
+        if variation is not None:
+            out['TrueWindDirection'] = (angle + variation) % TWO_PI
+        return out
+
+    if reference == WIND_APPARENT:
+        boatSpeed = state['SpeedThroughWater']
+        if boatSpeed is None:
+            return out
+        x = speed * math.cos(angle) - boatSpeed
+        y = speed * math.sin(angle)
+        speed = math.hypot(x, y)
+        angle = math.atan2(y, x) % TWO_PI
+    elif reference not in (WIND_TRUE_BOAT, WIND_TRUE_WATER):
+        # unknown or not a wind reference
+        return out
+
+    out['TrueWindAngle'] = angle
+    out['TrueWindSpeed'] = speed
+    heading = state['Heading']
+    if heading is None:
+        return out
+    direction = (heading + angle) % TWO_PI
+    if state['HeadingReference'] == 'True':
+        out['TrueWindDirection'] = direction
+        if variation is not None:
+            out['MagneticWindDirection'] = (direction - variation) % TWO_PI
+    elif state['HeadingReference'] == 'Magnetic':
+        out['MagneticWindDirection'] = direction
+        if variation is not None:
+            out['TrueWindDirection'] = (direction + variation) % TWO_PI
+    return out
+
+#
+# Velocity made good towards the wind (negative when sailing away from
+# it)
+#
+def vmg(state):
+    boatSpeed = state['SpeedThroughWater']
+    angle = state['TrueWindAngle']
+    if boatSpeed is None or angle is None:
+        return { 'VMG': None }
+    return { 'VMG': boatSpeed * math.cos(angle) }
+
+#
+# The current is the difference between where we are going over the
+# ground (COG/SOG) and through the water (heading/boat speed).
+#
+# CurrentSet -- direction the current is flowing to, from true north
+# CurrentDrift -- speed of the current
+#
+def current(state):
+    heading = trueHeading(state)
+    boatSpeed = state['SpeedThroughWater']
+    cog = state['COG']
+    sog = state['SOG']
+    if heading is None or boatSpeed is None or cog is None or sog is None:
+        return { 'CurrentSet': None, 'CurrentDrift': None }
+    x = sog * math.cos(cog) - boatSpeed * math.cos(heading)
+    y = sog * math.sin(cog) - boatSpeed * math.sin(heading)
+    return { 'CurrentSet': math.atan2(y, x) % TWO_PI, 'CurrentDrift': math.hypot(x, y) }
+
+DERIVED_CHANNELS = {
+    'TrueWind': DerivedChannel(
+        [ 'WindAngle', 'WindSpeed', 'WindReference', 'SpeedThroughWater', 'Heading', 'HeadingReference', 'Variation' ],
+        { 'TrueWindAngle': 'rad', 'TrueWindSpeed': 'm/s', 'TrueWindDirection': 'rad', 'MagneticWindDirection': 'rad' },
+        trueWind),
+    'VMG': DerivedChannel(
+        [ 'SpeedThroughWater', 'TrueWindAngle' ],
+        { 'VMG': 'm/s' },
+        vmg),
+    'Current': DerivedChannel(
+        [ 'Heading', 'HeadingReference', 'Variation', 'SpeedThroughWater', 'COG', 'SOG' ],
+        { 'CurrentSet': 'rad', 'CurrentDrift': 'm/s' },
+        current),
+}
@@ -0,0 +1,270 @@
+#!/usr/bin/python
+
+# system modules
+import time
+import collections
+
+# local modules
+from lib.nmea2000 import GetPgnTable, EncodeCanId, DataRecord, MAX_FAST_PACKET_LENGTH
+
+#
+# Encode NMEA 2000 records into CAN frames, using the same PgnDecodePlan
+# fields that PacketState.decode uses, so that anything encoded here
+# decodes back to the same values.
+#
+# Fields that aren't given (and SID and reserved bits) are sent as all
+# ones, which is what NMEA 2000 uses for "not available".
+#
+
+DEFAULT_PRIORITY = 6
+
+# bits on the wire for an extended CAN frame with n data bytes, not
+# counting bit stuffing
+CAN_FRAME_BITS = 67
+CAN_BYTE_BITS = 8
+
+#
+# How to encode one field
+#
+# name -- field name (the key in the values to encode)
+# bitOffset, bitLength -- where the field goes
+# low, high -- the range of raw values
+# unknownValue -- the raw value for None
+# resolution -- scale factor, or None
+# enumCodes -- lookup table name to raw value, or None
+# text -- True for ASCII text fields
+#
+EncodeField = collections.namedtuple('EncodeField', [
+    'name', 'bitOffset', 'bitLength', 'low', 'high', 'unknownValue',
+    'resolution', 'enumCodes', 'text'])
+
+#
+# The compiled encoder for one PGN
+#
+# fields -- tuple of EncodeField
+# length -- the payload length in bytes
+# fastPacket -- True if the PGN is sent as a fast packet
+#
+EncodePlan = collections.namedtuple('EncodePlan', ['fields', 'length', 'fastPacket'])
+
+#
+# Build the EncodePlan for a PgnDecodePlan
+#
+def compileEncodePlan(plan):
+    fields = []
+    # pgns.json gives the longest length for PGNs with repeating fields,
+    # fast packets are only as long as the fields that we send
+    length = 0 if plan.fastPacket else plan.pgnRecord.get('Length', 8)
+    for f in plan.fields:
+        # variable length fields can't be decoded either
+        if f.bitLength <= 0:
+            continue
+        length = max(length, f.minLength)
+
+        # decode only sees a signed value when it reads whole struct
+        # sized integers without shifting or masking them
+        if f.signed and f.shift == 0 and f.bitLength % 8 == 0 and f.numBytes in (1, 2, 4, 8):
+            low = -(1 << (f.bitLength - 1))
+            high = (1 << (f.bitLength - 1)) - 1
+        else:
+            low = 0
+            high = (1 << f.bitLength) - 1
+
+        enumCodes = None
+        if f.enumValues is not None:
+            enumCodes = {}
+            for (code, name) in f.enumValues.items():
+                enumCodes.setdefault(name, code)
+
+        fields.append(EncodeField(
+            name=f.name,
+            bitOffset=f.bitOffset,
+            bitLength=f.bitLength,
+            low=low,
+            high=high,
+            unknownValue=f.unknownValue,
+            resolution=f.resolution,
+            enumCodes=enumCodes,
+            text=f.dataType == 'ASCII text'))
+    return EncodePlan(tuple(fields), length, plan.fastPacket)
+
+#
+# Turn a value into the raw bits for a field
+#
+# rawValue -- value is from before the lookup table was applied
+#
+def encodeField(pgn, field, value, rawValue=False):
+    if value is None:
+        return field.unknownValue & ((1 << field.bitLength) - 1)
+
+    if field.text:
+        data = value.encode('ascii')
+        n = field.bitLength // 8
+        if len(data) > n:
+            raise ValueError("pgn %i field %s: %r is longer than %i characters" % (pgn, field.name, value, n))
+        # decode drops the 0xff padding
+        return int.from_bytes(data + b'\xff' * (n - len(data)), 'little')
+
+    if field.enumCodes is not None and not rawValue and isinstance(value, str):
+        if value in field.enumCodes:
+            value = field.enumCodes[value]
+        elif value.startswith('"') and value.endswith('"'):
+            # decode writes values that aren't in the table as "n"
+            value = int(value[1:-1])
+        else:
+            raise ValueError("pgn %i field %s: unknown value %r" % (pgn, field.name, value))
+
+    if field.resolution is not None:
+        raw = int(round(value / field.resolution))
+    else:
+        raw = int(round(value))
+
+    if raw < field.low or raw > field.high or raw == field.unknownValue:
+        raise ValueError("pgn %i field %s: %r is out of range" % (pgn, field.name, value))
+    return raw & ((1 << field.bitLength) - 1)
+
+#
+# Split a payload into fast packet frames (see FastPacket)
+#
+# sequence -- the 3 bit sequence counter for this message
+# returns: list of 8 byte frames
+#
+def FastPacketFrames(payload, sequence):
+    if len(payload) > MAX_FAST_PACKET_LENGTH:
+        raise ValueError("fast packets can't be longer than %i bytes" % MAX_FAST_PACKET_LENGTH)
+    sequence = (sequence & 0x7) << 5
+    frames = [ bytes((sequence, len(payload))) + payload[0:6] ]
+    for (frame, offset) in enumerate(range(6, len(payload), 7), 1):
+        frames.append(bytes((sequence | frame,)) + payload[offset:offset + 7])
+    # pad the last frame
+    frames[-1] = frames[-1] + b'\xff' * (8 - len(frames[-1]))
+    return frames
+
+#
+# Encodes records for one source address.  Each fast packet PGN gets
+# its own sequence counter.
+#
+# source_address -- the address to send from
+# pgnTable -- the PgnTable to use, default is GetPgnTable()
+#
+class Nmea2000Encoder(object):
+    def __init__(self, source_address, pgnTable=None):
+        self.__source_address = source_address
+        self.__pgnTable = pgnTable or GetPgnTable()
+        self.__plans = {}
+        self.__sequences = {}
+
+    def __plan(self, pgn):
+        plan = self.__plans.get(pgn)
+        if plan is None:
+            decodePlan = self.__pgnTable.GetDecodePlan(pgn)
+            if decodePlan is None:
+                raise KeyError("unknown pgn %i" % pgn)
+            plan = compileEncodePlan(decodePlan)
+            self.__plans[pgn] = plan
+        return plan
+
+    #
+    # Encode the payload of a record
+    #
+    # pgn -- the PGN
+    # values -- dict (or DataRecord) of field name to value.  Values are
+    #   in the same form that decode produces: scaled numbers, lookup
+    #   table names or strings.  Missing fields are sent as unknown.  
+    #   Lookup table fields from a DataRecord use the raw value, so that
+    #   values that aren't in the table come back the same.
+    # returns: bytes
+    #
+    def Encode(self, pgn, values):
+        plan = self.__plan(pgn)
+        record = isinstance(values, DataRecord)
+        bits = (1 << (plan.length * 8)) - 1
+        for field in plan.fields:
+            if record:
+                value = values.GetValue(field.name)
+                if value is not None:
+                    value = values.GetRawValue(field.name)
+                raw = encodeField(pgn, field, value, True)
+            else:
+                raw = encodeField(pgn, field, values.get(field.name))
+            mask = ((1 << field.bitLength) - 1) << field.bitOffset
+            bits = (bits & ~mask) | (raw << field.bitOffset)
+        return bits.to_bytes(plan.length, 'little')
+
+    #
+    # Encode a record into CAN frames
+    #
+    # priority -- default is DEFAULT_PRIORITY
+    # destination_address -- only used by PDU1 PGNs
+    # returns: list of (can_id, data)
+    #
+    def Frames(self, pgn, values, priority=None, destination_address=0xff):
+        plan = self.__plan(pgn)
+        payload = self.Encode(pgn, values)
+        if priority is None:
+            priority = DEFAULT_PRIORITY
+        can_id = EncodeCanId(pgn, self.__source_address, priority, destination_address)
+        if not plan.fastPacket:
+            return [ (can_id, payload) ]
+        sequence = self.__sequences.get(pgn, 0)
+        self.__sequences[pgn] = (sequence + 1) & 0x7
+        return [ (can_id, frame) for frame in FastPacketFrames(payload, sequence) ]
+
+#
+# Send records to the bus, pacing the frames so that they use no more
+# than busLoad of the bus.  Pacing uses absolute deadlines, so a slow
+# send() is made up for on the next frames rather than adding up.
+#
+# send -- function called with (can_id, data) for each frame
+# encoder -- the Nmea2000Encoder to use
+# bitrate -- the bus speed, NMEA 2000 is 250 kbit/s
+# busLoad -- the fraction of the bus to use, None to not pace
+#
+class Nmea2000Sender(object):
+    def __init__(self, send, encoder, bitrate=250000, busLoad=0.3):
+        self.__send = send
+        self.__encoder = encoder
+        self.__bitsPerSecond = None if busLoad is None else bitrate * busLoad
+        self.__deadline = 0.0
+        self.__messages = 0
+        self.__frames = 0
+
+    # The number of records and frames sent
+    @property
+    def Messages(self):
+        return self.__messages
+
+    @property
+    def Frames(self):
+        return self.__frames
+
+    #
+    # Send one record, see Nmea2000Encoder.Frames
+    #
+    def Send(self, pgn, values, priority=None, destination_address=0xff):
+        self.SendBatch([ (pgn, values, priority, destination_address) ])
+
+    #
+    # Send a list of records.  Each one is (pgn, values) or (pgn, values,
+    # priority, destination_address).  Everything is encoded before the
+    # first frame is sent so that the frames go out evenly spaced.
+    #
+    def SendBatch(self, messages):
+        frames = []
+        for message in messages:
+            frames.extend(self.__encoder.Frames(*message))
+        self.__messages += len(messages)
+
+        send = self.__send
+        bitsPerSecond = self.__bitsPerSecond
+        for (can_id, data) in frames:
+            if bitsPerSecond is not None:
+                now = time.monotonic()
+                if self.__deadline > now:
+                    time.sleep(self.__deadline - now)
+                else:
+                    # don't make up for time when we were idle
+                    self.__deadline = now
+                self.__deadline += (CAN_FRAME_BITS + CAN_BYTE_BITS * len(data)) / bitsPerSecond
+            send(can_id, data)
+            self.__frames += 1
@@ -0,0 +1,210 @@
+#!/usr/bin/python
+
+# system modules
+import math
+import collections
+from array import array
+
+#
+# A fixed size history of (timestamp, value) samples for one variable,
+# stored in two ring buffers of doubles.
+#
+# Aggregates (mean, min, max and circular mean) over the last window
+# seconds are kept up to date as samples are added, so asking for them
+# doesn't look at the samples.  The sums are recomputed from scratch once
+# every capacity samples so that rounding errors don't build up.
+# Aggregates over other windows are worked out from the samples.
+#
+# capacity -- the most samples to keep
+# window -- the length of the running aggregates in seconds
+# angle -- the values are angles in radians, keep the running circular
+#   mean
+#
+class History(object):
+    def __init__(self, capacity=1024, window=30.0, angle=False):
+        if window <= 0:
+            raise ValueError("history window must be more than 0 seconds")
+        self.__capacity = capacity
+        self.__window = window
+        self.__angle = angle
+        self.__timestamps = array('d', bytes(8 * capacity))
+        self.__values = array('d', bytes(8 * capacity))
+
+        # number of samples ever added, sample n is stored at
+        # n % capacity
+        self.__count = 0
+        # the first sample in the window
+        self.__start = 0
+
+        # running aggregates over the samples in the window
+        self.__sum = 0.0
+        self.__sin = 0.0
+        self.__cos = 0.0
+        # sample numbers in the window with increasing (min) or
+        # decreasing (max) values.  The first one is the min or max.
+        self.__minQueue = collections.deque()
+        self.__maxQueue = collections.deque()
+
+    # The number of samples stored
+    def __len__(self):
+        return min(self.__count, self.__capacity)
+
+    @property
+    def Window(self):
+        return self.__window
+
+    # The number of samples in the running window
+    @property
+    def WindowCount(self):
+        return self.__count - self.__start
+
+    # The newest (timestamp, value), or None if there are no samples
+    @property
+    def Latest(self):
+        if self.__count == 0:
+            return None
+        i = (self.__count - 1) % self.__capacity
+        return (self.__timestamps[i], self.__values[i])
+
+    #
+    # Add a sample.  Timestamps should not go backwards.
+    #
+    def Append(self, timestamp, value):
+        n = self.__count
+        capacity = self.__capacity
+
+        # the sample being overwritten leaves the window
+        if n - self.__start >= capacity:
+            self.__remove()
+
+        i = n % capacity
+        self.__timestamps[i] = timestamp
+        self.__values[i] = value
+        self.__count = n + 1
+
+        self.__sum += value
+        if self.__angle:
+            self.__sin += math.sin(value)
+            self.__cos += math.cos(value)
+
+        minQueue = self.__minQueue
+        while minQueue and self.__values[minQueue[-1] % capacity] >= value:
+            minQueue.pop()
+        minQueue.append(n)
+        maxQueue = self.__maxQueue
+        while maxQueue and self.__values[maxQueue[-1] % capacity] <= value:
+            maxQueue.pop()
+        maxQueue.append(n)
+
+        # samples that are too old leave the window
+        oldest = timestamp - self.__window
+        while self.__start < self.__count and self.__timestamps[self.__start % capacity] <= oldest:
+            self.__remove()
+
+        if self.__count % capacity == 0:
+            self.__resum()
+
+    # remove the first sample in the window from the running aggregates
+    def __remove(self):
+        n = self.__start
+        value = self.__values[n % self.__capacity]
+        self.__sum -= value
+        if self.__angle:
+            self.__sin -= math.sin(value)
+            self.__cos -= math.cos(value)
+        if self.__minQueue[0] == n:
+            self.__minQueue.popleft()
+        if self.__maxQueue[0] == n:
+            self.__maxQueue.popleft()
+        self.__start = n + 1
+
+    # recompute the running sums
+    def __resum(self):
+        values = [v for (t, v) in self.__samples(self.__start)]
+        self.__sum = math.fsum(values)
+        if self.__angle:
+            self.__sin = math.fsum(math.sin(v) for v in values)
+            self.__cos = math.fsum(math.cos(v) for v in values)
+
+    # (timestamp, value) from sample number start to the newest
+    def __samples(self, start):
+        capacity = self.__capacity
+        for n in range(start, self.__count):
+            i = n % capacity
+            yield (self.__timestamps[i], self.__values[i])
+
+    # the samples in the last window seconds
+    def __window_samples(self, window):
+        if window is None or window == self.__window:
+            return self.__samples(self.__start)
+        start = max(self.__count - self.__capacity, 0)
+        if self.__count > 0:
+            oldest = self.Latest[0] - window
+            while start < self.__count and self.__timestamps[start % self.__capacity] <= oldest:
+                start += 1
+        return self.__samples(start)
+
+    #
+    # Aggregates over the last window seconds (ending at the newest
+    # sample).  window defaults to the running window.  These return None
+    # if there are no samples in the window.
+    #
+    def Mean(self, window=None):
+        if window is None or window == self.__window:
+            count = self.__count - self.__start
+            if count == 0:
+                return None
+            return self.__sum / count
+        values = [v for (t, v) in self.__window_samples(window)]
+        if not values:
+            return None
+        return math.fsum(values) / len(values)
+
+    def Min(self, window=None):
+        if window is None or window == self.__window:
+            if not self.__minQueue:
+                return None
+            return self.__values[self.__minQueue[0] % self.__capacity]
+        return min((v for (t, v) in self.__window_samples(window)), default=None)
+
+    def Max(self, window=None):
+        if window is None or window == self.__window:
+            if not self.__maxQueue:
+                return None
+            return self.__values[self.__maxQueue[0] % self.__capacity]
+        return max((v for (t, v) in self.__window_samples(window)), default=None)
+
+    #
+    # The mean of angles (in radians, from 0 to 2 pi), so that the mean
+    # of 350 and 10 degrees is 0 and not 180
+    #
+    def CircularMean(self, window=None):
+        if self.__angle and (window is None or window == self.__window):
+            if self.__count == self.__start:
+                return None
+            (s, c) = (self.__sin, self.__cos)
+        else:
+            values = [v for (t, v) in self.__window_samples(window)]
+            if not values:
+                return None
+            s = math.fsum(math.sin(v) for v in values)
+            c = math.fsum(math.cos(v) for v in values)
+        return math.atan2(s, c) % (2 * math.pi)
+
+    #
+    # The samples as NumPy arrays (timestamps, values), oldest first.
+    #
+    # If the ring hasn't wrapped around then these are views of the ring
+    # buffers without a copy, and they will change as samples are added.
+    # Copy them if they need to be kept.
+    #
+    def Arrays(self):
+        # numpy is only needed for exporting history
+        import numpy
+        timestamps = numpy.frombuffer(self.__timestamps, dtype=numpy.float64)
+        values = numpy.frombuffer(self.__values, dtype=numpy.float64)
+        if self.__count <= self.__capacity:
+            return (timestamps[0:self.__count], values[0:self.__count])
+        i = self.__count % self.__capacity
+        return (numpy.concatenate((timestamps[i:], timestamps[0:i])),
+            numpy.concatenate((values[i:], values[0:i])))
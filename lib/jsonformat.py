@@ -0,0 +1,125 @@
+#!/usr/bin/python
+
+# system modules
+import math
+import json
+import time
+from json.encoder import encode_basestring_ascii
+
+# local modules
+from lib.nmea2000 import GetPgnTable
+
+#
+# Format DataRecords as JSON that is compatible with canboat's analyzer:
+#
+# {"timestamp": "2015-04-02-18:23:39.123", "prio": 2, "src": 1, "dst": 255,
+#  "pgn": 130306, "description": "Wind Data", "Fields": {"Wind Speed": 3.1,
+#  "Wind Angle": "12.30", "Reference": "Apparent"}}
+#
+# The output is the same as building that object and calling json.dumps,
+# but everything that is the same for every record of a PGN (key order,
+# escaped names, how to convert each value) is worked out once per PGN.
+# Angles are converted to degrees and unknown values are "Unknown".
+#
+
+#
+# Convert a field value to JSON
+#
+def formatValue(value):
+    if value is None:
+        return '"Unknown"'
+    t = type(value)
+    if t is int:
+        return int.__repr__(value)
+    if t is float and math.isfinite(value):
+        return float.__repr__(value)
+    if t is str:
+        return encode_basestring_ascii(value)
+    return json.dumps(value)
+
+# I can't think in radians, convert those to degrees
+def formatDegrees(value):
+    if value is None:
+        return '"Unknown"'
+    return '"%.2f"' % math.degrees(value)
+
+# units that are converted from radians to degrees
+DEGREES_UNITS = ('rad', 'rad/s')
+
+#
+# How to format one PGN
+#
+# header -- the JSON between the timestamp and the fields, with %i for
+#   the priority, source and destination
+# fields -- [ (prefix, name, format function) ], prefix is the JSON up
+#   to the value
+#
+class JsonFormatPlan(object):
+    def __init__(self, plan, pgn):
+        self.header = ', "prio": %%i, "src": %%i, "dst": %%i, "pgn": %i, "description": %s, "Fields": {' % (
+            pgn, json.dumps(plan.pgnRecord["Description"]))
+
+        # fields with the same long name are stored in the same key, the
+        # key stays where the first one was but the value is the last one
+        order = []
+        last = {}
+        for name in plan.names:
+            longName = plan.fields[plan.fieldIndex[name]].longName
+            if longName not in last:
+                order.append(longName)
+            last[longName] = name
+
+        self.fields = []
+        for longName in order:
+            name = last[longName]
+            f = plan.fields[plan.fieldIndex[name]]
+            prefix = encode_basestring_ascii(longName) + ': '
+            if self.fields:
+                prefix = ', ' + prefix
+            fn = formatDegrees if f.units in DEGREES_UNITS else formatValue
+            self.fields.append((prefix, name, fn))
+
+#
+# Formats records as canboat JSON, see above
+#
+class JsonFormatter(object):
+    def __init__(self):
+        self.__pgnTable = GetPgnTable()
+        # pgn: JsonFormatPlan
+        self.__plans = {}
+        # the timestamp is formatted once per second
+        self.__second = None
+        self.__secondPrefix = None
+
+    #
+    # Format a record
+    #
+    # pgn, dataRecord, pgnRecord -- as passed to PgnConsumer.ConsumePgn
+    # now -- the time of the record, default is the current time
+    # returns: the JSON as bytes, with a trailing newline
+    #
+    def Format(self, pgn, dataRecord, pgnRecord, now=None):
+        formatPlan = self.__plans.get(pgn)
+        if formatPlan is None:
+            formatPlan = JsonFormatPlan(self.__pgnTable.GetDecodePlan(pgn), pgn)
+            self.__plans[pgn] = formatPlan
+
+        out = [self.__timestamp(now), formatPlan.header % (dataRecord.priority, dataRecord.source_address, dataRecord.destination_address)]
+        for (prefix, name, fn) in formatPlan.fields:
+            out.append(prefix)
+            out.append(fn(dataRecord.GetValue(name)))
+        out.append('}}\n')
+        return ''.join(out).encode('ascii')
+
+    #
+    # The start of the record up to the end of the timestamp:
+    # {"timestamp": "2015-04-02-18:23:39.123"
+    #
+    def __timestamp(self, now):
+        if now is None:
+            now = time.time()
+        second = int(now)
+        if second != self.__second:
+            self.__secondPrefix = time.strftime('{"timestamp": "%Y-%m-%d-%H:%M:%S.', time.localtime(second))
+            self.__second = second
+        return '%s%03i"' % (self.__secondPrefix, int((now - second) * 1000))
@@ -0,0 +1,291 @@
+#!/usr/bin/python
+
+# system modules
+import os
+import mmap
+import heapq
+import queue
+import traceback
+import multiprocessing
+from contextlib import closing
+
+# local modules
+from lib.nmea2000 import Nmea2000Reader, PgnConsumer, PgnPrinter
+
+#
+# Parse a line from a NMEA 2000 log.  Two formats are supported:
+#
+# The format written by a Raymarine plotter running Lighthouse II
+# Rx 478700 09 f5 03 05 f8 00 00 ff ff ff ff ff
+# ignored-- header----- data-------------------
+# The second word is a timestamp in milliseconds
+#
+# candump logs
+# can0 09F50305 [8] F8 00 00 FF FF FF FF FF
+#
+# returns: (identifier, data, timestamp) or None for a blank line.
+#   timestamp is in seconds, or None if the log doesn't have one
+#
+def ParseLogLine(line):
+    words = line.split()
+    if not words:
+        return None
+
+    if words[0] == "Rx" or words[0] == "Tx":
+        # parse Raymarine log
+        identifier = int(''.join(words[2:6]), 16)
+        data = bytearray.fromhex(''.join(words[6:]))
+        timestamp = int(words[1]) / 1000.0
+    else:
+        # candump log
+        identifier = int(words[1], 16)
+        data = bytearray.fromhex(''.join(words[3:]))
+        timestamp = None
+
+    return (identifier, data, timestamp)
+
+#
+# Raymarine lines with 8 bytes of data always end with the 4 header bytes
+# and 8 data bytes, each two hex digits with a space in front:
+# Rx 478700 09 f5 03 05 f8 00 00 ff ff ff ff ff
+#          ^  ^  ^  ^  ^  ^  ^  ^  ^  ^  ^  ^  
+#
+RAYMARINE_FIXED_SPACES = b' ' * 12
+RAYMARINE_FIXED_LENGTH = 12 * 3
+
+#
+# Is this (bytes) line a Raymarine line with 8 bytes of data?
+#
+def IsFixedWidthLine(line):
+    return (len(line) > RAYMARINE_FIXED_LENGTH + 3 and
+        line[-RAYMARINE_FIXED_LENGTH::3] == RAYMARINE_FIXED_SPACES and
+        line.count(b' ') == 13 and
+        line[0:3] in (b'Rx ', b'Tx '))
+
+#
+# Parse a log line read as bytes, see ParseLogLine.  Raymarine lines 
+# with 8 bytes of data are parsed with a single hex conversion, anything
+# else goes through ParseLogLine.
+#
+def ParseLogBytes(line):
+    if IsFixedWidthLine(line):
+        raw = bytes.fromhex(line[1 - RAYMARINE_FIXED_LENGTH:].decode('ascii'))
+        return (int.from_bytes(raw[0:4], 'big'), raw[4:], int(line[3:-RAYMARINE_FIXED_LENGTH]) / 1000.0)
+    return ParseLogLine(line.decode('ascii', 'ignore'))
+
+#
+# Read the lines of a log file through mmap, so the file is never copied
+# into Python strings as a whole.
+# returns: a generator of lines (as bytes, without line endings)
+#
+def ReadLogLines(filename):
+    with open(filename, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        with closing(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)) as mm:
+            for line in iter(mm.readline, b''):
+                yield line.rstrip()
+
+#
+# Stream the frames from a Raymarine or candump log.  
+# returns: a generator of (can_id, payload, timestamp), ready to pass to
+#   Nmea2000Reader.HandlePacket
+#
+def ReadLogFile(filename):
+    for line in ReadLogLines(filename):
+        parsed = ParseLogBytes(line)
+        if parsed is not None:
+            yield parsed
+
+#
+# Get just the source address from a log line (as bytes), without 
+# parsing the data
+# returns: the source address or None for a blank line
+#
+def LineSourceAddress(line):
+    if IsFixedWidthLine(line):
+        return int(line[-26:-24], 16)
+    words = line.split()
+    if not words:
+        return None
+    if words[0] == b"Rx" or words[0] == b"Tx":
+        return int(words[5], 16)
+    return int(words[1], 16) & 0xff
+
+#
+# Read the lines of several logs, see ReadLogLines
+#
+def ReadLogFiles(filenames):
+    for filename in filenames:
+        for line in ReadLogLines(filename):
+            yield line
+
+#
+# Consumer used by the shard workers.  It formats records the same way as
+# PgnPrinter and tags them with the index of the log line that completed
+# them.
+#
+class ShardCollector(PgnConsumer):
+    def __init__(self):
+        self.__printer = PgnPrinter()
+        self.index = 0
+        self.output = []
+
+    def ConsumePgn(self, pgn, dataRecord, pgnRecord):
+        self.output.append((self.index, self.__printer.Format(pgn, dataRecord, pgnRecord)))
+
+#
+# Worker process for ParseLogParallel.  Reassembly state is per source
+# address, so each worker owns a set of sources and keeps its own
+# Nmea2000Reader for the life of the parse.
+#
+# inputQueue -- receives (batch, [(index, line as bytes)]), or None to exit
+# outputQueue -- gets (batch, [(index, text)]) for each batch.  If the
+#   worker fails it sends (None, traceback text) and exits.
+#
+def ShardWorker(inputQueue, outputQueue):
+    try:
+        collector = ShardCollector()
+        reader = Nmea2000Reader([collector])
+        while True:
+            work = inputQueue.get()
+            if work is None:
+                break
+            (batch, lines) = work
+            for (index, line) in lines:
+                parsed = ParseLogBytes(line)
+                if parsed is None:
+                    continue
+                (identifier, data, timestamp) = parsed
+                collector.index = index
+                reader.HandlePacket(identifier, data, timestamp)
+            outputQueue.put((batch, collector.output))
+            collector.output = []
+    except BaseException:
+        # this includes the exit() in parseOut
+        outputQueue.put((None, traceback.format_exc()))
+
+# how often (in seconds) to check that the workers are still running while
+# waiting for them
+WORKER_POLL_INTERVAL = 1.0
+
+#
+# Parse logs using a pool of processes.  Lines are sharded by source
+# address, with each new source going to the least loaded worker.  The
+# output is merged back into log order, so it is identical to running
+# every line through a single Nmea2000Reader and PgnPrinter.
+#
+# The logs are read in batches of batchSize lines so memory use doesn't
+# grow with the size of the log.
+#
+# filenames -- the logs to parse, in order
+# processes -- number of worker processes, default is one per CPU
+# returns: a generator of PgnPrinter output strings, in log order
+#
+def ParseLogParallel(filenames, processes=None, batchSize=50000):
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+
+    outputQueue = multiprocessing.Queue()
+    inputQueues = []
+    workers = []
+    for i in range(processes):
+        inputQueues.append(multiprocessing.Queue(2))
+        worker = multiprocessing.Process(target=ShardWorker, args=(inputQueues[i], outputQueue))
+        worker.daemon = True
+        worker.start()
+        workers.append(worker)
+
+    sources = {}
+    load = [0] * processes
+    results = {}
+
+    #
+    # wait for every worker to finish a batch and return the merged
+    # output
+    #
+    def collect(batch):
+        while len(results.get(batch, [])) < processes:
+            try:
+                (b, output) = outputQueue.get(timeout=WORKER_POLL_INTERVAL)
+            except queue.Empty:
+                checkWorkers()
+                continue
+            if b is None:
+                raise RuntimeError("shard worker failed:\n%s" % output)
+            results.setdefault(b, []).append(output)
+        return heapq.merge(*results.pop(batch))
+
+    #
+    # give a batch to a worker without waiting forever on one that died
+    #
+    def send(i, work):
+        while True:
+            try:
+                inputQueues[i].put(work, timeout=WORKER_POLL_INTERVAL)
+                return
+            except queue.Full:
+                checkWorkers()
+
+    def checkWorkers():
+        for (i, worker) in enumerate(workers):
+            if not worker.is_alive():
+                # a worker that failed sends its traceback before exiting
+                while True:
+                    try:
+                        (b, output) = outputQueue.get(timeout=0.1)
+                    except queue.Empty:
+                        break
+                    if b is None:
+                        raise RuntimeError("shard worker failed:\n%s" % output)
+                    results.setdefault(b, []).append(output)
+                raise RuntimeError("shard worker %i exited with code %s" % (i, worker.exitcode))
+
+    try:
+        batch = 0
+        index = 0
+        shards = [[] for i in range(processes)]
+        lineCount = 0
+        for line in ReadLogFiles(filenames):
+            source = LineSourceAddress(line)
+            if source is not None:
+                if source not in sources:
+                    sources[source] = load.index(min(load))
+                shard = sources[source]
+                shards[shard].append((index, line))
+                load[shard] += 1
+            index += 1
+            lineCount += 1
+
+            if lineCount == batchSize:
+                for i in range(processes):
+                    send(i, (batch, shards[i]))
+                # keep one batch in flight while we print the last one
+                if batch > 0:
+                    for (i, text) in collect(batch - 1):
+                        yield text
+                batch += 1
+                shards = [[] for i in range(processes)]
+                lineCount = 0
+
+        for i in range(processes):
+            send(i, (batch, shards[i]))
+        if batch > 0:
+            for (i, text) in collect(batch - 1):
+                yield text
+        for (i, text) in collect(batch):
+            yield text
+    finally:
+        # don't wait on queues that a dead (or stuck) worker will never read
+        for q in inputQueues:
+            try:
+                q.put_nowait(None)
+            except queue.Full:
+                pass
+            q.cancel_join_thread()
+        outputQueue.cancel_join_thread()
+        for worker in workers:
+            worker.join(WORKER_POLL_INTERVAL)
+            if worker.is_alive():
+                worker.terminate()
+                worker.join()
@@ -1,151 +1,492 @@
 #!/usr/bin/python
 
+import asyncio
 import threading
 import socket
-#import Queue
-import time
-from pprint import pprint
-from select import select
 
 #
-# This is the network base for a server that broadcasts the same data to
-# all clients and doesn't accept input from the clients.
+# All of the servers share one asyncio event loop, which runs on its own
+# thread.  It is created the first time that it is needed.
 #
-class BroadcastServer(object):
-    # worker thread
-    __thread = None
+__eventLoop = None
+__eventLoopLock = threading.Lock()
+
+def GetEventLoop():
+    global __eventLoop
+    with __eventLoopLock:
+        if __eventLoop is None:
+            __eventLoop = asyncio.new_event_loop()
+            thread = threading.Thread(target=__eventLoop.run_forever)
+            thread.daemon = True
+            thread.start()
+        return __eventLoop
+
+#
+# What to do with a client that isn't reading its data fast enough to
+# stay within the last maxBuffer bytes of output
+#
+# OVERFLOW_DROP_OLDEST -- skip the client ahead to the oldest output that
+#   is still buffered
+# OVERFLOW_DISCONNECT -- close the connection
+#
+OVERFLOW_DROP_OLDEST = 0
+OVERFLOW_DISCONNECT = 1
+
+# the most buffers to pass to one sendmsg call
+MAX_SEND_BUFFERS = 64
+
+#
+# The recent output of a server, shared by all of its clients.  Each
+# output is encoded once and stored as an immutable bytes object.  Outputs
+# are numbered with a sequence number, and clients keep track of the next
+# sequence number that they need to send.
+#
+# The ring holds at most maxBytes of output (but always the newest output)
+# and at most maxEntries outputs.
+#
+class BroadcastRing(object):
+    def __init__(self, maxBytes, maxEntries=1024):
+        # round up to a power of two so a sequence number can be masked
+        # into a slot
+        size = 1
+        while size < maxEntries:
+            size <<= 1
+        self.__mask = size - 1
+        self.__slots = [None] * size
+        self.__tags = [None] * size
+        self.__maxBytes = maxBytes
+        self.__bytes = 0
+        # sequence number of the oldest output in the ring
+        self.First = 0
+        # sequence number of the next output to be added
+        self.Next = 0
+
+    def __len__(self):
+        return self.Next - self.First
+
+    # The number of bytes in the ring
+    @property
+    def Bytes(self):
+        return self.__bytes
+
+    #
+    # Add an output and throw out old outputs to stay within the limits
+    #
+    # data -- the output, as bytes
+    # tag -- clients with a filter only get outputs with a tag in their
+    #   filter.  Outputs without a tag go to everyone.
+    #
+    def Append(self, data, tag=None):
+        if self.Next - self.First > self.__mask:
+            self.__evict()
+        self.__slots[self.Next & self.__mask] = data
+        self.__tags[self.Next & self.__mask] = tag
+        self.__bytes += len(data)
+        self.Next += 1
+        while self.__bytes > self.__maxBytes and self.Next - self.First > 1:
+            self.__evict()
+
+    #
+    # Get up to count outputs starting at sequence number
+    #
+    # tags -- only return outputs with one of these tags (or no tag), None
+    #   for all outputs
+    # returns: (buffers, sequences, end)
+    #   buffers -- the outputs
+    #   sequences -- the sequence number of each output
+    #   end -- the sequence number after the last output looked at
+    #
+    def Get(self, sequence, count, tags=None):
+        if tags is None:
+            end = min(sequence + count, self.Next)
+            sequences = range(sequence, end)
+            return ([self.__slots[s & self.__mask] for s in sequences], sequences, end)
 
-    # the list of open client sockets
-    __sockets = []
+        buffers = []
+        sequences = []
+        end = sequence
+        while end < self.Next and len(buffers) < count:
+            tag = self.__tags[end & self.__mask]
+            if tag is None or tag in tags:
+                buffers.append(self.__slots[end & self.__mask])
+                sequences.append(end)
+            end += 1
+        return (buffers, sequences, end)
 
-    # the socket that we listen for new connections on
-    __listen = None
+    def __evict(self):
+        slot = self.First & self.__mask
+        self.__bytes -= len(self.__slots[slot])
+        self.__slots[slot] = None
+        self.__tags[slot] = None
+        self.First += 1
 
-    # output queues for each socket.  The queue is deleted when the 
-    # last send has completed.  If the queue doesn't exist for a socket
-    # then the send can take place immediately.
-    # socket: [ data ]
-    __writeQueue = {}
+#
+# The state for one connected client.  This is just a position in the
+# server's BroadcastRing, so memory use doesn't grow with the number of
+# clients.
+#
+class BroadcastClient(object):
+    def __init__(self, sock, address, sequence):
+        self.socket = sock
+        self.address = address
+        # the next output in the ring to send
+        self.sequence = sequence
+        # the unsent part of an output that was partly sent, or None
+        self.pending = None
+        # the set of output tags this client wants, None for everything
+        self.tags = None
+        # partial command line from the client
+        self.input = b''
+        # are we waiting for the socket to be writable?
+        self.waiting = False
+        self.tasks = []
+        # number of outputs thrown away because the client fell behind
+        self.dropped = 0
 
+#
+# This is the network base for a server that broadcasts the same data to
+# all clients.  The only input accepted from clients is command lines,
+# which are passed to fnCommand.
+#
+# Output is encoded once into a BroadcastRing of maxBuffer bytes, and is
+# sent to each client with vectored sends straight from the ring.  A
+# client that falls more than the ring behind is handled with the overflow
+# policy, so it never holds up the other clients.
+#
+# Output can come from the data function every interval, or be pushed
+# from any thread with Send().  When output is pushed faster than the
+# event loop can send it, it is sent in batches.
+#
+class BroadcastServer(object):
     #
     # Initialize a new server, listening to all bound IP addresses on the
     # assigned port
     #
     # port -- the TCP/IP port to bind to
     # interval -- How often we should run the function that gathers data
-    # fn -- The data function to run.  The return value is a string to 
+    # fn -- The data function to run.  The return value is a string to
     #   send to all clients.
     # fnConnect -- Called whenever a client connects or disconnects
+    # maxBuffer -- the most output (in bytes) to buffer for slow clients
+    # overflow -- OVERFLOW_DROP_OLDEST or OVERFLOW_DISCONNECT
+    # loop -- the event loop to run on, default is GetEventLoop()
+    # fnCommand -- Called with (server, client, line) for each line of
+    #   input from a client
+    # maxEntries -- the most outputs to buffer for slow clients
+    # maxPending -- the most outputs from Send() to hold while waiting for
+    #   the event loop.  The oldest are thrown away past this.
+    #
+    # interval and fn can be None if all output comes from Send()
     #
-    def __init__(self, port, interval, fn, fnConnect):
-        self.__fn = fn;
-        self.__fnConnect = fnConnect;
-        self.__interval = interval;
+    # fn, fnConnect and fnCommand are called on the event loop thread
+    #
+    def __init__(self, port, interval, fn, fnConnect, maxBuffer=65536, overflow=OVERFLOW_DROP_OLDEST, loop=None, fnCommand=None, maxEntries=1024, maxPending=1024):
+        self.__fn = fn
+        self.__fnConnect = fnConnect
+        self.__fnCommand = fnCommand
+        self.__interval = interval
+        self.__overflow = overflow
+        self.__loop = loop or GetEventLoop()
+        self.__ring = BroadcastRing(maxBuffer, maxEntries)
+
+        # the most output to add to the ring before sending it, so that a
+        # burst bigger than the ring doesn't run past clients that are
+        # keeping up.  See __flush_pending.
+        self.__batchBytes = max(1, maxBuffer // 2)
+        self.__batchEntries = max(1, maxEntries // 2)
+
+        # the list of connected clients
+        self.__clients = []
+        self.__tasks = []
+
+        # the tags that any client wants, None if some client wants
+        # everything.  See Wants().
+        self.__wanted = set()
+
+        # output from Send() that hasn't been added to the ring yet:
+        # [ (data, tag) ]
+        self.__pendingLock = threading.Lock()
+        self.__pending = []
+        self.__maxPending = maxPending
+        self.__pendingDropped = 0
 
         # create and bind the socket that we use to accept new incoming
-        # connections
+        # connections.  This is done here so that errors are reported to
+        # the caller.
         self.__listen = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.__listen.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.__listen.bind(('', port))
         self.__listen.listen(5)
-        self.__sockets.append(self.__listen)
-
-        # create the thread that handles all IO
-        self.__thread = threading.Thread(target=self.__thread_loop)
-        self.__thread.daemon = True
-        self.__thread.start()
-
-    #
-    # This is the core worker thread for the server.  It listens for 
-    # incoming data on __consumeRd and sends that data to all attached
-    # clients.  It also accepts new clients.
-    #
-    def __thread_loop(self):
-        lastsend = time.process_time()
-        while (True):
-            timeout = max(self.__interval - (time.process_time() - lastsend), 0)
-            readable, writable, exceptional = select(
-                self.__sockets, 
-                self.__writeQueue.keys(), 
-                self.__sockets, 
-                timeout)
-
-            # if we haven't send output since the last interval then send it
-            # now.  
-            if time.process_time() > lastsend + self.__interval:
-                lastsend = time.process_time()
-                # don't send output if no one is connected
-                if len(self.__sockets) > 1:
-                    output = self.__fn()
-                    for outputSocket in self.__sockets:
-                        if outputSocket != self.__listen:
-                            self.__send_internal(outputSocket, output)
-
-            # there is incoming data on the socket, a new incoming connection,
-            # or a dropped connection
-            for s in readable:
-                if s is self.__listen:
-                    connection, client_address = self.__listen.accept()
-                    connection.setblocking(0)
-                    self.__sockets.append(connection)
-                    if self.__fnConnect != None:
-                        self.__fnConnect(len(self.__sockets) - 1)
-
-                else:
-                    try:
-                        # listen and throw out data, we only publish
-                        data = s.recv(1024)
-                    except:
-                        # on Windows we get an exception on connection 
-                        # drop
-                        data = 0
-
-                    if data == 0:
-                        # connection dropped
-                        self.__cleanup_socket(s)
-
-                    # we throw out all other input
-
-
-            # a write has completed
-            for s in writable:
-                if self.__writeQueue[s].empty():
-                    # we sent out the last item in the queue, delete it
-                    del self.__writeQueue[s]
-                else:
-                    # get the next item to send
-                    data = self.__writeQueue[s].get_nowait()
-                    try:
-                        s.send(data)
-                    except:
-                        self.__cleanup_socket(s)
-
-            # socket closed
-            for s in exceptional:
-                self.__cleanup_socket(s)
-
-    #
-    # internal function that cleans up all outstanding state for a socket
-    #
-    def __cleanup_socket(self, s):
-        s.close()
-        self.__sockets.remove(s)
-        if self.__fnConnect != None:
-            self.__fnConnect(len(self.__sockets) - 1)
-        if s in self.__writeQueue:
-            del self.__writeQueue[s]
+        self.__listen.setblocking(False)
+
+        asyncio.run_coroutine_threadsafe(self.__start(), self.__loop).result()
+
+    # The number of connected clients
+    @property
+    def ClientCount(self):
+        return len(self.__clients)
+
+    # The number of outputs thrown away for slow clients
+    @property
+    def Dropped(self):
+        return self.__pendingDropped + sum(c.dropped for c in self.__clients)
+
+    #
+    # Does any client want output with this tag?  This can be called
+    # from any thread, and is meant to let the caller skip building output
+    # that no one will get.
+    #
+    def Wants(self, tag=None):
+        wanted = self.__wanted
+        return wanted is None or tag is None and len(wanted) > 0 or tag in wanted
+
+    #
+    # Send output to all clients as soon as possible.  This can be called
+    # from any thread.
+    #
+    # output -- a string or bytes
+    # tag -- only clients that want this tag get the output, see
+    #   SetTags.  None goes to all clients.
+    #
+    def Send(self, output, tag=None):
+        if isinstance(output, str):
+            output = output.encode('utf-8')
+        with self.__pendingLock:
+            self.__pending.append((output, tag))
+            if len(self.__pending) > self.__maxPending:
+                del self.__pending[0]
+                self.__pendingDropped += 1
+            if len(self.__pending) > 1:
+                # a flush is already scheduled, it'll pick this up
+                return
+        self.__loop.call_soon_threadsafe(self.__flush_pending)
+
+    #
+    # Set the tags that a client wants, None for everything.  Called on
+    # the event loop thread (usually from fnCommand).
+    #
+    def SetTags(self, client, tags):
+        client.tags = None if tags is None else set(tags)
+        self.__update_wanted()
+
+    def __update_wanted(self):
+        wanted = set()
+        for client in self.__clients:
+            if client.tags is None:
+                wanted = None
+                break
+            wanted.update(client.tags)
+        self.__wanted = wanted
+
+    #
+    # Stop the server and disconnect all clients
+    #
+    def Close(self):
+        asyncio.run_coroutine_threadsafe(self.__close(), self.__loop).result()
+
+    async def __start(self):
+        self.__tasks.append(self.__loop.create_task(self.__accept_loop()))
+        if self.__fn is not None and self.__interval is not None:
+            self.__tasks.append(self.__loop.create_task(self.__interval_loop()))
+
+    async def __close(self):
+        for task in self.__tasks:
+            task.cancel()
+        await asyncio.gather(*self.__tasks, return_exceptions=True)
+        self.__listen.close()
+        for client in list(self.__clients):
+            self.__cleanup_client(client)
+
+    #
+    # Accept new clients.  They start with the next output.
+    #
+    async def __accept_loop(self):
+        while True:
+            connection, client_address = await self.__loop.sock_accept(self.__listen)
+            connection.setblocking(False)
+            client = BroadcastClient(connection, client_address, self.__ring.Next)
+            client.tasks.append(self.__loop.create_task(self.__read_loop(client)))
+            self.__clients.append(client)
+            self.__update_wanted()
+            if self.__fnConnect != None:
+                self.__fnConnect(len(self.__clients))
+
+    #
+    # Run the data function every interval seconds.  Deadlines are kept
+    # on the (monotonic) wall clock, so a slow data function doesn't
+    # cause the interval to drift.
+    #
+    async def __interval_loop(self):
+        deadline = self.__loop.time()
+        while True:
+            deadline += self.__interval
+            now = self.__loop.time()
+            if deadline < now:
+                # we fell more than an interval behind, don't try to
+                # catch up
+                deadline = now
+            await asyncio.sleep(deadline - now)
+
+            # don't send output if no one is connected
+            if len(self.__clients) > 0:
+                self.__broadcast(self.__fn())
+
+    #
+    # Add output to the ring and send it to all clients
+    #
+    def __broadcast(self, output):
+        if not output:
+            return
+        if isinstance(output, str):
+            output = output.encode('utf-8')
+        self.__ring.Append(output)
+        self.__send_all()
 
     #
-    # Send data to one of the associated sockets.  This also maintains
-    # the write queue.
+    # Move everything from Send() into the ring, and send it.  Everything
+    # that came in since the last flush goes out together, unless it is
+    # more than half the ring, then it is sent in parts.
     #
-    def __send_internal(self, outputSocket, data):
-        if outputSocket not in self.__writeQueue:
-            # no output queue, create one and send data
+    def __flush_pending(self):
+        with self.__pendingLock:
+            pending = self.__pending
+            self.__pending = []
+        batchBytes = 0
+        batchEntries = 0
+        for (output, tag) in pending:
+            self.__ring.Append(output, tag)
+            batchBytes += len(output)
+            batchEntries += 1
+            if batchBytes >= self.__batchBytes or batchEntries >= self.__batchEntries:
+                self.__send_all()
+                batchBytes = 0
+                batchEntries = 0
+        if batchEntries > 0:
+            self.__send_all()
+
+    #
+    # Send the new output in the ring to all clients
+    #
+    def __send_all(self):
+        for client in list(self.__clients):
+            if client.sequence < self.__ring.First:
+                # the client has fallen off the end of the ring
+                if self.__overflow == OVERFLOW_DISCONNECT:
+                    self.__cleanup_client(client)
+                    continue
+                client.dropped += self.__ring.First - client.sequence
+                client.sequence = self.__ring.First
+            if not client.waiting:
+                self.__send(client)
+
+    #
+    # Send as much of the client's output as the socket will take.  If
+    # the socket fills up then we wait for it to become writable.
+    #
+    def __send(self, client):
+        while True:
+            (buffers, sequences, end) = self.__ring.Get(client.sequence, MAX_SEND_BUFFERS, client.tags)
+            if client.pending is not None:
+                buffers.insert(0, client.pending)
+            if not buffers:
+                # everything left was filtered out
+                client.sequence = end
+                break
+
             try:
-                outputSocket.send(data)
-                self.__writeQueue[outputSocket] = Queue.Queue()
-            except:
-                outputSocket.close()
-        else:
-            self.__writeQueue[outputSocket].put_nowait(data)
-        
+                sent = client.socket.sendmsg(buffers)
+            except (BlockingIOError, InterruptedError):
+                sent = 0
+            except OSError:
+                self.__cleanup_client(client)
+                return
+
+            # account for what was sent, a partly sent buffer is kept in
+            # pending.  The buffers from the ring are immutable so
+            # a memoryview of them stays valid after they leave the ring.
+            if client.pending is not None:
+                if sent < len(client.pending):
+                    client.pending = client.pending[sent:]
+                    break
+                sent -= len(client.pending)
+                client.pending = None
+                buffers.pop(0)
+            for (b, sequence) in zip(buffers, sequences):
+                if sent < len(b):
+                    if sent > 0:
+                        client.pending = memoryview(b)[sent:]
+                        client.sequence = sequence + 1
+                    break
+                sent -= len(b)
+                client.sequence = sequence + 1
+            else:
+                client.sequence = end
+                continue
+            break
+
+        waiting = client.pending is not None or client.sequence < self.__ring.Next
+        if waiting and not client.waiting:
+            self.__loop.add_writer(client.socket, self.__writable, client)
+        elif client.waiting and not waiting:
+            self.__loop.remove_writer(client.socket)
+        client.waiting = waiting
+
+    #
+    # Called when a client's socket can take more data
+    #
+    def __writable(self, client):
+        if client.sequence < self.__ring.First:
+            # output was thrown away while we were waiting
+            if self.__overflow == OVERFLOW_DISCONNECT:
+                self.__cleanup_client(client)
+                return
+            client.dropped += self.__ring.First - client.sequence
+            client.sequence = self.__ring.First
+        self.__send(client)
+
+    #
+    # Read command lines from a client.  Without fnCommand the input is
+    # thrown out, we only publish.  This also notices when the client
+    # disconnects.
+    #
+    async def __read_loop(self, client):
+        try:
+            while True:
+                data = await self.__loop.sock_recv(client.socket, 1024)
+                if not data:
+                    break
+                if self.__fnCommand is None:
+                    continue
+                lines = (client.input + data).split(b'\n')
+                # don't let a client without line endings use up memory
+                client.input = lines.pop()[-1024:]
+                for line in lines:
+                    self.__fnCommand(self, client, line.decode('ascii', 'ignore').strip())
+        except OSError:
+            pass
+        self.__cleanup_client(client)
+
+    #
+    # internal function that cleans up all outstanding state for a client
+    #
+    def __cleanup_client(self, client):
+        if client not in self.__clients:
+            return
+        self.__clients.remove(client)
+        self.__update_wanted()
+        if client.waiting:
+            self.__loop.remove_writer(client.socket)
+            client.waiting = False
+        self.__loop.create_task(self.__close_client(client))
+        if self.__fnConnect != None:
+            self.__fnConnect(len(self.__clients))
+
+    #
+    # The socket can only be closed once the client's tasks have stopped
+    # waiting on it
+    #
+    async def __close_client(self, client):
+        for task in client.tasks:
+            task.cancel()
+        await asyncio.gather(*client.tasks, return_exceptions=True)
+        client.socket.close()
@@ -1,89 +1,323 @@
 #!/usr/bin/python
 
+import math
 import time
-import quantities
-from lib.network import BroadcastServer
+import threading
+import operator
+from lib.network import BroadcastServer, GetEventLoop
 
 #
-# Dump current state as NMEA 0183 output once per second
+# Unit conversion factors, (input units, output units): factor.  Input
+# units are the units in the PGN definitions, output units are what the
+# NMEA 0183 sentences use.  Converting to the same units is always
+# allowed.
+#
+UNIT_FACTORS = {
+    ('m/s', 'knots'): 3600.0 / 1852.0,
+    ('m/s', 'km/h'): 3.6,
+    ('m', 'ft'): 1.0 / 0.3048,
+    ('m', 'fathoms'): 1.0 / 1.8288,
+    ('rad', 'deg'): 180.0 / math.pi,
+    ('rad/s', 'deg/s'): 180.0 / math.pi,
+    ('rad/s', 'deg/min'): 60.0 * 180.0 / math.pi,
+}
+
+def unitFactor(inputUnits, outputUnits):
+    if inputUnits == outputUnits:
+        return 1.0
+    if (inputUnits, outputUnits) not in UNIT_FACTORS:
+        raise ValueError("can't convert %s to %s" % (inputUnits, outputUnits))
+    return UNIT_FACTORS[(inputUnits, outputUnits)]
+
+#
+# Formatters for values that aren't a single number.  Each is
+# (function, output for an unknown value).  Some of these produce two
+# fields.
+#
+
+# degrees to (degrees, minutes, ten thousandths of a minute).  This is
+# rounded before it is split, so 59.99996 minutes carries into the
+# degrees instead of printing as 60.0000
+def splitDegrees(value):
+    (degrees, minutes) = divmod(int(round(value * 600000.0)), 600000)
+    return (degrees,) + divmod(minutes, 10000)
+
+# latitude in degrees to ddmm.mmmm,N
+def formatLatitude(value):
+    hemisphere = 'N' if value >= 0 else 'S'
+    return "%02i%02i.%04i,%s" % (splitDegrees(abs(value)) + (hemisphere,))
+
+# longitude in degrees to dddmm.mmmm,E
+def formatLongitude(value):
+    hemisphere = 'E' if value >= 0 else 'W'
+    return "%03i%02i.%04i,%s" % (splitDegrees(abs(value)) + (hemisphere,))
+
+# a signed angle in degrees to d.d,E (positive is east)
+def formatEastWest(value):
+    return "%.1f,%s" % (abs(value), 'E' if value >= 0 else 'W')
+
+# seconds since midnight to hhmmss.ss.  Rounded to centiseconds before it
+# is split, like splitDegrees, and midnight wraps to 000000.00
+def formatTime(value):
+    (seconds, centiseconds) = divmod(int(round(value * 100.0)) % 8640000, 100)
+    (minutes, seconds) = divmod(seconds, 60)
+    (hours, minutes) = divmod(minutes, 60)
+    return "%02i%02i%02i.%02i" % (hours, minutes, seconds, centiseconds)
+
+# the status of a value that is known, for the data valid fields.  Use
+# 'valid' for status fields (V when unknown) and 'mode' for mode
+# indicators (N when unknown)
+def formatValid(value):
+    return 'A'
+
+# days since 1970-01-01 to ddmmyy
+def formatDate(value):
+    return time.strftime("%d%m%y", time.gmtime(value * 86400))
+
+FORMATTERS = {
+    'lat': (formatLatitude, ','),
+    'lon': (formatLongitude, ','),
+    'ew': (formatEastWest, ','),
+    'hhmmss': (formatTime, ''),
+    'ddmmyy': (formatDate, ''),
+    'valid': (formatValid, 'V'),
+    'mode': (formatValid, 'N'),
+}
+
+# XOR of all of the characters in a string
+def checksum(s):
+    c = 0
+    for b in s.encode('ascii'):
+        c ^= b
+    return c
+
+#
+# A NMEA 0183 sentence template, compiled so that it can be filled in
+# without parsing it again.  See Nmea0183Server for the template format.
+#
+# segments -- [ literal, (getter, factor, formatter, unknown, unknown
+#   checksum), literal, ... ]
+#   the list always starts and ends with a literal
+# literalChecksum -- the checksum of all of the literal segments
+# variables -- the names of the variables used by the sentence
+# minInterval -- the shortest time between two sends of this sentence
+#
+# lastSent, timer and heartbeat are used by Nmea0183Server to schedule
+# the sentence
+#
+class Nmea0183Sentence(object):
+    #
+    # template -- the sentence template
+    # getVariable -- returns a getter function for a variable name, the
+    #   getter is called with a Nmea2000Snapshot
+    # getUnits -- returns the units of a variable name
+    # maxRate -- the most times per second to send the sentence
+    #
+    def __init__(self, template, getVariable, getUnits, maxRate):
+        self.template = template
+        self.minInterval = 1.0 / maxRate
+        self.lastSent = None
+        self.timer = None
+        self.heartbeat = None
+        self.variables = []
+        self.segments = []
+        end = 0
+        startSub = template.find("{")
+        while startSub != -1:
+            self.segments.append(template[end:startSub])
+
+            # locate and parse the substitution
+            endSub = template.find("}", startSub + 1)
+            parts = template[startSub + 1:endSub].split(",")
+            format = parts[0]
+            variable = parts[1]
+            if variable not in self.variables:
+                self.variables.append(variable)
+            factor = 1.0
+            if len(parts) > 2:
+                factor = unitFactor(getUnits(variable), parts[2])
+
+            if format in FORMATTERS:
+                (formatter, unknown) = FORMATTERS[format]
+            else:
+                formatter = format.__mod__
+                unknown = ''
+            self.segments.append((getVariable(variable), factor, formatter, unknown, checksum(unknown)))
+
+            end = endSub + 1
+            startSub = template.find("{", end)
+        self.segments.append(template[end:])
+
+        self.literalChecksum = 0
+        for segment in self.segments[0::2]:
+            self.literalChecksum ^= checksum(segment)
+
+    #
+    # Fill in the template with values from a Nmea2000Snapshot
+    # returns: the sentence, with the leading $, checksum and line ending
+    #
+    def Format(self, snapshot):
+        segments = self.segments
+        out = [segments[0]]
+        c = self.literalChecksum
+        for i in range(1, len(segments), 2):
+            (getter, factor, formatter, unknown, unknownChecksum) = segments[i]
+            value = getter(snapshot)
+            if value is None:
+                sub = unknown
+                c ^= unknownChecksum
+            else:
+                sub = formatter(value * factor)
+                c ^= checksum(sub)
+            out.append(sub)
+            out.append(segments[i + 1])
+        return "$%s*%02x\r\n" % (''.join(out), c)
+
+#
+# Send the current state as NMEA 0183 sentences.
+#
+# Each sentence is sent when one of its variables changes in
+# Nmea2000State, but no more than maxRate times a second.  Sentences are
+# also sent every heartbeat seconds when nothing has changed, so that
+# instruments know that the data is still good.
+#
+# state -- the Nmea2000State to send
+# maxRate -- default for the most times per second to send a sentence
+# heartbeat -- how often to send sentences that haven't changed (seconds)
+# loop -- the asyncio event loop for the server, default is the loop
+#   shared by all servers (see lib.network.GetEventLoop)
 #
 class Nmea0183Server(object):
-    def __init__(self, state, port=10110, interval=1):
-        # This list is what defines the output.  Substitution from 
+    def __init__(self, state, port=10110, maxRate=10, heartbeat=1.0, loop=None):
+        # This list is what defines the output.  Substitution from
         # Nmea2000State is done with the following parser:
         # {format,variable,units}
-        # * variable is the variable name in Nmea2000State
-        # * format is a python format string
+        # * variable is the variable name in Nmea2000State (including the
+        #   derived channels, such as TrueWindDirection)
+        # * format is a python format string, or one of the names in
+        #   FORMATTERS
         # * units is output units to use, this is translated from the
-        #   units used in the state map
-        # The leading $ and checksum is added to the output
+        #   units used in the state map using UNIT_FACTORS
+        # The leading $ and checksum is added to the output.  Unknown
+        # values are left empty.
+        #
+        # An entry can also be (template, maxRate) to send that sentence
+        # at a different rate than the default.
         self.__output = [
                 'SDDPT,{%.1f,Depth,m},{%.1f,DepthOffset,m}',
                 'VWVHW,,,,,{%0.1f,SpeedThroughWater,knots},N,{%0.1f,SpeedThroughWater,km/h},K',
                 'IIMWV,{%.1f,WindAngle,deg},R,{%.1f,WindSpeed,knots},N,A',
+                'HCHDG,{%.1f,Heading,deg},{ew,Deviation,deg},{ew,Variation,deg}',
+                'GPRMC,{hhmmss,Time},{valid,Latitude},{lat,Latitude},{lon,Longitude},{%.1f,SOG,knots},{%.1f,COG,deg},{ddmmyy,Date},{ew,Variation,deg},{mode,Latitude}',
+                'GPVTG,{%.1f,COG,deg},T,,M,{%.1f,SOG,knots},N,{%.1f,SOG,km/h},K,A',
+                'WIMWD,{%.1f,TrueWindDirection,deg},T,{%.1f,MagneticWindDirection,deg},M,{%.1f,TrueWindSpeed,knots},N,{%.1f,TrueWindSpeed,m/s},M',
             ]
 
-        self.__server = BroadcastServer(port, interval, self.__Transmit, self.__Connect)
-
         self.__state = state
         self.__clientCount = 0
+        self.__heartbeat = heartbeat
+        self.__loop = loop or GetEventLoop()
+
+        self.__sentences = []
+        for s in self.__output:
+            if isinstance(s, tuple):
+                (s, rate) = s
+            else:
+                rate = maxRate
+            self.__sentences.append(Nmea0183Sentence(s, self.__GetVariable, self.__GetUnits, rate))
+
+        # state variable: [ sentences that use it ]
+        self.__sentencesFor = {}
+        for sentence in self.__sentences:
+            for variable in sentence.variables:
+                users = self.__sentencesFor.setdefault(variable, [])
+                if sentence not in users:
+                    users.append(sentence)
+
+        # sentences with changes that haven't been handled by the event
+        # loop yet
+        self.__changedLock = threading.Lock()
+        self.__changed = set()
+
+        self.__server = BroadcastServer(port, None, None, self.__Connect, loop=self.__loop)
+        state.Subscribe(self.__StateChanged)
+
+    #
+    # Get a function that returns the value of a variable from a 
+    # Nmea2000Snapshot
+    #
+    def __GetVariable(self, variable):
+        return operator.itemgetter(variable)
 
-    # 
+    def __GetUnits(self, variable):
+        return self.__state.GetUnits(variable)
+
+    #
     # __Connect is called by BroadcastServer whenever the number of connected
-    # clients has changed
+    # clients has changed.  When the first client connects every sentence
+    # is sent, which also starts the heartbeats.
     #
     def __Connect(self, clientCount):
+        first = self.__clientCount == 0 and clientCount > 0
         self.__clientCount = clientCount
+        if first:
+            for sentence in self.__sentences:
+                self.__Changed(sentence)
 
     #
-    # This is the periodic timer function which dumps all state through
-    # the NMEA 0183 list defined above
+    # Called by Nmea2000State (on the decoding thread) when variables
+    # change.  The sentences that use them are handed to the event loop,
+    # changes that come in before the loop gets to them are merged.
     #
-    def __Transmit(self):
-        output = ""
-
+    def __StateChanged(self, sequence, names):
         # don't do anything if there is no one to talk to
         if self.__clientCount == 0:
-            return output
-
-        for nmeastr in self.__output:
-            # do variable substitution on the nmea0183 string
-            startSub = nmeastr.find("{")
-            while (startSub != -1):
-                # locate and parse the substitution
-                endSub = nmeastr.find("}", startSub + 1)
-                lookup = nmeastr[startSub + 1:endSub]
-                parts = lookup.split(",")
-                format = parts[0]
-                variable = parts[1]
-                outputUnits = None
-                if len(parts) > 2:
-                    outputUnits = parts[2]
-                value = self.__state[variable]
-
-                # do unit conversion if necessary
-                if (outputUnits != None):
-                    inputUnits = self.__state.GetUnits(variable)
-                    v = quantities.Quantity(value, inputUnits)
-                    value = v.rescale(outputUnits)
-
-                # build the resulting output using our value and format
-                sub = format % value
-
-                # do the substitution
-                nmeastr = nmeastr[0:startSub] + sub + nmeastr[endSub + 1:]
-
-                # locate the next substitution
-                startSub = nmeastr.find("{")
-
-            # compute the checksum
-            checksum = 0
-            for c in str(nmeastr):
-                checksum ^= ord(c)
-
-            # compose the final string
-            nmeastr = "$%s*%02x\r\n" % (nmeastr, checksum)
-            output += nmeastr;
-
-        return output
+            return
+
+        with self.__changedLock:
+            schedule = len(self.__changed) == 0
+            for name in names:
+                self.__changed.update(self.__sentencesFor.get(name, ()))
+            if not self.__changed:
+                return
+        if schedule:
+            self.__loop.call_soon_threadsafe(self.__HandleChanges)
+
+    def __HandleChanges(self):
+        with self.__changedLock:
+            changed = self.__changed
+            self.__changed = set()
+        for sentence in changed:
+            self.__Changed(sentence)
+
+    #
+    # A sentence has new data.  Send it now, or if it was sent too
+    # recently then when its rate allows.
+    #
+    def __Changed(self, sentence):
+        if sentence.timer is not None:
+            # already waiting to send
+            return
+        now = self.__loop.time()
+        if sentence.lastSent is None or now >= sentence.lastSent + sentence.minInterval:
+            self.__Send(sentence)
+        else:
+            sentence.timer = self.__loop.call_at(sentence.lastSent + sentence.minInterval, self.__Send, sentence)
+
+    #
+    # Send a sentence to all clients and restart its heartbeat
+    #
+    def __Send(self, sentence):
+        sentence.timer = None
+        if sentence.heartbeat is not None:
+            sentence.heartbeat.cancel()
+            sentence.heartbeat = None
+
+        # stop sending when there is no one to talk to
+        if self.__clientCount == 0:
+            sentence.lastSent = None
+            return
 
+        sentence.lastSent = self.__loop.time()
+        self.__server.Send(sentence.Format(self.__state.Snapshot()))
+        sentence.heartbeat = self.__loop.call_at(sentence.lastSent + self.__heartbeat, self.__Send, sentence)
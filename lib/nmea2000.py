@@ -9,15 +9,20 @@ import fileinput
 import abc
 import time
 import threading
-import csv
+import collections
+import hashlib
+import os
+import pickle
+import functools
 from abc import ABCMeta
 from io import StringIO
 from pprint import pprint
-# pip install quantities
-import quantities
 
 # local modules
-from lib.RepeatTimer import RepeatTimer
+from lib.scheduler import GetScheduler
+from lib.history import History
+from lib.derived import DERIVED_CHANNELS
+from lib.datalog import DataLogBuffer, DataLogWriter, FSYNC_BLOCK
 
 #
 # abstract class for a NMEA 2000 data consumer
@@ -34,6 +39,16 @@ class PgnConsumer(object):
     def ConsumePgn(self, pgn, dataRecord, pgnRecord):
         return
 
+    #
+    # The PGNs that this consumer wants.  Nmea2000Reader won't reassemble
+    # or decode PGNs that no consumer wants.
+    #
+    # returns: None for everything, a list of PGNs, or a dict of PGN to a
+    #   list of source addresses (or None for all sources)
+    #
+    def Subscriptions(self):
+        return None
+
 #
 # Parse NMEA 2000 packets and call a handler will a full packet is received and 
 # decoded
@@ -47,33 +62,265 @@ class Nmea2000Reader:
     #   consumes processed data from the bus
     #
     def __init__(self, consumers):
-        self.__pgnTable = PgnTable()
+        self.__pgnTable = GetPgnTable()
         self.__packetStateTable = {}
-        self.__consumers = consumers
+        self.__consumers = PgnDispatcher(consumers)
+        self.__statistics = FastPacketStatistics()
 
     #
     # HandlePacket is called whenever a new data packet is found on the bus
     #
-    def HandlePacket(self, arbitration_id, data):
-        if arbitration_id.source_address not in self.__packetStateTable:
-            self.__packetStateTable[arbitration_id.source_address] = PacketState(self.__pgnTable, arbitration_id.source_address, self.__consumers)
+    # arbitration_id -- the 29 bit CAN identifier as an integer.  Objects
+    #   with a can_id attribute (j1939.ArbitrationID) also work
+    # timestamp -- time the packet was received in seconds, used to expire
+    #   incomplete fast packets.  Defaults to time.monotonic()
+    #
+    def HandlePacket(self, arbitration_id, data, timestamp=None):
+        if not isinstance(arbitration_id, int):
+            arbitration_id = arbitration_id.can_id
+        canId = DecodeCanId(arbitration_id)
+
+        packetState = self.__packetStateTable.get(canId.source_address)
+        if packetState is None:
+            packetState = PacketState(self.__pgnTable, canId.source_address, self.__consumers, self.__statistics)
+            self.__packetStateTable[canId.source_address] = packetState
+
+        packetState.ProcessPacket(canId, data, timestamp)
+
+    #
+    # Counters for fast packet reassembly across all sources
+    #
+    @property
+    def Statistics(self):
+        return self.__statistics
+
+    #
+    # Call this when a consumer's Subscriptions() have changed
+    #
+    def UpdateSubscriptions(self):
+        self.__consumers.Update()
+
+    #
+    # The PGNs that any consumer wants, see PgnDispatcher.Pgns
+    #
+    def Subscriptions(self):
+        return self.__consumers.Pgns()
+
+#
+# PgnDispatcher finds the consumers for a PGN from a given source, using
+# the consumers' Subscriptions().  Lookups are cached, so this is a single
+# dict lookup per packet.
+#
+class PgnDispatcher(object):
+    #
+    # consumers -- A list of consumers (inherited from PgnConsumer)
+    #
+    def __init__(self, consumers):
+        self.__consumers = consumers
+        self.Update()
+
+    #
+    # Reload the subscriptions from all consumers
+    #
+    def Update(self):
+        subscriptions = []
+        for consumer in self.__consumers:
+            pgns = None
+            if hasattr(consumer, 'Subscriptions'):
+                pgns = consumer.Subscriptions()
+            if pgns is not None and not isinstance(pgns, dict):
+                pgns = dict.fromkeys(pgns)
+            subscriptions.append((consumer, pgns))
+        self.__subscriptions = subscriptions
+        self.__cache = {}
+
+    #
+    # returns: a tuple of consumers that want this PGN from this source
+    #
+    def Lookup(self, pgn, source_address):
+        key = (pgn, source_address)
+        consumers = self.__cache.get(key)
+        if consumers is None:
+            consumers = []
+            for (consumer, pgns) in self.__subscriptions:
+                if pgns is None:
+                    consumers.append(consumer)
+                elif pgn in pgns and (pgns[pgn] is None or source_address in pgns[pgn]):
+                    consumers.append(consumer)
+            consumers = tuple(consumers)
+            self.__cache[key] = consumers
+        return consumers
+
+    #
+    # The PGNs that any consumer wants, for filtering frames before they
+    # get here.
+    # returns: dict of pgn to None (from any source) or a set of source
+    #   addresses, or None if a consumer wants every PGN
+    #
+    def Pgns(self):
+        wanted = {}
+        for (consumer, pgns) in self.__subscriptions:
+            if pgns is None:
+                return None
+            for (pgn, sources) in pgns.items():
+                if sources is None or (pgn in wanted and wanted[pgn] is None):
+                    wanted[pgn] = None
+                else:
+                    wanted[pgn] = wanted.get(pgn, set()) | set(sources)
+        return wanted
+
+#
+# The parts of a 29 bit NMEA 2000 (J1939) CAN identifier
+#
+# can_id -- the raw identifier
+# pgn -- the PGN as an integer
+# priority -- 0 (highest) to 7
+# source_address -- the sender
+# destination_address -- the receiver, 255 for broadcast (PDU2) PGNs
+#
+CanId = collections.namedtuple('CanId', [
+    'can_id', 'pgn', 'priority', 'source_address', 'destination_address'])
+
+#
+# Split a 29 bit CAN identifier into a CanId.  There are only a handful 
+# of identifiers on a bus, so the results are cached.
+#
+@functools.lru_cache(maxsize=4096)
+def DecodeCanId(can_id):
+    pf = (can_id >> 16) & 0xff
+    pgn = (can_id >> 8) & 0x3ffff
+    if pf < 240:
+        # PDU1, the PS field is the destination address
+        destination_address = pgn & 0xff
+        pgn &= 0x3ff00
+    else:
+        # PDU2, the PS field is part of the PGN
+        destination_address = 0xff
+    return CanId(can_id, pgn, (can_id >> 26) & 0x7, can_id & 0xff, destination_address)
+
+#
+# Build a 29 bit CAN identifier, the reverse of DecodeCanId.  The
+# destination is only used for PDU1 PGNs (PF < 240).
+#
+def EncodeCanId(pgn, source_address, priority=6, destination_address=0xff):
+    if ((pgn >> 8) & 0xff) < 240:
+        pgn = (pgn & 0x3ff00) | (destination_address & 0xff)
+    return ((priority & 0x7) << 26) | ((pgn & 0x3ffff) << 8) | (source_address & 0xff)
+
+#
+# Counters kept while reassembling fast packets
+#
+# completed -- messages that were fully reassembled and decoded
+# dropped -- messages thrown away because a frame was repeated, invalid
+#   or there were too many messages in flight
+# expired -- messages thrown away because they weren't completed in time
+#
+class FastPacketStatistics(object):
+    def __init__(self):
+        self.completed = 0
+        self.dropped = 0
+        self.expired = 0
+
+    def __str__(self):
+        return "completed=%i dropped=%i expired=%i" % (self.completed, self.dropped, self.expired)
+
+#
+# Return the PgnTable for jsonFile.  There is one PgnTable per process
+# (per JSON file), which is shared by the reader, state and anything else
+# that needs it.
+#
+__pgnTables = {}
+__pgnTablesLock = threading.Lock()
+
+def GetPgnTable(jsonFile='./pgns.json'):
+    key = os.path.abspath(jsonFile)
+    with __pgnTablesLock:
+        if key not in __pgnTables:
+            __pgnTables[key] = PgnTable(jsonFile)
+        return __pgnTables[key]
 
-        self.__packetStateTable[arbitration_id.source_address].ProcessPacket(arbitration_id, data)
-        
 #
 # PgnTable is a class that represents all of the PGNs and has data to parse them
 # from a NMEA 2000 network. 
 #
 # The table is loaded from pgns.json and more or less matches it's format
 #
+# Loading and fixing up pgns.json is slow, so the fixed up table is saved
+# next to it in cacheFile (pgns.json.cache by default).  The cache is
+# keyed on the SHA1 of the JSON file, with the mtime and size used as a 
+# quick check to avoid hashing on every start.
+#
 class PgnTable:
+    # bump this whenever fixupPgnTable changes what it produces
+    CACHE_VERSION = 1
+
     # initialize the PGN table by loading the JSON structure from disk
-    def __init__(self, jsonFile='./pgns.json'):
-        with open(jsonFile, 'r') as json_data:
-            self.__pgnTable = json.load(json_data)
-            self.__pgnTable = self.__pgnTable['PGNs']
-        self.fixupPgnTable()
-        #self.applyCorrections()
+    def __init__(self, jsonFile='./pgns.json', cacheFile=None):
+        if cacheFile is None:
+            cacheFile = jsonFile + '.cache'
+        self.__cacheHash = None
+
+        if not self.loadCache(jsonFile, cacheFile):
+            with open(jsonFile, 'r') as json_data:
+                self.__pgnTable = json.load(json_data)
+                self.__pgnTable = self.__pgnTable['PGNs']
+            self.fixupPgnTable()
+            #self.applyCorrections()
+            self.saveCache(jsonFile, cacheFile)
+        self.compileDecodePlans()
+
+    #
+    # Load the fixed up table from cacheFile if it matches jsonFile
+    # returns: True if the table was loaded
+    #
+    def loadCache(self, jsonFile, cacheFile):
+        try:
+            with open(cacheFile, 'rb') as f:
+                cache = pickle.load(f)
+            if cache['version'] != self.CACHE_VERSION:
+                return False
+
+            st = os.stat(jsonFile)
+            touched = cache['mtime'] != st.st_mtime or cache['size'] != st.st_size
+            # the file was touched, check if the contents changed
+            if touched and cache['hash'] != self.hashFile(jsonFile):
+                return False
+
+            self.__cacheHash = cache['hash']
+            self.__pgnTable = cache['pgnTable']
+            if touched:
+                # update the cache with the new mtime
+                self.saveCache(jsonFile, cacheFile)
+            return True
+        except (IOError, OSError, EOFError, KeyError, TypeError, pickle.UnpicklingError):
+            return False
+
+    #
+    # Save the fixed up table to cacheFile.  Failing to write the cache 
+    # (for instance on a read only filesystem) isn't an error.
+    #
+    def saveCache(self, jsonFile, cacheFile):
+        try:
+            st = os.stat(jsonFile)
+            cache = {
+                'version': self.CACHE_VERSION,
+                'mtime': st.st_mtime,
+                'size': st.st_size,
+                'hash': self.__cacheHash or self.hashFile(jsonFile),
+                'pgnTable': self.__pgnTable,
+            }
+            # write to a temporary file and rename so that a power cut
+            # can't leave a partial cache behind
+            tmpFile = '%s.%i.tmp' % (cacheFile, os.getpid())
+            with open(tmpFile, 'wb') as f:
+                pickle.dump(cache, f, pickle.HIGHEST_PROTOCOL)
+            os.replace(tmpFile, cacheFile)
+        except (IOError, OSError):
+            pass
+
+    def hashFile(self, filename):
+        with open(filename, 'rb') as f:
+            return hashlib.sha1(f.read()).hexdigest()
 
     # Get a single value from the table
     def __getitem__(self, key):
@@ -83,6 +330,10 @@ class PgnTable:
     def __contains__(self, key):
         return key in self.__pgnTable
 
+    # Get the compiled PgnDecodePlan for a PGN, or None if it isn't known
+    def GetDecodePlan(self, pgn):
+        return self.__decodePlans.get(pgn)
+
     @property
     def Nmea0183Table(self):
         return self.__nmea0183map
@@ -96,7 +347,6 @@ class PgnTable:
         pgnDict = {}
         for pgnRecord in self.__pgnTable:
             pgnId = pgnRecord["PGN"]
-            print(pgnId)
             pgnDict[pgnId] = pgnRecord
         self.__pgnTable = pgnDict
 
@@ -132,252 +382,727 @@ class PgnTable:
             if f['Name'] == fieldName:
                 f[fieldParam] = newValue
 
+    #
+    # Compile every PGN into a PgnDecodePlan.  This does all of the work
+    # that decode() would otherwise repeat for every frame: walking the
+    # field list, tracking bit offsets, working out byte counts, struct
+    # formats, masks, unknown value sentinels, resolutions and lookup
+    # tables.
+    #
+    # This must be run after fixupPgnTable() and any corrections.
+    #
+    def compileDecodePlans(self):
+        self.__decodePlans = {}
+        for pgn in self.__pgnTable:
+            self.__decodePlans[pgn] = self.compileDecodePlan(self.__pgnTable[pgn])
+
+    def compileDecodePlan(self, pgnRecord):
+        fields = []
+
+        # this mirrors the offset tracking that decode has always done,
+        # including how variable length fields are chained together
+        bitOffset = 0
+        bitLength = 0
+
+        for f in pgnRecord.get('Fields', []):
+            name = f['Name']
+            if 'BitOffset' in f and 'BitLength' in f:
+                bitOffset = f['BitOffset']
+                bitLength = f['BitLength']
+            elif 'BitLengthVariable' in f and f['BitLengthVariable']:
+                bitOffset += bitLength
+                bitLength = -1
+            signed = f.get('Signed', False)
+
+            # skip reserved blocks
+            if name == None or name == 'Reserved' or name == 'SID':
+                continue
+
+            dataType = f.get('Type')
+            fieldLength = bitLength
+            if bitLength == -1:
+                bitLength = 0
+
+            unknownValue = (1 << (bitLength)) - 1
+            if f.get('Signed') == True:
+                unknownValue = unknownValue >> 1
+
+            startingByte = int(bitOffset / 8)
+            numBytes = int(fieldLength / 8)
+            if (fieldLength % 8 > 0):
+                numBytes += 1
+
+            # fixed width integers are read with a precompiled struct,
+            # anything else falls back to parseOut
+            unpack = None
+            kind = FIELD_GENERIC
+            if fieldLength != -1 and dataType not in ('ASCII text', 'ASCII string starting with length byte'):
+                if numBytes == 3:
+                    # 3 byte numbers are always read as unsigned
+                    unpack = unpackUInt24
+                    kind = FIELD_INTEGER
+                elif numBytes in INTEGER_FORMATS:
+                    unpack = struct.Struct('<' + INTEGER_FORMATS[numBytes][signed]).unpack_from
+                    kind = FIELD_INTEGER
+
+            mask = -1
+            if fieldLength > 0 and (fieldLength % 8 != 0):
+                mask = (1 << fieldLength) - 1
+
+            resolution = None
+            if 'Resolution' in f and f['Resolution'] != 1:
+                resolution = float(f['Resolution'])
+
+            if 'Units' in f and f['Units'] != None:
+                units = f['Units']
+            else:
+                units = ''
+
+            # lookup tables are keyed by the string form of the value,
+            # precompute the integer keys that would match
+            enumValues = None
+            enumMask = 0
+            if f.get('Type', 'scalar') == 'Lookup table' and 'EnumValues' in f:
+                enumValues = {}
+                enumMask = f['EnumMask']
+                for key in f['EnumValues']:
+                    try:
+                        intKey = int(key)
+                    except (TypeError, ValueError):
+                        continue
+                    if str(intKey) == key:
+                        enumValues[intKey] = f['EnumValues'][key]
+
+            fields.append(PgnField(
+                name=name,
+                longName=f['LongName'],
+                rawValueKey=name + ':RawValue',
+                unitsKey=name + ':Units',
+                longNameKey=name + ':LongName',
+                units=units,
+                kind=kind,
+                bitOffset=bitOffset,
+                bitLength=fieldLength,
+                dataType=dataType,
+                signed=signed,
+                startingByte=startingByte,
+                numBytes=numBytes,
+                minLength=int(math.ceil((bitOffset + fieldLength) / 8.0)),
+                unpack=unpack,
+                shift=bitOffset % 8,
+                mask=mask,
+                slot=-1,
+                unknownValue=unknownValue,
+                resolution=resolution,
+                enumMask=enumMask,
+                enumValues=enumValues))
+
+        recordStruct, fields = self.compileRecordStruct(fields)
+
+        # repeated names keep their first position and their last value
+        fieldIndex = {}
+        for i, field in enumerate(fields):
+            fieldIndex[field.name] = i
+        names = tuple(dict.fromkeys(field.name for field in fields))
+        keyIndex = {}
+        for name in names:
+            i = fieldIndex[name]
+            keyIndex[fields[i].rawValueKey] = (i, DataRecord.RAW_VALUE)
+            keyIndex[name] = (i, DataRecord.VALUE)
+            keyIndex[fields[i].unitsKey] = (i, DataRecord.UNITS)
+            keyIndex[fields[i].longNameKey] = (i, DataRecord.LONG_NAME)
+
+        minLength = 0
+        for field in fields:
+            minLength = max(minLength, field.minLength)
+        if recordStruct is not None:
+            minLength = max(minLength, recordStruct.size)
+
+        return PgnDecodePlan(
+            pgnRecord=pgnRecord,
+            fields=tuple(fields),
+            recordStruct=recordStruct,
+            minLength=minLength,
+            fastPacket=pgnRecord.get('Length', 0) > 8,
+            names=names,
+            fieldIndex=fieldIndex,
+            keyIndex=keyIndex)
+
+    #
+    # If every field in a PGN is a byte aligned 1, 2, 4 or 8 byte integer
+    # and none of them overlap then the whole record can be read with a 
+    # single struct.unpack_from call.  Fields that share the same bytes
+    # (bit fields) share a slot in the struct.
+    #
+    # returns: (struct.Struct or None, fields with slot filled in)
+    #
+    def compileRecordStruct(self, fields):
+        if len(fields) == 0:
+            return None, fields
+
+        slots = []
+        for field in fields:
+            if field.kind != FIELD_INTEGER or field.numBytes not in INTEGER_FORMATS:
+                return None, fields
+            slot = (field.startingByte, field.numBytes, field.signed)
+            if slot not in slots:
+                slots.append(slot)
+        slots.sort()
+
+        # make sure that there isn't any overlap between slots
+        fmt = '<'
+        position = 0
+        for (startingByte, numBytes, signed) in slots:
+            if startingByte < position:
+                return None, fields
+            fmt += 'x' * (startingByte - position)
+            fmt += INTEGER_FORMATS[numBytes][signed]
+            position = startingByte + numBytes
+
+        fields = [f._replace(slot=slots.index((f.startingByte, f.numBytes, f.signed))) for f in fields]
+        return struct.Struct(fmt), fields
+
+#
+# struct formats for fixed width integers, by number of bytes and then
+# signed
+#
+INTEGER_FORMATS = {
+    1: { False: 'B', True: 'b' },
+    2: { False: 'H', True: 'h' },
+    4: { False: 'L', True: 'l' },
+    8: { False: 'Q', True: 'q' },
+}
+
+# field kinds for PgnField
+FIELD_INTEGER = 0
+FIELD_GENERIC = 1
+
+#
+# unpack_from style reader for 3 byte numbers, which struct can't do
+#
+def unpackUInt24(b, offset):
+    return (int.from_bytes(b[offset:offset + 3], 'little'),)
+
+#
+# A single field from a PGN, precompiled by PgnTable so that decode
+# doesn't need to look at the JSON field record
+#
+# name, longName, units -- names and units from pgns.json
+# rawValueKey, unitsKey, longNameKey -- the keys used in dataRecord
+# kind -- FIELD_INTEGER to use unpack, FIELD_GENERIC to use parseOut
+# bitOffset, bitLength, dataType, signed -- the raw field layout
+# startingByte, numBytes -- the bytes that hold the field
+# minLength -- the minimum data length, shorter data decodes as 0
+# unpack -- struct unpack_from function for the field
+# shift, mask -- extract the field from the unpacked integer
+# slot -- index of the field in PgnDecodePlan.recordStruct
+# unknownValue -- the value that means the field isn't known
+# resolution -- scale factor for the field, or None
+# enumMask, enumValues -- lookup table mask and values, or None
+#
+PgnField = collections.namedtuple('PgnField', [
+    'name', 'longName', 'rawValueKey', 'unitsKey', 'longNameKey', 'units',
+    'kind', 'bitOffset', 'bitLength', 'dataType', 'signed',
+    'startingByte', 'numBytes', 'minLength', 'unpack', 'shift', 'mask',
+    'slot', 'unknownValue', 'resolution', 'enumMask', 'enumValues'])
+
+#
+# The compiled form of a PGN.  
+#
+# pgnRecord -- the record from pgns.json
+# fields -- tuple of PgnField to decode
+# recordStruct -- struct.Struct that reads every field at once, or None
+# minLength -- data length needed to use recordStruct
+# fastPacket -- True if this PGN is sent as a fast packet
+# names -- the unique field names, in order
+# fieldIndex -- field name to index in fields
+# keyIndex -- DataRecord dict key to (index in fields, part)
+#
+PgnDecodePlan = collections.namedtuple('PgnDecodePlan', [
+    'pgnRecord', 'fields', 'recordStruct', 'minLength', 'fastPacket',
+    'names', 'fieldIndex', 'keyIndex'])
+
+#
+# A single fast packet message that is being reassembled
+#
+# Fast packets are split into up to 32 frames.  The first byte of each 
+# frame holds a 3 bit sequence counter and a 5 bit frame counter.  Frame 0
+# has the total length in the second byte followed by 6 bytes of data, 
+# every other frame has 7 bytes of data.  
+#
+# Each frame is copied straight to its final position in a preallocated
+# buffer through a memoryview, so frames can be received in any order and
+# the reassembled message is never copied.  FastPacket objects are reused
+# by PacketState (see Reset) so the buffer is only allocated once.
+#
+MAX_FAST_PACKET_LENGTH = 6 + 31 * 7
+
+class FastPacket(object):
+    def __init__(self, pgn, sequence, timestamp):
+        self.buffer = bytearray(MAX_FAST_PACKET_LENGTH)
+        self.view = memoryview(self.buffer)
+        self.Reset(pgn, sequence, timestamp)
+
+    # Get ready to reassemble a new message
+    def Reset(self, pgn, sequence, timestamp):
+        self.pgn = pgn
+        self.sequence = sequence
+        self.timestamp = timestamp
+        self.length = -1
+        self.frameCount = 0
+        self.received = 0
+
+    #
+    # Add a frame to the message
+    # returns: False if the frame doesn't belong in this message
+    #
+    def AddFrame(self, frame, data):
+        if self.received & (1 << frame):
+            # we already have this frame, this is a new message
+            return False
+
+        if frame == 0:
+            if len(data) < 2:
+                return False
+            self.length = data[1]
+            self.frameCount = 1 + int(math.ceil(max(self.length - 6, 0) / 7.0))
+            if self.frameCount > 32 or (self.received >> self.frameCount):
+                return False
+            n = min(len(data) - 2, 6)
+            self.view[0:n] = memoryview(data)[2:2 + n]
+        else:
+            if self.frameCount and frame >= self.frameCount:
+                return False
+            offset = 6 + (frame - 1) * 7
+            n = min(len(data) - 1, 7)
+            self.view[offset:offset + n] = memoryview(data)[1:1 + n]
+
+        self.received |= (1 << frame)
+        return True
+
+    # Have all frames been received?
+    def IsComplete(self):
+        return self.frameCount > 0 and self.received == (1 << self.frameCount) - 1
+
+    # The reassembled message.  This is only valid until Reset is called.
+    def Assemble(self):
+        return self.view[0:self.length]
+
 # 
 # PacketState keeps track of the parsing state for multi-packet fields 
 # (NMEA 2000 Fast Packet) for data coming from a given source address.
 #
+# Each in-flight fast packet is kept in a slot keyed by (PGN, sequence
+# counter), so a device can interleave several fast packet PGNs.  There 
+# are at most maxSlots slots, when they are full the oldest is dropped.  
+# Messages that aren't completed within timeout seconds are expired.
+#
 # When a packet is completely received it is send to decode() for processing
 #
 class PacketState:
-    def __init__(self, pgnTable, source_address, consumers):
-        self.__packetsLeft = 0
-        self.__fastPacketSequence = 0
+    def __init__(self, pgnTable, source_address, consumers, statistics=None, maxSlots=8, timeout=1.0):
         self.__pgnTable = pgnTable
         self.__source_address = source_address
-        self.__currentPgn = 0
+        if not isinstance(consumers, PgnDispatcher):
+            consumers = PgnDispatcher(consumers)
         self.__consumers = consumers
+        self.__statistics = statistics if statistics is not None else FastPacketStatistics()
+        self.__maxSlots = maxSlots
+        self.__timeout = timeout
+        self.__slots = {}
+        self.__freePackets = []
 
     def int_to_bytes(self, val, num_bytes):
         num_bytes -= 1
         return [(val & (0xff << (num_bytes-pos)*8)) >> (num_bytes-pos)*8 for pos in range(num_bytes + 1)]
 
-    # arbitration_id: CAN arbitration_id (header)
+    # arbitration_id: CAN arbitration_id (header) as a CanId
     # data: CAN data (8 bytes)
-    def ProcessPacket(self, arbitration_id, data):
-        # break out the fast packet support fields
-        fastPacket = struct.unpack("<H", data[0:2])[0]
-        sequenceCounter = (fastPacket & 0xe000) >> 13
-        frameCounter = (fastPacket & 0x1f00) >> 8
-        length = (fastPacket & 0xff)
-        pgn = arbitration_id.pgn.value
-        prio = arbitration_id.priority
-        source_address = arbitration_id.source_address
-
-        if (self.__packetsLeft > 0) and ((self.__fastPacketSequence != sequenceCounter) or (self.__currentPgn != pgn)):
-            # somehow we lost a sequence, reset our internal state
-            #print("PacketState-%i: lost sequence, expectedpgn = %i, nowpgn = %i fastPacketSequence = %i, sequenceCounter = %i" % (self.__source_address, self.__currentPgn, pgn, self.__fastPacketSequence, sequenceCounter))
-            self.__packetsLeft = 0
-            self.__currentPgn = 0
+    # timestamp: time the packet was received, defaults to now
+    def ProcessPacket(self, arbitration_id, data, timestamp=None):
+        pgn = arbitration_id.pgn
+        plan = self.__pgnTable.GetDecodePlan(pgn)
+        if plan is None:
             return 0
 
-        if (self.__packetsLeft > 0) and (self.__fastPacketSequence == sequenceCounter) and (self.__currentPgn == pgn):
-            # we end up here if we are in the middle of processing a fast packet sequence
-            self.__b.extend(data[1:])
-            self.__packetsLeft -= 1
-
-            # we're at the end of the packet sequence
-            if (self.__packetsLeft == 0):
-                self.decode(pgn, arbitration_id, self.__b)
-        elif (pgn in self.__pgnTable) and (self.__pgnTable[pgn]['Length'] > 8) and length > 6:
-            # new fast-packet pgn
-            extraLength = max(length - 6, 0)
-            self.__packetsLeft = int(math.ceil(extraLength / 7.0))
-            self.__fastPacketSequence = sequenceCounter
-            self.__currentPgn = pgn
-            self.__b = data[2:]
-        else:
+        # don't bother with PGNs that no one wants
+        consumers = self.__consumers.Lookup(pgn, self.__source_address)
+        if not consumers:
+            return 0
+
+        if not plan.fastPacket:
             # short pgn
-            self.decode(pgn, arbitration_id, data)
+            self.decode(pgn, arbitration_id, data, consumers, timestamp)
+            return
 
-    #
-    # parse invidual bits from a NMEA data field
-    # also does endian-fixup.  There is probably a cleaner
-    # way to do this
-    # b -- byte array with the data
-    # bitOffset -- the offset of the data to read
-    # bitLength -- the number of bits to read
-    # type -- The type to decode (pulled from PgnTable)
-    # returns: the value
-    #
-    def parseOut(self, b, bitOffset, bitLength, dataType, signed):
-        # variable length
-        if bitLength == -1:
-            startingByte = int(bitOffset / 8)
-            if startingByte < len(b):
-                print(dataType)
-                print("variable length -- not working yet")
-                print("bitOffset = %i" % bitOffset)
-                data = b[startingByte:]
-                pprint(data)
-                print(len(b))
-                print(startingByte)
-                exit()
-
-        # check for out of bounds
-        if (bitOffset + bitLength > len(b) * 8):
+        if len(data) < 1:
             return 0
 
-        #print("data[%d] = %s" % (len(b), ' '.join('%02x' % x for x in b)))
+        # the record gets the timestamp that we were given, but expiring
+        # fast packets needs a time
+        recordTimestamp = timestamp
+        if timestamp is None:
+            timestamp = time.monotonic()
 
-        startingByte = int(bitOffset / 8)
-        numBytes = int(bitLength / 8)
-        if (bitLength % 8 > 0): 
-            numBytes += 1
-
-        #print("bitOffset = %d %s" % (bitOffset, str(type(bitOffset))))
-        #print("bitLength = %d %s" % (bitLength, str(type(bitLength))))
-        #print("startingByte = %d %s" % (startingByte, str(type(startingByte))))
-        #print("dataType = %s" % dataType)
-        #print("numBytes = %d %s" % (numBytes, str(type(numBytes))))
-
-        data = b[startingByte:startingByte + numBytes]
-
-        #print("data[%d] = %s" % (len(data), ' '.join('%02x' % x for x in data)))
-
-        # unpack depending on the type of length
-        if (dataType == 'ASCII text'):
-            # data is just the ASCII text.  Ignore translation errors
-            v = data.decode('ascii', 'ignore')
-        elif (dataType == 'ASCII string starting with length byte'):
-            # untested! This might work?
-            #length = data[0]
-            #v = ''.join(map(chr, data[1:length]))
-            raise NotImplementedError
-        elif (numBytes == 1) and signed:
-            # single byte signed int
-            v = struct.unpack('<b', data)[0]
-        elif (numBytes == 1) and not signed:
-            # single byte signed int
-            v = struct.unpack('<B', data)[0]
-        elif (numBytes == 2) and signed:
-            # two byte signed int
-            v = struct.unpack('<h', data)[0]
-        elif (numBytes == 2) and not signed:
-            # two byte signed int
-            v = struct.unpack('<H', data)[0]
-        elif (numBytes == 3):
-            # three byte signed int
-            # pad with leading 0 for 3 byte numbers
-            data = data + bytearray(1)
-            if signed:
-                v = struct.unpack('<l', data)[0]
-            else:
-                v = struct.unpack('<L', data)[0]
-        elif (numBytes == 4) and signed:
-            # four byte signed int
-            v = struct.unpack('<l', data)[0]
-        elif (numBytes == 4) and not signed:
-            # four byte signed int
-            v = struct.unpack('<L', data)[0]
-        elif (numBytes == 8) and signed:
-            # eight byte signed int
-            v = struct.unpack('<q', data)[0]
-        elif (numBytes == 8) and not signed:
-            # eight byte signed int
-            v = struct.unpack('<Q', data)[0]
+        # break out the fast packet support fields
+        sequenceCounter = (data[0] & 0xe0) >> 5
+        frameCounter = data[0] & 0x1f
+        key = (pgn, sequenceCounter)
+
+        packet = self.__slots.get(key)
+        if packet is not None and timestamp - packet.timestamp > self.__timeout:
+            self.releaseSlot(key)
+            self.__statistics.expired += 1
+            packet = None
+
+        if packet is None:
+            packet = self.newSlot(key, pgn, sequenceCounter, timestamp)
+
+        if not packet.AddFrame(frameCounter, data):
+            # this frame doesn't fit in the existing message, start over
+            self.releaseSlot(key)
+            self.__statistics.dropped += 1
+            packet = self.newSlot(key, pgn, sequenceCounter, timestamp)
+            if not packet.AddFrame(frameCounter, data):
+                self.releaseSlot(key)
+                self.__statistics.dropped += 1
+                return 0
+
+        # we're at the end of the packet sequence
+        if packet.IsComplete():
+            self.__statistics.completed += 1
+            self.decode(pgn, arbitration_id, packet.Assemble(), consumers, recordTimestamp)
+            self.releaseSlot(key)
+
+    #
+    # Create a new slot for a fast packet, making room if necessary
+    #
+    def newSlot(self, key, pgn, sequenceCounter, timestamp):
+        # expire anything that has been waiting too long
+        for k in [k for k in self.__slots if timestamp - self.__slots[k].timestamp > self.__timeout]:
+            self.releaseSlot(k)
+            self.__statistics.expired += 1
+
+        # drop the oldest if we are out of slots
+        if len(self.__slots) >= self.__maxSlots:
+            oldest = min(self.__slots, key=lambda k: self.__slots[k].timestamp)
+            self.releaseSlot(oldest)
+            self.__statistics.dropped += 1
+
+        if self.__freePackets:
+            packet = self.__freePackets.pop()
+            packet.Reset(pgn, sequenceCounter, timestamp)
         else:
-            # something else that we haven't encountered
-            raise RuntimeError('Unexpected number of bytes %d and dataType %s ' % (numBytes, dataType))
+            packet = FastPacket(pgn, sequenceCounter, timestamp)
+        self.__slots[key] = packet
+        return packet
 
-        # numbers may be contained in less than a byte, this shifts and 
-        # masks as appropriate
-        if isinstance(v, (int)):
-            bitOffsetInByte = bitOffset % 8
-            v = v >> bitOffsetInByte
-            if (bitLength % 8 != 0):
-                v = v & ((1 << bitLength) - 1)
+    #
+    # Remove a slot and keep its FastPacket around for reuse
+    #
+    def releaseSlot(self, key):
+        self.__freePackets.append(self.__slots.pop(key))
 
-        return v
+    def parseOut(self, b, bitOffset, bitLength, dataType, signed):
+        return parseOut(b, bitOffset, bitLength, dataType, signed)
 
     #
     # Use pgnTable (loaded from JSON "pgns.json") to decode a NMEA 2000 record
+    # This runs the PgnDecodePlan that PgnTable compiled for the PGN
     #
     # pgn -- the pgn of the record
     # b -- byte array with the data
+    # consumers -- the consumers to send the record to, by default the 
+    #   ones subscribed to this PGN
+    # timestamp -- the time of the (last frame of the) record, or None
     # returns: human readable string of the record
     #
-    def decode(self, pgn, arbitration_id, b):
-        if pgn not in self.__pgnTable:
+    def decode(self, pgn, arbitration_id, b, consumers=None, timestamp=None):
+        plan = self.__pgnTable.GetDecodePlan(pgn)
+        if plan is None:
             #print("decode failed: pgn=%i" % pgn)
             return 0
-        pgnRecord = self.__pgnTable[pgn]
+        if consumers is None:
+            consumers = self.__consumers.Lookup(pgn, self.__source_address)
+        pgnRecord = plan.pgnRecord
 
-        dataRecord = {}
+        # fields are decoded as the consumers ask for them
+        dataRecord = DataRecord(plan, arbitration_id, b, timestamp)
 
-        dataRecord["nmea2000:pgn"] = arbitration_id.pgn.value
-        dataRecord["nmea2000:priority"] = arbitration_id.priority
-        dataRecord["nmea2000:source_address"] = arbitration_id.source_address
-        dataRecord["nmea2000:destination_address"] = arbitration_id.destination_address
+        for consumer in consumers:
+            consumer.ConsumePgn(pgn, dataRecord, pgnRecord)
 
-        bitOffset = 0
-        bitLength = 0
+        # b may be a reassembly buffer that is about to be reused
+        dataRecord.Detach()
 
-        for f in pgnRecord['Fields']:
-            name = f['Name']
-            if 'BitOffset' in f and 'BitLength' in f:
-                bitOffset = f['BitOffset']
-                bitLength = f['BitLength']
-            elif 'BitLengthVariable' in f and f['BitLengthVariable']:
-                bitOffset += bitLength
-                bitLength = -1
-            signed = f.get('Signed', False)
+#
+# parse invidual bits from a NMEA data field
+# also does endian-fixup.  There is probably a cleaner
+# way to do this
+# b -- byte array (or memoryview) with the data
+# bitOffset -- the offset of the data to read
+# bitLength -- the number of bits to read
+# type -- The type to decode (pulled from PgnTable)
+# returns: the value
+#
+def parseOut(b, bitOffset, bitLength, dataType, signed):
+    # variable length
+    if bitLength == -1:
+        startingByte = int(bitOffset / 8)
+        if startingByte < len(b):
+            print(dataType)
+            print("variable length -- not working yet")
+            print("bitOffset = %i" % bitOffset)
+            data = b[startingByte:]
+            pprint(data)
+            print(len(b))
+            print(startingByte)
+            exit()
+
+    # check for out of bounds
+    if (bitOffset + bitLength > len(b) * 8):
+        return 0
+
+    #print("data[%d] = %s" % (len(b), ' '.join('%02x' % x for x in b)))
+
+    startingByte = int(bitOffset / 8)
+    numBytes = int(bitLength / 8)
+    if (bitLength % 8 > 0): 
+        numBytes += 1
+
+    #print("bitOffset = %d %s" % (bitOffset, str(type(bitOffset))))
+    #print("bitLength = %d %s" % (bitLength, str(type(bitLength))))
+    #print("startingByte = %d %s" % (startingByte, str(type(startingByte))))
+    #print("dataType = %s" % dataType)
+    #print("numBytes = %d %s" % (numBytes, str(type(numBytes))))
+
+    data = bytes(b[startingByte:startingByte + numBytes])
+
+    #print("data[%d] = %s" % (len(data), ' '.join('%02x' % x for x in data)))
+
+    # unpack depending on the type of length
+    if (dataType == 'ASCII text'):
+        # data is just the ASCII text.  Ignore translation errors
+        v = data.decode('ascii', 'ignore')
+    elif (dataType == 'ASCII string starting with length byte'):
+        # untested! This might work?
+        #length = data[0]
+        #v = ''.join(map(chr, data[1:length]))
+        raise NotImplementedError
+    elif (numBytes == 1) and signed:
+        # single byte signed int
+        v = struct.unpack('<b', data)[0]
+    elif (numBytes == 1) and not signed:
+        # single byte signed int
+        v = struct.unpack('<B', data)[0]
+    elif (numBytes == 2) and signed:
+        # two byte signed int
+        v = struct.unpack('<h', data)[0]
+    elif (numBytes == 2) and not signed:
+        # two byte signed int
+        v = struct.unpack('<H', data)[0]
+    elif (numBytes == 3):
+        # three byte signed int
+        # pad with leading 0 for 3 byte numbers
+        data = data + bytearray(1)
+        if signed:
+            v = struct.unpack('<l', data)[0]
+        else:
+            v = struct.unpack('<L', data)[0]
+    elif (numBytes == 4) and signed:
+        # four byte signed int
+        v = struct.unpack('<l', data)[0]
+    elif (numBytes == 4) and not signed:
+        # four byte signed int
+        v = struct.unpack('<L', data)[0]
+    elif (numBytes == 8) and signed:
+        # eight byte signed int
+        v = struct.unpack('<q', data)[0]
+    elif (numBytes == 8) and not signed:
+        # eight byte signed int
+        v = struct.unpack('<Q', data)[0]
+    else:
+        # something else that we haven't encountered
+        raise RuntimeError('Unexpected number of bytes %d and dataType %s ' % (numBytes, dataType))
+
+    # numbers may be contained in less than a byte, this shifts and 
+    # masks as appropriate
+    if isinstance(v, (int)):
+        bitOffsetInByte = bitOffset % 8
+        v = v >> bitOffsetInByte
+        if (bitLength % 8 != 0):
+            v = v & ((1 << bitLength) - 1)
+
+    return v
 
-            # skip reserved blocks
-            if name == None or name == 'Reserved' or name == 'SID':
-                continue
+#
+# A decoded NMEA 2000 record, passed to PgnConsumer.ConsumePgn as 
+# dataRecord.
+#
+# Fields are decoded from the raw data the first time they are asked for,
+# using the PgnDecodePlan for the PGN.  All names, units and key order are
+# shared through the plan, so a record is just the raw data and the values
+# that have been decoded so far.
+#
+# timestamp is the time passed to Nmea2000Reader.HandlePacket with the 
+# (last) frame of the record, None if there wasn't one.
+#
+# For speed consumers should use Names(), GetValue(), GetUnits(), 
+# GetRawValue() and GetLongName().  For compatibility the record also 
+# works like the old dict, with keys "Name", "Name:RawValue", 
+# "Name:Units", "Name:LongName" and "nmea2000:pgn", "nmea2000:priority",
+# "nmea2000:source_address", "nmea2000:destination_address".
+#
+class DataRecord(object):
+    __slots__ = ('pgn', 'priority', 'source_address', 'destination_address', 
+        'timestamp', '__plan', '__b', '__values', '__slots')
+
+    # the parts of a field returned by __getitem__
+    VALUE = 0
+    RAW_VALUE = 1
+    UNITS = 2
+    LONG_NAME = 3
+
+    HEADER_KEYS = {
+        'nmea2000:pgn': 'pgn',
+        'nmea2000:priority': 'priority',
+        'nmea2000:source_address': 'source_address',
+        'nmea2000:destination_address': 'destination_address',
+    }
 
-            value = self.parseOut(b, bitOffset, bitLength, f.get('Type'), signed)
+    #
+    # plan -- the PgnDecodePlan for this PGN
+    # arbitration_id -- CAN arbitration_id (header) as a CanId
+    # b -- byte array (or memoryview) with the data
+    # timestamp -- the time of the record in seconds, or None
+    #
+    def __init__(self, plan, arbitration_id, b, timestamp=None):
+        self.pgn = arbitration_id.pgn
+        self.priority = arbitration_id.priority
+        self.source_address = arbitration_id.source_address
+        self.destination_address = arbitration_id.destination_address
+        self.timestamp = timestamp
+        self.__plan = plan
+        self.__b = b
+        self.__values = [None] * len(plan.fields)
+        self.__slots = None
 
-            if bitLength == -1:
-                bitLength = 0
-            unknownValue = (1 << (bitLength)) - 1
-            if f.get('Signed') == True:
-                unknownValue = unknownValue >> 1
+    #
+    # Make sure the record no longer refers to a buffer that the caller 
+    # might reuse
+    #
+    def Detach(self):
+        if isinstance(self.__b, memoryview):
+            self.__b = self.__b.tobytes()
 
-            #print("field = %s" % name)
-            #print("bitOffset = %d" % bitOffset)
-            #print("bitLength = %d" % bitLength)
-            #print("unknownValue = %d" % unknownValue)
-            #print("value = %d" % value)
+    # The names of the fields in this record, in PGN order
+    def Names(self):
+        return self.__plan.names
 
-            if value == unknownValue:
-                dataRecord[name + ':RawValue'] = value
-                value = None
-                units = None
-            else:
-                # resolution modifier
-                if 'Resolution' in f and f['Resolution'] != 1:
-                    resolution = float(f['Resolution'])
-                    value = value * resolution
-
-                # type modifier, we use it to find lookup tables
-                if 'Type' in f:
-                    type = f['Type']
-                else:
-                    type = 'scalar'
+    # The decoded value of a field, None if it is unknown
+    def GetValue(self, name):
+        return self.__field(self.__plan.fieldIndex[name])[0]
 
-                dataRecord[name + ':RawValue'] = value
+    # The decoded value of the field at index i in the PgnDecodePlan
+    def GetValueAt(self, i):
+        return self.__field(i)[0]
 
-                # units modifier, used to decorate output
-                if 'Units' in f and f['Units'] != None:
-                    units = f['Units']
-                else:
-                    units = ''
+    # The value of a field before lookup tables were applied
+    def GetRawValue(self, name):
+        return self.__field(self.__plan.fieldIndex[name])[1]
 
-                # expand lookup table
-                if (type == 'Lookup table') and ('EnumValues' in f):
-                    v = value & f['EnumMask']
-                    value = '"%d"' % v
-                    enumValues = f['EnumValues']
-                    if (str(v) in enumValues):
-                        value = enumValues[str(v)]
+    # The units of a field, None if the value is unknown
+    def GetUnits(self, name):
+        return self.__field(self.__plan.fieldIndex[name])[2]
 
-            dataRecord[name] = value
-            dataRecord[name + ':Units'] = units
-            dataRecord[name + ':LongName'] = f['LongName']
+    # The original name of the field from pgns.json
+    def GetLongName(self, name):
+        return self.__plan.fields[self.__plan.fieldIndex[name]].longName
 
-        for consumer in self.__consumers:
-            consumer.ConsumePgn(pgn, dataRecord, pgnRecord)
+    #
+    # dict compatibility
+    #
+    def __getitem__(self, key):
+        if key in self.HEADER_KEYS:
+            return getattr(self, self.HEADER_KEYS[key])
+        (i, part) = self.__plan.keyIndex[key]
+        if part == self.LONG_NAME:
+            return self.__plan.fields[i].longName
+        return self.__field(i)[part]
+
+    def __contains__(self, key):
+        return key in self.HEADER_KEYS or key in self.__plan.keyIndex
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.HEADER_KEYS) + len(self.__plan.keyIndex)
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def keys(self):
+        return list(self.HEADER_KEYS) + list(self.__plan.keyIndex)
+
+    def items(self):
+        return [(k, self[k]) for k in self.keys()]
+
+    def values(self):
+        return [self[k] for k in self.keys()]
+
+    # Decode every field and return the record as a dict
+    def AsDict(self):
+        return dict(self.items())
+
+    #
+    # Decode field i if it hasn't been already
+    # returns: (value, raw value, units)
+    #
+    def __field(self, i):
+        v = self.__values[i]
+        if v is None:
+            v = self.__decode(i)
+            self.__values[i] = v
+        return v
+
+    def __decode(self, i):
+        plan = self.__plan
+        f = plan.fields[i]
+        b = self.__b
+
+        if f.slot >= 0 and len(b) >= plan.minLength:
+            # read all fields at once if the layout allows it
+            if self.__slots is None:
+                self.__slots = plan.recordStruct.unpack_from(b)
+            value = (self.__slots[f.slot] >> f.shift) & f.mask
+        elif f.kind == FIELD_INTEGER:
+            # check for out of bounds
+            if len(b) < f.minLength:
+                value = 0
+            else:
+                value = (f.unpack(b, f.startingByte)[0] >> f.shift) & f.mask
+        else:
+            value = parseOut(b, f.bitOffset, f.bitLength, f.dataType, f.signed)
+
+        if value == f.unknownValue:
+            return (None, value, None)
+
+        # resolution modifier
+        if f.resolution is not None:
+            value = value * f.resolution
+        rawValue = value
+
+        # expand lookup table
+        if f.enumValues is not None:
+            v = value & f.enumMask
+            value = f.enumValues.get(v)
+            if value is None:
+                value = '"%d"' % v
+
+        return (value, rawValue, f.units)
 
 # 
 # This is a simple NMEA 2000 data consumer that prints all input
@@ -392,13 +1117,17 @@ class PgnPrinter(PgnConsumer):
     # pgnRecord - the record from pgnTable with the meta-information about this PGN
     #
     def ConsumePgn(self, pgn, dataRecord, pgnRecord):
+        print(self.Format(pgn, dataRecord, pgnRecord))
+
+    #
+    # Format a NMEA2000 record the way that ConsumePgn prints it
+    #
+    def Format(self, pgn, dataRecord, pgnRecord):
         outFields = []
         description = pgnRecord['Description']
-        for name in dataRecord.keys():
-            if (name.find(':') != -1):
-                continue
-            value = dataRecord[name]
-            units = dataRecord[name + ':Units']
+        for name in dataRecord.Names():
+            value = dataRecord.GetValue(name)
+            units = dataRecord.GetUnits(name)
 
             # I can't think in radians, convert those to degrees
             # convert radians to degrees
@@ -419,8 +1148,77 @@ class PgnPrinter(PgnConsumer):
             # append output 
             outFields.append("%s=(%s%s)" % (name, value, units))
 
-        # print output
-        print("source=%s: pgn=%s(%i): values=%s\n" % (str(dataRecord["nmea2000:source_address"]), description, pgn, ' '.join(outFields[0:])))
+        return "source=%s: pgn=%s(%i): values=%s\n" % (str(dataRecord.source_address), description, pgn, ' '.join(outFields[0:]))
+
+#
+# A consistent copy of Nmea2000State at one point in time.  Snapshots
+# are never changed after they are made, so they can be read from any
+# thread without a lock.
+#
+# Values are stored in a list, each variable has a slot in the list.
+#
+# sequence -- the sequence number of the last change in the snapshot
+#
+class Nmea2000Snapshot(object):
+    __slots__ = ('sequence', '__slotIndex', '__values', '__changed')
+
+    #
+    # slotIndex -- dict of variable name to slot, shared by all snapshots
+    # values -- list of the value in each slot (None if unknown)
+    # changed -- list of the sequence number of the last change to each
+    #   slot
+    #
+    # The snapshot takes ownership of the lists, they must not be changed
+    # afterwards.
+    #
+    def __init__(self, sequence, slotIndex, values, changed):
+        self.sequence = sequence
+        self.__slotIndex = slotIndex
+        self.__values = values
+        self.__changed = changed
+
+    def __getitem__(self, k):
+        return self.__values[self.__slotIndex[k]]
+
+    def __contains__(self, k):
+        return k in self.__slotIndex
+
+    def get(self, k, default=None):
+        if k in self.__slotIndex:
+            return self[k]
+        return default
+
+    def keys(self):
+        return self.__slotIndex.keys()
+
+    # The value in a slot
+    def GetSlot(self, slot):
+        return self.__values[slot]
+
+    # The sequence number of the last change to a variable, 0 if it has 
+    # never been set
+    def GetSequence(self, k):
+        return self.__changed[self.__slotIndex[k]]
+
+    # Build the next snapshot with some slots changed (dict of slot to
+    # value)
+    def Update(self, sequence, changes):
+        values = list(self.__values)
+        changed = list(self.__changed)
+        for (slot, value) in changes.items():
+            values[slot] = value
+            changed[slot] = sequence
+        return Nmea2000Snapshot(sequence, self.__slotIndex, values, changed)
+
+#
+# How Nmea2000State uses one PGN, compiled from the state map
+#
+# ranks -- dict of source address to priority (0 is the best), None if
+#   every source is the same
+# unranked -- the priority of sources that aren't in ranks
+# fields -- [ (field index in the PgnDecodePlan, state slot) ]
+#
+StateMapPlan = collections.namedtuple('StateMapPlan', ['ranks', 'unranked', 'fields'])
 
 #
 # This class keeps track of all boat state coming in via NMEA 2000. 
@@ -429,59 +1227,152 @@ class PgnPrinter(PgnConsumer):
 # local cache that can then be consumed by other classes (such as the
 # NMEA 0183 output or the data logger).
 #
+# The list of PGNs comes from a JSON file (statemap.json):
+#   timeout -- seconds before a source that has stopped sending loses
+#     its priority
+#   pgns -- list of:
+#     pgn -- the PGN
+#     fields -- dict of the field name in the PGN to the variable name
+#     sources -- optional, source addresses in priority order.  A variable
+#       is only taken from a lower priority source if the higher priority
+#       one hasn't sent it for timeout seconds.  Sources that aren't listed
+#       come last.  Without this the last source to send wins.
+#   derived -- list of channels from lib/derived.py to compute.  They are
+#     only computed again when one of their inputs changes.
+#
+# The state is kept as a Nmea2000Snapshot.  Each update builds a new
+# snapshot and replaces the old one, so readers never need a lock.  Use
+# Snapshot() to read several variables that need to agree with each other
+# (like Latitude and Longitude).
+#
 class Nmea2000State(PgnConsumer):
+    #
     # Initialize the class
-    def __init__(self):
-        # TODO -- single instance this between here and Nmea2000Reader
-        self.__pgnTable = PgnTable()
+    #
+    # configFile -- the state map, see above
+    # historyCapacity -- the most samples of history to keep for each
+    #   variable
+    # historyWindow -- the length (in seconds) of the running averages
+    #   kept for each variable
+    #
+    def __init__(self, configFile='./statemap.json', historyCapacity=1024, historyWindow=30.0):
+        self.__pgnTable = GetPgnTable()
 
-        #
-        # This is a map of PGNs to data that should be kept from them.
-        # The key in the map is the PGN to notice
-        # The data in the map is the list of data values to store.  
-        # The value is XXX,YYY, where XXX is the name of the variable
-        # in the PGN data, and YYY is the name of the variable in the
-        # state map.  If ,YYY is missing then the same name is used in
-        # both
-        #
-        self.__map = {
-            127250: [ 'Heading' ],
-            128259: [ 'SpeedWaterReferenced,SpeedThroughWater' ],
-            128267: [ 'Depth', 'Offset,DepthOffset' ],
-            129025: [ 'Longitude', 'Latitude' ],
-            129026: [ 'SOG', 'COG' ],
-            130306: [ 'WindSpeed', 'WindAngle', 'Reference,WindReference' ],
-            129033: [ 'Date', 'Time' ],
-        }
+        with open(configFile, 'r') as f:
+            config = json.load(f)
+        self.__timeout = config.get('timeout', 5.0)
 
         # 
-        # __state is what keeps track of our variables
-        #
-        # There is one entry per variable stored that contains both
-        # the value.  There is a paired variable in __units that
-        # contains the units for that variable.  The units don't
-        # change over the lifetime of this object.
+        # Each variable has a slot in the snapshots.  There is a paired
+        # entry in __units that contains the units for that variable.  The
+        # units don't change over the lifetime of this object.
         #
-        # If the value is not known then the map will contain the
-        # entry None.
+        # If the value is not known then the slot will contain None.
         #
-        self.__state = {} 
+        self.__slotIndex = {}
+        self.__names = []
         self.__units = {}
+        self.__listeners = []
+
+        # pgn: StateMapPlan
+        self.__plans = {}
+        for entry in config['pgns']:
+            pgn = entry['pgn']
+            plan = self.__pgnTable.GetDecodePlan(pgn)
+            if plan is None:
+                raise ValueError("%s: unknown pgn %i" % (configFile, pgn))
+            fields = []
+            for (pgnName, stateName) in entry['fields'].items():
+                if pgnName not in plan.fieldIndex:
+                    raise ValueError("%s: pgn %i has no field %s" % (configFile, pgn, pgnName))
+                fields.append((plan.fieldIndex[pgnName], self.newSlot(stateName, self.FindUnitsForField(pgn, pgnName))))
+            ranks = None
+            if 'sources' in entry:
+                ranks = dict((source, i) for (i, source) in enumerate(entry['sources']))
+            self.__plans[pgn] = StateMapPlan(ranks, len(ranks or ()), fields)
+
+        # [ (DerivedChannel, set of input slots, [ (output name, slot) ]) ]
+        self.__derived = []
+        for name in config.get('derived', []):
+            if name not in DERIVED_CHANNELS:
+                raise ValueError("%s: unknown derived channel %s" % (configFile, name))
+            channel = DERIVED_CHANNELS[name]
+            for v in channel.inputs:
+                if v not in self.__slotIndex:
+                    raise ValueError("%s: derived channel %s needs %s" % (configFile, name, v))
+            outputs = [(v, self.newSlot(v, channel.outputs[v])) for v in channel.outputs]
+            self.__derived.append((channel, set(self.__slotIndex[v] for v in channel.inputs), outputs))
+
+        # the source priority and time of the value in each slot, only
+        # used while updating
+        self.__slotRank = [None] * len(self.__names)
+        self.__slotTime = [0.0] * len(self.__names)
 
+        #
+        # Variables with units are numbers, and we keep a History of
+        # them.  Angles also get a running circular mean.
+        #
+        self.__history = {}
+        self.__slotHistory = [None] * len(self.__names)
+        for (slot, name) in enumerate(self.__names):
+            if self.__units[name] != '':
+                self.__history[name] = History(historyCapacity, historyWindow, self.__units[name] == 'rad')
+                self.__slotHistory[slot] = self.__history[name]
+
+        # held while updating the state (not needed for reading it)
         self.__lock = threading.Lock()
 
-        for pgn in self.__map.keys():
-            for v in self.__map[pgn]:
-                i = v.find(',')
-                if (i == -1):
-                    pgnName = v
-                    stateName = v
-                else:
-                    pgnName = v[0:i]
-                    stateName = v[i+1:]
-                i += 1
-                self.__state[stateName] = None
-                self.__units[stateName] = self.FindUnitsForField(pgn, pgnName)
+        #
+        # Every update that changes the state gets a new sequence number.
+        # The snapshot has the sequence number of the last change to each
+        # variable.
+        #
+        self.__snapshot = Nmea2000Snapshot(0, self.__slotIndex, [None] * len(self.__names), [0] * len(self.__names))
+
+    #
+    # Find or make the slot for a variable
+    #
+    def newSlot(self, name, units):
+        if name not in self.__slotIndex:
+            self.__slotIndex[name] = len(self.__names)
+            self.__names.append(name)
+            self.__units[name] = units
+        return self.__slotIndex[name]
+
+    #
+    # We only care about the PGNs in our map
+    #
+    def Subscriptions(self):
+        return list(self.__plans.keys())
+
+    #
+    # Ask to be told about changes to the state.  fn is called with
+    # (sequence, names) after each update that changes a variable, where
+    # names is the list of variables that changed.  It is called on the
+    # thread that is decoding PGNs, so it should return quickly.
+    #
+    def Subscribe(self, fn):
+        self.__listeners.append(fn)
+
+    def Unsubscribe(self, fn):
+        self.__listeners.remove(fn)
+
+    # The sequence number of the last change
+    @property
+    def Sequence(self):
+        return self.__snapshot.sequence
+
+    # The sequence number of the last change to a variable, 0 if it has 
+    # never been set
+    def GetSequence(self, k):
+        return self.__snapshot.GetSequence(k)
+
+    #
+    # Get the current state as a Nmea2000Snapshot.  All of the values in
+    # a snapshot are from the same point in time.
+    #
+    def Snapshot(self):
+        return self.__snapshot
 
     # 
     # Find the units for a given field in a pgn
@@ -496,34 +1387,83 @@ class Nmea2000State(PgnConsumer):
         return ''
 
     #
-    # Update __state with data from this PGN
+    # Update the state with data from this PGN
     # 
     # pgn - the PGN related to this record
     # dataRecord - The data that is being shown in the record
     # pgnRecord - the record from pgnTable with the meta-information about this PGN (ignored)
     #
     def ConsumePgn(self, pgn, dataRecord, pgnRecord):
-        if pgn not in self.__map:
+        plan = self.__plans.get(pgn)
+        if plan is None:
             return None
 
-        for v in self.__map[pgn]:
-            i = v.find(',')
-            if i == -1:
-                pgnName = v
-                fieldName = v
-            else:
-                pgnName = v[0:i]
-                fieldName = v[i+1:]
+        values = [(slot, dataRecord.GetValueAt(i)) for (i, slot) in plan.fields]
+
+        timestamp = dataRecord.timestamp
+        if timestamp is None:
+            timestamp = time.time()
+        if plan.ranks is None:
+            rank = 0
+        else:
+            rank = plan.ranks.get(dataRecord.source_address, plan.unranked)
 
-            with self.__lock:
-                self.__state[fieldName] = dataRecord[pgnName]
+        with self.__lock:
+            snapshot = self.__snapshot
+            changed = {}
+            for (slot, value) in values:
+                # keep the value from a better source, unless it has
+                # gone quiet
+                current = self.__slotRank[slot]
+                if current is not None and rank > current and timestamp - self.__slotTime[slot] <= self.__timeout:
+                    continue
+                self.__slotRank[slot] = rank
+                self.__slotTime[slot] = timestamp
+
+                if snapshot.GetSlot(slot) != value:
+                    changed[slot] = value
+                if value is not None and self.__slotHistory[slot] is not None:
+                    self.__slotHistory[slot].Append(timestamp, value)
+
+            if changed:
+                sequence = snapshot.sequence + 1
+                snapshot = snapshot.Update(sequence, changed)
+                snapshot = self.updateDerived(snapshot, changed, timestamp)
+                # readers see either the old or the new snapshot
+                self.__snapshot = snapshot
+
+        if changed:
+            names = [self.__names[slot] for slot in changed]
+            for fn in self.__listeners:
+                fn(sequence, names)
+
+    #
+    # Compute the derived channels whose inputs are in changed (dict of
+    # slot to value), and add their outputs to the snapshot and changed.
+    # returns: the new snapshot
+    #
+    def updateDerived(self, snapshot, changed, timestamp):
+        for (channel, inputs, outputs) in self.__derived:
+            if inputs.isdisjoint(changed):
+                continue
+            results = channel.fn(snapshot)
+            derivedChanges = {}
+            for (name, slot) in outputs:
+                value = results[name]
+                if snapshot.GetSlot(slot) != value:
+                    derivedChanges[slot] = value
+                if value is not None and self.__slotHistory[slot] is not None:
+                    self.__slotHistory[slot].Append(timestamp, value)
+            if derivedChanges:
+                snapshot = snapshot.Update(snapshot.sequence, derivedChanges)
+                changed.update(derivedChanges)
+        return snapshot
 
     # 
     # Return the value of a state item
     #
     def __getitem__(self, k):
-        with self.__lock:
-            return self.__state[k]
+        return self.__snapshot[k]
 
     # 
     # Get the units for a state item
@@ -531,55 +1471,124 @@ class Nmea2000State(PgnConsumer):
     def GetUnits(self, k):
         return self.__units[k]
 
+    #
+    # Aggregates of the history of a state item over the last window
+    # seconds, default is historyWindow (which is the fastest).  See
+    # History.
+    #
+    def Mean(self, k, window=None):
+        with self.__lock:
+            return self.__history[k].Mean(window)
+
+    def Min(self, k, window=None):
+        with self.__lock:
+            return self.__history[k].Min(window)
+
+    def Max(self, k, window=None):
+        with self.__lock:
+            return self.__history[k].Max(window)
+
+    def CircularMean(self, k, window=None):
+        with self.__lock:
+            return self.__history[k].CircularMean(window)
+
+    #
+    # The history of a state item as NumPy arrays (timestamps, values),
+    # oldest first.  These are copies, so they can be kept.
+    #
+    def HistoryArrays(self, k):
+        with self.__lock:
+            (timestamps, values) = self.__history[k].Arrays()
+            return (timestamps.copy(), values.copy())
+
+    # The names of the state items that have history
+    def HistoryKeys(self):
+        return self.__history.keys()
+
     #
     # Return the list of known keys
     #
     def keys(self):
-        return self.__state.keys()
+        return self.__snapshot.keys()
 
 #
-# Log data from the Nmea2000State object to a log file
+# Log data from the Nmea2000State object to log files (see lib/datalog.py)
+#
+# Samples are added to typed arrays on the sampling thread, and handed to
+# a background writer every flushInterval seconds, so the decoding thread
+# never waits for the disk.  Use ExportCsv to turn a log into CSV.
 #
 class NmeaLogger(object):
     #
     # state -- a Nmea2000State object that is collecting state from the bus
+    # rate -- samples per second, or None to log every change to the state
+    # keys -- the state variables to log, default is all of them
+    # directory -- where to put the log files
+    # flushInterval -- seconds of samples to buffer before writing them
+    # rotateSeconds -- start a new file this often, None for one file
+    # fsync -- when to fsync the log file (FSYNC_NEVER, FSYNC_BLOCK or
+    #   FSYNC_ROTATE)
     #
-    def __init__(self, state):
+    def __init__(self, state, rate=1.0, keys=None, directory='saildata', flushInterval=1.0, rotateSeconds=3600, fsync=FSYNC_BLOCK):
         self.__state = state
-        self.__timer = RepeatTimer(1, self.worker)
-        self.__filename = "%s.csv" % time.strftime('saildata/saildata-%Y-%m-%d-%H-%M')
-        self.__file = open(self.__filename, 'wb')
-        self.__csv = csv.writer(self.__file) #, dialect='excel2')
-        self.__writeheader = True
-        self.__keys = [ 
-            'Heading', 
-            'SpeedThroughWater', 
-            'SOG', 
-            'COG',
-            'WindSpeed', 
-            'WindAngle', 
-            'WindReference',
-            'Depth', 
-            'DepthOffset',
-            'Longitude', 
-            'Latitude', ]
-
-    #
-    # This worker method is called once per second to log the state data
+        self.__keys = list(keys or state.keys())
+        self.__columns = [ (k, state.GetUnits(k)) for k in self.__keys ]
+        self.__flushInterval = flushInterval
+        self.__writer = DataLogWriter(directory, self.__columns, rotateSeconds=rotateSeconds, fsync=fsync)
+        self.__lock = threading.Lock()
+        self.__buffer = DataLogBuffer(self.__columns)
+        self.__closed = False
+        self.__rate = rate
+        if rate is None:
+            state.Subscribe(self.__Changed)
+        else:
+            self.__task = GetScheduler().Every(1.0 / rate, self.worker, 'NmeaLogger')
+
+    # The files written so far
+    @property
+    def Filenames(self):
+        return self.__writer.Filenames
+
+    #
+    # This worker method is called rate times per second to log the state
+    # data
     #
     def worker(self):
-        # write the header if there isn't already one
-        # we do this on the first write instead of during __init__ to pick
-        # up the units
-        if self.__writeheader:
-            self.__writeheader = False;
-            header = []
-            for k in self.__keys:
-                header.append("%s (%s)" % (k, self.__state.GetUnits(k)))
-            # write out the header
-            self.__csv.writerow(header.encode("utf-8"))
-
-        values = []
-        for k in self.__keys:
-            values.append(self.__state[k])
-        self.__csv.writerow(values.encode("utf-8"))
+        self.sample(time.time())
+
+    # Called by Nmea2000State when logging every change
+    def __Changed(self, sequence, names):
+        self.sample(time.time())
+
+    #
+    # Add a row with the current state
+    #
+    def sample(self, timestamp):
+        snapshot = self.__state.Snapshot()
+        values = [ snapshot[k] for k in self.__keys ]
+        with self.__lock:
+            if self.__closed:
+                return
+            buffer = self.__buffer
+            buffer.Append(timestamp, values)
+            if timestamp - buffer.First >= self.__flushInterval:
+                self.__buffer = DataLogBuffer(self.__columns)
+                self.__writer.Write(buffer)
+
+    #
+    # Write out everything that has been logged and close the file
+    #
+    # The state when this is called is logged as the last row.
+    #
+    def Close(self):
+        if self.__rate is None:
+            self.__state.Unsubscribe(self.__Changed)
+        else:
+            self.__task.Cancel()
+        self.sample(time.time())
+        with self.__lock:
+            if self.__closed:
+                return
+            self.__closed = True
+            self.__writer.Write(self.__buffer)
+        self.__writer.Close()
@@ -0,0 +1,323 @@
+#!/usr/bin/python
+
+# system modules
+import math
+import time
+import struct
+import threading
+import collections
+
+# local modules
+from lib.nmea2000 import Nmea2000Reader, PgnConsumer, DecodeCanId
+
+#
+# A pipeline that keeps receiving frames from the bus separate from
+# decoding them, and decoding separate from slow consumers.
+#
+#   receive (caller's thread) -> frame rings -> decode thread
+#     -> a queue and worker thread per consumer
+#
+# The receive stage only copies the frame into a preallocated ring, so it
+# never waits for decoding or for a consumer.  Frames and records for
+# bulk PGNs (AIS by default) go into their own rings and queues, and are
+# only handled when there is nothing else waiting, so a burst of AIS
+# traffic can only ever cost AIS frames and never wind or heading.
+#
+# Everything in this file is threads.  Decoding is not fast enough in
+# CPython to move to another process and pay for sending records back.
+#
+
+# AIS PGNs, which come in bursts and don't matter as much as instruments
+BULK_PGNS = frozenset([
+    129038, 129039, 129040, 129041, 129792, 129793, 129794, 129795,
+    129796, 129797, 129798, 129800, 129801, 129802, 129803, 129804,
+    129805, 129806, 129807, 129808, 129809, 129810])
+
+#
+# What a ConsumerQueue does when it is full
+#
+# OVERFLOW_DROP_OLDEST -- throw away the oldest record to make room
+# OVERFLOW_DROP_NEWEST -- throw away the new record
+# OVERFLOW_BLOCK -- wait for room.  This holds up decoding for every
+#   consumer, only use it for consumers that must see every record.
+#
+OVERFLOW_DROP_OLDEST = 0
+OVERFLOW_DROP_NEWEST = 1
+OVERFLOW_BLOCK = 2
+
+# timestamp (NaN for None), can_id, data length, data
+FRAME_RECORD = struct.Struct('<dIB8s')
+
+#
+# A fixed size ring of frames in one preallocated buffer.  It isn't
+# thread safe, Nmea2000Pipeline locks around it.  When the ring is full
+# new frames are dropped.
+#
+class FrameRing(object):
+    def __init__(self, capacity):
+        self.__capacity = capacity
+        self.__buffer = bytearray(capacity * FRAME_RECORD.size)
+        # frames ever added and removed, frame n is at n % capacity
+        self.__head = 0
+        self.__tail = 0
+        self.dropped = 0
+
+    def __len__(self):
+        return self.__tail - self.__head
+
+    #
+    # Add a frame
+    # returns: False if it was dropped
+    #
+    def Put(self, can_id, data, timestamp):
+        if self.__tail - self.__head >= self.__capacity:
+            self.dropped += 1
+            return False
+        offset = (self.__tail % self.__capacity) * FRAME_RECORD.size
+        FRAME_RECORD.pack_into(self.__buffer, offset, math.nan if timestamp is None else timestamp,
+            can_id, len(data), bytes(data))
+        self.__tail += 1
+        return True
+
+    #
+    # Remove up to count frames
+    # returns: list of (can_id, data, timestamp)
+    #
+    def Get(self, count):
+        frames = []
+        unpack = FRAME_RECORD.unpack_from
+        end = min(self.__tail, self.__head + count)
+        for n in range(self.__head, end):
+            (timestamp, can_id, length, data) = unpack(self.__buffer, (n % self.__capacity) * FRAME_RECORD.size)
+            frames.append((can_id, data[0:length], None if math.isnan(timestamp) else timestamp))
+        self.__head = end
+        return frames
+
+#
+# Give records to a consumer on its own thread, through a bounded queue.
+# Use this as the consumer in Nmea2000Pipeline to pick the queue size and
+# overflow policy, otherwise each consumer gets the defaults.
+#
+# consumer -- the PgnConsumer
+# maxSize -- the most records waiting, for each of the normal and bulk
+#   queues
+# overflow -- OVERFLOW_DROP_OLDEST, OVERFLOW_DROP_NEWEST or OVERFLOW_BLOCK
+# bulkPgns -- PGNs that are only handled when nothing else is waiting
+#
+class ConsumerQueue(PgnConsumer):
+    def __init__(self, consumer, maxSize=1024, overflow=OVERFLOW_DROP_OLDEST, bulkPgns=BULK_PGNS):
+        self.__consumer = consumer
+        self.__maxSize = maxSize
+        self.__overflow = overflow
+        self.__bulkPgns = bulkPgns
+        self.__queue = collections.deque()
+        self.__bulkQueue = collections.deque()
+        self.__condition = threading.Condition()
+        self.__dropped = 0
+        self.__bulkDropped = 0
+        self.__busy = False
+        self.__closed = False
+        self.__thread = threading.Thread(target=self.worker, name=type(consumer).__name__)
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    @property
+    def Consumer(self):
+        return self.__consumer
+
+    # Records dropped because the queue was full
+    @property
+    def Dropped(self):
+        return self.__dropped
+
+    @property
+    def BulkDropped(self):
+        return self.__bulkDropped
+
+    def Subscriptions(self):
+        if hasattr(self.__consumer, 'Subscriptions'):
+            return self.__consumer.Subscriptions()
+        return None
+
+    #
+    # Called on the decode thread, queues the record for the worker
+    #
+    def ConsumePgn(self, pgn, dataRecord, pgnRecord):
+        # the record outlives the buffer that it was decoded from
+        dataRecord.Detach()
+        bulk = pgn in self.__bulkPgns
+        queue = self.__bulkQueue if bulk else self.__queue
+        with self.__condition:
+            if len(queue) >= self.__maxSize:
+                if self.__overflow == OVERFLOW_BLOCK:
+                    while len(queue) >= self.__maxSize and not self.__closed:
+                        self.__condition.wait()
+                else:
+                    if bulk:
+                        self.__bulkDropped += 1
+                    else:
+                        self.__dropped += 1
+                    if self.__overflow == OVERFLOW_DROP_NEWEST:
+                        return
+                    queue.popleft()
+            queue.append((pgn, dataRecord, pgnRecord))
+            self.__condition.notify_all()
+
+    #
+    # Wait until everything queued has been consumed
+    #
+    def Drain(self):
+        with self.__condition:
+            while self.__queue or self.__bulkQueue or self.__busy:
+                self.__condition.wait()
+
+    #
+    # Consume what is queued and stop the worker
+    #
+    def Close(self):
+        with self.__condition:
+            self.__closed = True
+            self.__condition.notify_all()
+        self.__thread.join()
+
+    #
+    # This is the main body of the worker thread
+    #
+    def worker(self):
+        while True:
+            with self.__condition:
+                self.__busy = False
+                while not self.__queue and not self.__bulkQueue:
+                    # wake up Drain
+                    self.__condition.notify_all()
+                    if self.__closed:
+                        return
+                    self.__condition.wait()
+                if self.__queue:
+                    item = self.__queue.popleft()
+                else:
+                    item = self.__bulkQueue.popleft()
+                self.__busy = True
+                # wake up ConsumePgn if it is blocked
+                self.__condition.notify_all()
+            self.__consumer.ConsumePgn(*item)
+
+#
+# A drop in replacement for Nmea2000Reader that decodes on its own thread
+# and gives each consumer its own ConsumerQueue.
+#
+# consumers -- list of PgnConsumer or ConsumerQueue
+# ringSize -- the most frames waiting to be decoded, for each of the
+#   normal and bulk rings
+# batchSize -- the most frames to decode per lock
+# bulkPgns -- PGNs that are only decoded when nothing else is waiting
+#
+class Nmea2000Pipeline(object):
+    def __init__(self, consumers, ringSize=4096, batchSize=64, bulkPgns=BULK_PGNS):
+        self.__queues = []
+        for consumer in consumers:
+            if not isinstance(consumer, ConsumerQueue):
+                consumer = ConsumerQueue(consumer, bulkPgns=bulkPgns)
+            self.__queues.append(consumer)
+        self.__reader = Nmea2000Reader(self.__queues)
+        self.__bulkPgns = bulkPgns
+        self.__batchSize = batchSize
+        self.__ring = FrameRing(ringSize)
+        self.__bulkRing = FrameRing(ringSize)
+        self.__condition = threading.Condition()
+        self.__busy = False
+        self.__closed = False
+        self.__thread = threading.Thread(target=self.worker, name='Nmea2000Pipeline')
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    #
+    # Queue a frame to be decoded, see Nmea2000Reader.HandlePacket.  This
+    # never waits for decoding.
+    # returns: False if the frame was dropped because the ring was full
+    #
+    def HandlePacket(self, arbitration_id, data, timestamp=None):
+        if not isinstance(arbitration_id, int):
+            arbitration_id = arbitration_id.can_id
+        # stamp the frame now, when it was received.  Left to the decode
+        # thread a bulk fast packet that waits behind other frames would
+        # look too slow and be expired.  This is wall clock time, like
+        # SocketCanReader, because consumers use it as the record's time.
+        if timestamp is None:
+            timestamp = time.time()
+        if DecodeCanId(arbitration_id).pgn in self.__bulkPgns:
+            ring = self.__bulkRing
+        else:
+            ring = self.__ring
+        with self.__condition:
+            if not ring.Put(arbitration_id, data, timestamp):
+                return False
+            self.__condition.notify()
+        return True
+
+    # The ConsumerQueue for each consumer
+    @property
+    def Queues(self):
+        return list(self.__queues)
+
+    # Frames dropped because a ring was full
+    @property
+    def Dropped(self):
+        return self.__ring.dropped
+
+    @property
+    def BulkDropped(self):
+        return self.__bulkRing.dropped
+
+    # Counters for fast packet reassembly
+    @property
+    def Statistics(self):
+        return self.__reader.Statistics
+
+    def Subscriptions(self):
+        return self.__reader.Subscriptions()
+
+    def UpdateSubscriptions(self):
+        self.__reader.UpdateSubscriptions()
+
+    #
+    # Wait until every frame has been decoded and consumed
+    #
+    def Drain(self):
+        with self.__condition:
+            while len(self.__ring) or len(self.__bulkRing) or self.__busy:
+                self.__condition.wait()
+        for queue in self.__queues:
+            queue.Drain()
+
+    #
+    # Decode and consume what is queued, then stop all of the threads
+    #
+    def Close(self):
+        with self.__condition:
+            self.__closed = True
+            self.__condition.notify_all()
+        self.__thread.join()
+        for queue in self.__queues:
+            queue.Close()
+
+    #
+    # This is the main body of the decode thread
+    #
+    def worker(self):
+        handlePacket = self.__reader.HandlePacket
+        while True:
+            with self.__condition:
+                self.__busy = False
+                while not len(self.__ring) and not len(self.__bulkRing):
+                    # wake up Drain
+                    self.__condition.notify_all()
+                    if self.__closed:
+                        return
+                    self.__condition.wait()
+                frames = self.__ring.Get(self.__batchSize)
+                if not frames:
+                    frames = self.__bulkRing.Get(self.__batchSize)
+                self.__busy = True
+            for (can_id, data, timestamp) in frames:
+                handlePacket(can_id, data, timestamp)
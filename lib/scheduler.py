@@ -0,0 +1,270 @@
+#!/usr/bin/python
+
+# system modules
+import time
+import heapq
+import itertools
+import threading
+import traceback
+import collections
+
+#
+# Run periodic (and one shot) functions from one place, instead of a
+# thread per task.
+#
+# Deadlines are absolute (on the monotonic clock): a task with an interval
+# of 1 second runs at start + 1, start + 2, ... no matter how long it takes
+# to run, so it doesn't drift.  If a task falls more than a whole interval
+# behind then the missed runs are skipped (and counted), it doesn't run
+# several times in a row to catch up.
+#
+# Scheduler runs tasks on its own thread.  AsyncScheduler runs them on an
+# asyncio event loop.  Both have the same interface.
+#
+
+#
+# Timing statistics for a task, all times are in seconds
+#
+# runs -- number of times it has run
+# missed -- runs skipped because the task fell behind
+# errors -- runs that raised an exception
+# meanRuntime, maxRuntime -- how long fn took
+# meanLateness, maxLateness -- how long after the deadline fn started
+#
+TaskStatistics = collections.namedtuple('TaskStatistics', [
+    'runs', 'missed', 'errors', 'meanRuntime', 'maxRuntime', 'meanLateness', 'maxLateness'])
+
+#
+# A task returned by Scheduler.Every or Scheduler.After
+#
+# fn -- the function to run (with no arguments)
+# interval -- seconds between runs, None for a one shot task
+# name -- for statistics, defaults to the function's name
+#
+class ScheduledTask(object):
+    def __init__(self, scheduler, fn, interval, name=None):
+        self.__scheduler = scheduler
+        self.fn = fn
+        self.interval = interval
+        self.name = name or getattr(fn, '__name__', repr(fn))
+        self.cancelled = False
+        # used by AsyncScheduler
+        self.handle = None
+
+        self.__runs = 0
+        self.__missed = 0
+        self.__errors = 0
+        self.__totalRuntime = 0.0
+        self.__maxRuntime = 0.0
+        self.__totalLateness = 0.0
+        self.__maxLateness = 0.0
+
+    #
+    # Stop running the task.  If it is running now then it finishes.
+    #
+    def Cancel(self):
+        self.__scheduler.Cancel(self)
+
+    def Statistics(self):
+        runs = self.__runs
+        return TaskStatistics(runs, self.__missed, self.__errors,
+            self.__totalRuntime / runs if runs else 0.0, self.__maxRuntime,
+            self.__totalLateness / runs if runs else 0.0, self.__maxLateness)
+
+    #
+    # Run the function and keep track of how it went.  Exceptions are
+    # printed, they don't stop the task or the scheduler.
+    #
+    # lateness -- how long after the deadline this is
+    #
+    def run(self, lateness):
+        start = time.monotonic()
+        try:
+            self.fn()
+        except Exception:
+            self.__errors += 1
+            traceback.print_exc()
+        runtime = time.monotonic() - start
+
+        self.__runs += 1
+        self.__totalRuntime += runtime
+        self.__maxRuntime = max(self.__maxRuntime, runtime)
+        self.__totalLateness += lateness
+        self.__maxLateness = max(self.__maxLateness, lateness)
+
+    #
+    # The deadline after this one, skipping any that have already passed
+    #
+    def nextDeadline(self, deadline, now):
+        behind = int((now - deadline) // self.interval)
+        if behind > 0:
+            self.__missed += behind
+        else:
+            behind = 0
+        return deadline + (behind + 1) * self.interval
+
+#
+# Runs tasks on one thread, in deadline order.  Tasks should return quickly
+# since they hold up every other task while they run.
+#
+class Scheduler(object):
+    def __init__(self, name='Scheduler'):
+        # (deadline, counter, task).  Cancelled tasks are left in the heap
+        # and skipped when they come up.
+        self.__heap = []
+        self.__counter = itertools.count()
+        self.__condition = threading.Condition()
+        self.__closed = False
+        self.__thread = threading.Thread(target=self.worker, name=name)
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    #
+    # Run fn every interval seconds.  The first run is after delay
+    # seconds, which defaults to interval.
+    #
+    def Every(self, interval, fn, name=None, delay=None):
+        task = ScheduledTask(self, fn, interval, name)
+        self.__add(task, time.monotonic() + (interval if delay is None else delay))
+        return task
+
+    #
+    # Run fn once, after delay seconds
+    #
+    def After(self, delay, fn, name=None):
+        task = ScheduledTask(self, fn, None, name)
+        self.__add(task, time.monotonic() + delay)
+        return task
+
+    def Cancel(self, task):
+        with self.__condition:
+            task.cancelled = True
+
+    # The tasks that haven't finished or been cancelled
+    @property
+    def Tasks(self):
+        with self.__condition:
+            return [ task for (deadline, n, task) in sorted(self.__heap) if not task.cancelled ]
+
+    #
+    # Stop the scheduler thread.  Tasks that are waiting don't run.
+    #
+    def Close(self):
+        with self.__condition:
+            self.__closed = True
+            self.__condition.notify()
+        self.__thread.join()
+
+    def __add(self, task, deadline):
+        with self.__condition:
+            heapq.heappush(self.__heap, (deadline, next(self.__counter), task))
+            # wake up the thread in case this is now the first deadline
+            self.__condition.notify()
+
+    #
+    # Wait for the next task that is due
+    # returns: (deadline, task), or None when the scheduler is closed
+    #
+    def __next(self):
+        with self.__condition:
+            while not self.__closed:
+                if not self.__heap:
+                    self.__condition.wait()
+                    continue
+                (deadline, n, task) = self.__heap[0]
+                if task.cancelled:
+                    heapq.heappop(self.__heap)
+                    continue
+                now = time.monotonic()
+                if deadline > now:
+                    self.__condition.wait(deadline - now)
+                    continue
+                heapq.heappop(self.__heap)
+                return (deadline, task)
+            return None
+
+    #
+    # This is the main body of the scheduler thread
+    #
+    def worker(self):
+        while True:
+            due = self.__next()
+            if due is None:
+                break
+            (deadline, task) = due
+            task.run(time.monotonic() - deadline)
+            if task.interval is not None:
+                with self.__condition:
+                    if not task.cancelled:
+                        heapq.heappush(self.__heap, (task.nextDeadline(deadline, time.monotonic()), next(self.__counter), task))
+
+#
+# Runs tasks on an asyncio event loop (with loop.call_at), so they can use
+# the loop's objects without locks.  Every, After and Cancel can be called
+# from any thread.
+#
+# loop -- the event loop, default is the loop shared by all servers (see
+#   lib.network.GetEventLoop)
+#
+class AsyncScheduler(object):
+    def __init__(self, loop=None):
+        if loop is None:
+            from lib.network import GetEventLoop
+            loop = GetEventLoop()
+        self.__loop = loop
+        self.__tasks = set()
+
+    def Every(self, interval, fn, name=None, delay=None):
+        task = ScheduledTask(self, fn, interval, name)
+        self.__loop.call_soon_threadsafe(self.__start, task, interval if delay is None else delay)
+        return task
+
+    def After(self, delay, fn, name=None):
+        task = ScheduledTask(self, fn, None, name)
+        self.__loop.call_soon_threadsafe(self.__start, task, delay)
+        return task
+
+    def Cancel(self, task):
+        task.cancelled = True
+        self.__loop.call_soon_threadsafe(self.__cancel, task)
+
+    # The tasks that haven't finished or been cancelled
+    @property
+    def Tasks(self):
+        return [ task for task in list(self.__tasks) if not task.cancelled ]
+
+    def __start(self, task, delay):
+        if task.cancelled:
+            return
+        self.__tasks.add(task)
+        deadline = self.__loop.time() + delay
+        task.handle = self.__loop.call_at(deadline, self.__run, task, deadline)
+
+    def __cancel(self, task):
+        if task.handle is not None:
+            task.handle.cancel()
+        self.__tasks.discard(task)
+
+    def __run(self, task, deadline):
+        if task.cancelled:
+            return
+        task.run(self.__loop.time() - deadline)
+        if task.interval is None or task.cancelled:
+            self.__tasks.discard(task)
+            return
+        deadline = task.nextDeadline(deadline, self.__loop.time())
+        task.handle = self.__loop.call_at(deadline, self.__run, task, deadline)
+
+#
+# All of the periodic tasks share one Scheduler, which is created the
+# first time that it is needed.
+#
+__scheduler = None
+__schedulerLock = threading.Lock()
+
+def GetScheduler():
+    global __scheduler
+    with __schedulerLock:
+        if __scheduler is None:
+            __scheduler = Scheduler()
+        return __scheduler
@@ -0,0 +1,183 @@
+#!/usr/bin/python
+
+# system modules
+import time
+import struct
+import socket
+import select
+
+#
+# Read NMEA 2000 frames straight from a Linux SocketCAN interface, without
+# python-can or python-j1939.
+#
+# Frames are received into one preallocated buffer, as many as are
+# waiting (up to batchSize) per wakeup, and handed to
+# Nmea2000Reader.HandlePacket as (can_id, memoryview) without making any
+# objects for them.  The kernel is given CAN filters for the PGNs that the
+# reader's consumers subscribe to, so frames that no one wants are
+# dropped before they reach Python.
+#
+# This can be tried out on a virtual interface:
+#   ip link add dev vcan0 type vcan && ip link set up vcan0
+#   canplayer vcan0=can0 -I candump.log
+#
+
+# struct can_frame: can_id, length, padding, data
+CAN_FRAME = struct.Struct('=IB3x8s')
+# struct can_filter: can_id, can_mask
+CAN_FILTER = struct.Struct('=II')
+
+CAN_EFF_FLAG = 0x80000000
+CAN_RTR_FLAG = 0x40000000
+CAN_ERR_FLAG = 0x20000000
+CAN_EFF_MASK = 0x1fffffff
+
+# the kernel allows at most this many filters on a socket
+CAN_RAW_FILTER_MAX = 512
+
+# the bits of a CAN identifier that hold the PGN, for PDU1 (PF < 240)
+# PGNs the low byte is the destination and is left out
+PGN_MASK_PDU1 = 0x3ff00 << 8
+PGN_MASK_PDU2 = 0x3ffff << 8
+SOURCE_MASK = 0xff
+
+#
+# Build the kernel filters for a set of PGNs
+#
+# pgns -- dict of pgn to None or a set of source addresses (see
+#   PgnDispatcher.Pgns), or None for everything
+# returns: list of (can_id, can_mask), or None to receive everything
+#
+def CanFilters(pgns):
+    if pgns is None:
+        return None
+    filters = []
+    for (pgn, sources) in sorted(pgns.items()):
+        if ((pgn >> 8) & 0xff) < 240:
+            mask = PGN_MASK_PDU1
+        else:
+            mask = PGN_MASK_PDU2
+        # only match extended frames that aren't remote requests
+        can_id = CAN_EFF_FLAG | ((pgn << 8) & mask)
+        mask |= CAN_EFF_FLAG | CAN_RTR_FLAG
+        if sources is None:
+            filters.append((can_id, mask))
+        else:
+            for source in sorted(sources):
+                filters.append((can_id | source, mask | SOURCE_MASK))
+    # too many filters for the kernel, filter in Python instead
+    if len(filters) > CAN_RAW_FILTER_MAX:
+        return None
+    return filters
+
+#
+# interface -- the SocketCAN interface (such as can0 or vcan0)
+# reader -- the Nmea2000Reader to give frames to
+# batchSize -- the most frames to receive per wakeup
+# receiveBuffer -- size for the socket's kernel receive buffer, or None
+#   to leave it alone.  A bigger buffer rides out longer stalls.
+#
+class SocketCanReader(object):
+    def __init__(self, interface, reader, batchSize=64, receiveBuffer=None):
+        self.__reader = reader
+        self.__batchSize = batchSize
+        self.__buffer = bytearray(batchSize * CAN_FRAME.size)
+        self.__view = memoryview(self.__buffer)
+        self.__frames = 0
+        self.__batches = 0
+        self.__running = False
+
+        self.__socket = socket.socket(socket.AF_CAN, socket.SOCK_RAW, socket.CAN_RAW)
+        if receiveBuffer is not None:
+            self.__socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, receiveBuffer)
+        self.__socket.bind((interface,))
+        self.__socket.setblocking(False)
+        self.UpdateFilters()
+
+    # The number of frames and batches received
+    @property
+    def Frames(self):
+        return self.__frames
+
+    @property
+    def Batches(self):
+        return self.__batches
+
+    # The kernel filters in use, None if every frame is received
+    @property
+    def Filters(self):
+        return self.__filters
+
+    def fileno(self):
+        return self.__socket.fileno()
+
+    #
+    # Set the kernel filters from the reader's subscriptions.  Call this
+    # after Nmea2000Reader.UpdateSubscriptions.
+    #
+    def UpdateFilters(self):
+        filters = CanFilters(self.__reader.Subscriptions())
+        if filters is None:
+            # one filter that matches everything
+            packed = CAN_FILTER.pack(0, 0)
+        else:
+            # no filters at all means no frames
+            packed = b''.join(CAN_FILTER.pack(can_id, mask) for (can_id, mask) in filters)
+        self.__socket.setsockopt(socket.SOL_CAN_RAW, socket.CAN_RAW_FILTER, packed)
+        self.__filters = filters
+
+    #
+    # Wait for frames and give them to the reader
+    #
+    # timeout -- seconds to wait for the first frame, None to wait forever
+    # returns: the number of frames handled
+    #
+    def ReadBatch(self, timeout=None):
+        if not select.select([ self.__socket ], [], [], timeout)[0]:
+            return 0
+
+        # receive everything that is waiting before decoding any of it
+        view = self.__view
+        size = CAN_FRAME.size
+        count = 0
+        for offset in range(0, len(self.__buffer), size):
+            try:
+                n = self.__socket.recv_into(view[offset:offset + size], size)
+            except (BlockingIOError, InterruptedError):
+                break
+            if n < size:
+                break
+            count += 1
+        if count == 0:
+            return 0
+
+        timestamp = time.time()
+        handlePacket = self.__reader.HandlePacket
+        unpack = CAN_FRAME.unpack_from
+        buffer = self.__buffer
+        for offset in range(0, count * size, size):
+            can_id = unpack(buffer, offset)[0]
+            # NMEA 2000 only uses extended data frames
+            if (can_id & (CAN_EFF_FLAG | CAN_RTR_FLAG | CAN_ERR_FLAG)) != CAN_EFF_FLAG:
+                continue
+            length = min(buffer[offset + 4], 8)
+            handlePacket(can_id & CAN_EFF_MASK, view[offset + 8:offset + 8 + length], timestamp)
+
+        self.__frames += count
+        self.__batches += 1
+        return count
+
+    #
+    # Read frames until Stop() is called
+    #
+    def Run(self):
+        self.__running = True
+        while self.__running:
+            self.ReadBatch(0.5)
+
+    def Stop(self):
+        self.__running = False
+
+    def Close(self):
+        self.__running = False
+        self.__socket.close()
@@ -2,7 +2,6 @@
 
 # dependencies
 # pip install python-can==3.3.2
-# pip install quantities
 # python python-j1939/setup.py install (from https://github.com/milhead2/python-j1939)
 
 # system modules
@@ -18,48 +17,61 @@ from pprint import pprint
 import j1939
 
 # local modules
-from lib.RepeatTimer import RepeatTimer
-from lib.nmea2000 import Nmea2000Reader, Nmea2000State, NmeaLogger, PgnPrinter
+from lib.scheduler import GetScheduler
+from lib.nmea2000 import Nmea2000Reader, Nmea2000State, NmeaLogger, PgnPrinter, DecodeCanId
+from lib.logparser import ParseLogBytes, ReadLogFiles
 from lib.nmea0183server import Nmea0183Server
 from lib.network import BroadcastServer
+from lib.jsonformat import JsonFormatter
+from lib.socketcan import SocketCanReader
+from lib.pipeline import Nmea2000Pipeline
 
 # 
 # Output JSON that is compatible with canboat's analyzer.  This is sent over
 # port 10111
 #
-# This is buffered and sent every half second
+# Each record is sent as soon as it is decoded.  If records come in faster
+# than they can be sent then they are sent in batches, and clients that
+# fall too far behind lose the oldest records (see BroadcastServer).
+#
+# By default clients get every PGN.  A client can pick the PGNs that it
+# wants by sending a line with a list of PGNs:
+#   pgns 130306 127250
+# and go back to all PGNs with:
+#   pgns all
 #
 class JsonServer(object):
     #
     # Initialize the server
     #
-    def __init__(self, port=10111, interval=0.5):
-        self.__server = BroadcastServer(port, interval, self.__Transmit, self.__Connect)
-        self.__lock = threading.Lock()
-        self.__sendBuffer = []
-        self.__clientCount = 0
-
-    #
-    # transmit the contents of the send buffer to all clients
+    # loop -- the asyncio event loop for the server, default is the loop
+    #   shared by all servers (see lib.network.GetEventLoop)
+    # maxBuffer -- the most output (in bytes) to buffer for slow clients
     #
-    def __Transmit(self):
-        with self.__lock:
-            output = '\n'.join(self.__sendBuffer) + '\n'
-            self.__sendBuffer = []
-
-        return output
+    def __init__(self, port=10111, loop=None, maxBuffer=262144):
+        self.__formatter = JsonFormatter()
+        self.__server = BroadcastServer(port, None, None, None, maxBuffer=maxBuffer, loop=loop, fnCommand=self.__Command, maxEntries=4096, maxPending=4096)
 
-    # 
-    # __Connect is called by BroadcastServer whenever the number of connected
-    # clients has changed
     #
-    def __Connect(self, clientCount):
-        with self.__lock:
-            self.__clientCount = clientCount
+    # __Command is called by BroadcastServer for each line that a client
+    # sends us
+    #
+    def __Command(self, server, client, line):
+        words = line.split()
+        if len(words) == 0 or words[0] != "pgns":
+            return
+        if len(words) == 1 or words[1] == "all":
+            server.SetTags(client, None)
+        else:
+            try:
+                server.SetTags(client, [int(w) for w in words[1:]])
+            except ValueError:
+                pass
 
     # 
     # ConsumePgn is called as incoming NMEA 2000 PGNs come in.  It reformats
-    # the record as JSON and appends it to the send buffer
+    # the record as JSON (see lib/jsonformat.py) and sends it to the
+    # clients that want it
     #
     # pgn - the PGN related to this record
     # dataRecord - The data that is being shown in the record
@@ -67,48 +79,11 @@ class JsonServer(object):
     #   about this PGN
     #
     def ConsumePgn(self, pgn, dataRecord, pgnRecord):
-        # don't do anything if there aren't any clients
-        #if self.__clientCount == 0:
-        #    return None
-
-        outObject = {}
-        # 2015-04-02-18:23:39.000
-        # TODO -- output milliseconds
-        outObject["timestamp"] = time.strftime("%Y-%m-%d-%H:%M:%S.000")
-        outObject["prio"] = dataRecord["nmea2000:priority"]
-        outObject["src"] = dataRecord["nmea2000:source_address"]
-        outObject["dst"] = dataRecord["nmea2000:destination_address"]
-        outObject["pgn"] = dataRecord["nmea2000:pgn"]
-        outObject["description"] = pgnRecord["Description"]
-        fieldsObject = {}
-
-        for name in dataRecord.keys():
-            if (name.find(':') != -1):
-                continue
-
-            value = dataRecord[name]
-            units = dataRecord[name + ':Units']
-
-            # I can't think in radians, convert those to degrees
-            # convert radians to degrees
-            if units == 'rad':
-                value = ("%.2f" % math.degrees(value))
-
-            if units == 'rad/s':
-                value = ("%.2f" % math.degrees(value))
+        # don't do anything if there aren't any clients for this PGN
+        if not self.__server.Wants(pgn):
+            return None
 
-            if value == None:
-                value = "Unknown"
-
-            # append output 
-            fieldsObject[dataRecord[name + ":LongName"]] = value
-
-        outObject["Fields"] = fieldsObject
-
-        # save output
-        with self.__lock:
-            self.__sendBuffer.append(json.dumps(outObject))
-        #print(json.dumps(outObject))
+        self.__server.Send(self.__formatter.Format(pgn, dataRecord, pgnRecord), pgn)
 
 
 #
@@ -118,14 +93,17 @@ class JsonServer(object):
 class PrintState(object):
     def __init__(self, state):
         self.__state = state
-        self.__timer = RepeatTimer(1, self.worker)
+        self.__task = GetScheduler().Every(1, self.worker, 'PrintState')
 
     def worker(self):
+        snapshot = self.__state.Snapshot()
         print("state dump")
-        unixTime = (self.__state['Time'] + (self.__state['Date'] * 86400)) - 0
-        print("Time: %s" % (time.ctime(int(unixTime))))
-        for v in self.__state.keys():
-            print("%s: %s %s" % (v, self.__state[v], self.__state.GetUnits(v)))
+        # there is no time until the GPS has a fix
+        if snapshot['Time'] is not None and snapshot['Date'] is not None:
+            unixTime = (snapshot['Time'] + (snapshot['Date'] * 86400)) - 0
+            print("Time: %s" % (time.ctime(int(unixTime))))
+        for v in snapshot.keys():
+            print("%s: %s %s" % (v, snapshot[v], self.__state.GetUnits(v)))
 
 #
 # parse NMEA 2000 data and run it through our system
@@ -143,51 +121,59 @@ def parseLog():
     reader = Nmea2000Reader(consumers)
     printState = PrintState(nmea2000state)
 
-    for line in fileinput.input():
-        line = line.rstrip()
-        if not line: continue
-
-        words = line.split()
-        if words[0] == "Rx" or words[0] == "Tx":
-            # parse Raymarine log
-            identifier = int(''.join(words[2:6]), 16)
-            data = bytearray.fromhex(''.join(words[6:]))
-            arbitration_id = j1939.ArbitrationID()
-            arbitration_id.can_id = identifier
-        else:
-            # candump log
-            identifier = int(words[1], 16)
-            data = bytearray.fromhex(''.join(words[3:]))
-
-        arbitration_id = j1939.ArbitrationID()
-        arbitration_id.can_id = identifier
-
-        print("%-3i: pgn=%-6i line=%s" % (arbitration_id.source_address, arbitration_id.pgn.value, line))
-
-        reader.HandlePacket(arbitration_id, data)
-        #time.sleep(0.01)
-
-# parse NMEA 2000 network data from CAN bus
-def parseNetwork():
+    try:
+        for line in ReadLogFiles(sys.argv[1:]):
+            parsed = ParseLogBytes(line)
+            if parsed is None: continue
+            (identifier, data, timestamp) = parsed
+
+            canId = DecodeCanId(identifier)
+            print("%-3i: pgn=%-6i line=%s" % (canId.source_address, canId.pgn, line.decode('ascii', 'ignore')))
+
+            reader.HandlePacket(identifier, data, timestamp)
+            #time.sleep(0.01)
+    finally:
+        # write out whatever the logger has buffered
+        nmealogger.Close()
+
+# parse NMEA 2000 network data from CAN bus.  With an interface the
+# frames are read straight from SocketCAN (lib/socketcan.py) instead of
+# through python-can.
+def parseNetwork(interface=None):
     #json = JsonServer()
-    bus = j1939.Bus()
     nmea2000state = Nmea2000State()
     #nmea0183 = Nmea0183Server(nmea2000state)
     nmealogger = NmeaLogger(nmea2000state)
     consumers = [ nmea2000state, PgnPrinter() ]
-    reader = Nmea2000Reader(consumers)
+    # decode and consume on other threads so that the bus is always read
+    reader = Nmea2000Pipeline(consumers)
     printState = PrintState(nmea2000state)
     try:
-        #t = stopwatch.Timer()
-        for msg in bus:
-            #t.stop()
-            #ms = int(t.elapsed * 10000)
-            #sys.stdout.write(str(ms) + ' ')
-            #sys.stdout.flush()
+        if interface is not None:
+            socketCan = SocketCanReader(interface, reader)
+            try:
+                socketCan.Run()
+            except KeyboardInterrupt:
+                socketCan.Close()
+            return
+
+        bus = j1939.Bus()
+        try:
             #t = stopwatch.Timer()
-            reader.HandlePacket(msg.arbitration_id, msg.data)
-    except KeyboardInterrupt:
-        bus.shutdown()
+            for msg in bus:
+                #t.stop()
+                #ms = int(t.elapsed * 10000)
+                #sys.stdout.write(str(ms) + ' ')
+                #sys.stdout.flush()
+                #t = stopwatch.Timer()
+                reader.HandlePacket(msg.arbitration_id, msg.data)
+        except KeyboardInterrupt:
+            bus.shutdown()
+    finally:
+        # finish decoding what was received, then write out whatever the
+        # logger has buffered
+        reader.Close()
+        nmealogger.Close()
 
 if len(sys.argv) < 2:
     pathname = os.path.dirname(sys.argv[0])        
@@ -195,6 +181,12 @@ if len(sys.argv) < 2:
     print("starting in %s" % fullpath)
     os.chdir(fullpath)
     parseNetwork()
+elif sys.argv[1].startswith("--socketcan"):
+    # --socketcan or --socketcan=vcan0
+    interface = 'can0'
+    if '=' in sys.argv[1]:
+        interface = sys.argv[1].split('=')[1]
+    parseNetwork(interface)
 else:
     print("parselog");
     parseLog()
@@ -0,0 +1,78 @@
+#!/usr/bin/python
+
+# system modules
+import math
+import unittest
+
+#
+# Tests for the derived channels in lib/derived.py
+#
+
+# local modules
+from lib.derived import trueWind, WIND_TRUE_NORTH, WIND_MAGNETIC_NORTH, WIND_APPARENT, WIND_TRUE_BOAT, WIND_TRUE_WATER
+
+#
+# State for trueWind: heading 90 degrees true, 10 degrees east variation
+# and 3 m/s through the water
+#
+def windState(reference, angle, speed):
+    return {
+        'WindAngle': angle,
+        'WindSpeed': speed,
+        'WindReference': reference,
+        'SpeedThroughWater': 3.0,
+        'Heading': math.radians(90),
+        'HeadingReference': 'True',
+        'Variation': math.radians(10),
+    }
+
+class TrueWindTest(unittest.TestCase):
+    def assertAngle(self, value, degrees):
+        self.assertIsNotNone(value)
+        self.assertAlmostEqual(math.degrees(value) % 360, degrees)
+
+    def testTrueNorth(self):
+        # passed through, already a direction
+        out = trueWind(windState(WIND_TRUE_NORTH, math.radians(45), 8.0))
+        self.assertAngle(out['TrueWindDirection'], 45)
+        self.assertAngle(out['MagneticWindDirection'], 35)
+        self.assertEqual(out['TrueWindSpeed'], 8.0)
+        self.assertIsNone(out['TrueWindAngle'])
+
+    def testMagneticNorth(self):
+        out = trueWind(windState(WIND_MAGNETIC_NORTH, math.radians(45), 8.0))
+        self.assertAngle(out['MagneticWindDirection'], 45)
+        self.assertAngle(out['TrueWindDirection'], 55)
+        self.assertEqual(out['TrueWindSpeed'], 8.0)
+        self.assertIsNone(out['TrueWindAngle'])
+
+    def testApparent(self):
+        # 5 m/s apparent at 53 degrees: 3 m/s of it is the boat moving,
+        # so the true wind is 4 m/s on the beam
+        out = trueWind(windState(WIND_APPARENT, math.atan2(4, 3), 5.0))
+        self.assertAngle(out['TrueWindAngle'], 90)
+        self.assertAlmostEqual(out['TrueWindSpeed'], 4.0)
+        self.assertAngle(out['TrueWindDirection'], 180)
+        self.assertAngle(out['MagneticWindDirection'], 170)
+
+    def testTrueBoat(self):
+        # an angle off the bow, turned into a direction with the heading
+        out = trueWind(windState(WIND_TRUE_BOAT, math.radians(30), 6.0))
+        self.assertAngle(out['TrueWindAngle'], 30)
+        self.assertEqual(out['TrueWindSpeed'], 6.0)
+        self.assertAngle(out['TrueWindDirection'], 120)
+        self.assertAngle(out['MagneticWindDirection'], 110)
+
+    def testTrueWater(self):
+        out = trueWind(windState(WIND_TRUE_WATER, math.radians(330), 6.0))
+        self.assertAngle(out['TrueWindAngle'], 330)
+        self.assertEqual(out['TrueWindSpeed'], 6.0)
+        self.assertAngle(out['TrueWindDirection'], 60)
+
+    def testUnknownReference(self):
+        for reference in [ None, 'True', 'Unknown' ]:
+            out = trueWind(windState(reference, math.radians(30), 6.0))
+            self.assertEqual(set(out.values()), set([None]))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,150 @@
+#!/usr/bin/python
+
+# system modules
+import os
+import json
+import shutil
+import random
+import tempfile
+import unittest
+
+#
+# Tests for lib/encoder.py.  Records for every PGN in pgns-test.json are
+# encoded, decoded again with Nmea2000Reader and compared with what was
+# encoded.
+#
+
+# local modules
+from lib.nmea2000 import Nmea2000Reader, GetPgnTable, DecodeCanId
+from lib.encoder import Nmea2000Encoder, FastPacketFrames, compileEncodePlan
+
+SOURCE = 0x23
+TRIALS = 50
+
+#
+# The tests run in a temporary directory with pgns-test.json as
+# pgns.json, so that GetPgnTable() (and its cache) uses it
+#
+fixtureDirectory = None
+savedDirectory = None
+
+def setUpModule():
+    global fixtureDirectory, savedDirectory
+    fixtureDirectory = tempfile.mkdtemp()
+    shutil.copy(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pgns-test.json'),
+        os.path.join(fixtureDirectory, 'pgns.json'))
+    savedDirectory = os.getcwd()
+    os.chdir(fixtureDirectory)
+
+def tearDownModule():
+    os.chdir(savedDirectory)
+    shutil.rmtree(fixtureDirectory)
+
+class RecordConsumer(object):
+    def __init__(self):
+        self.records = []
+
+    def ConsumePgn(self, pgn, dataRecord, pgnRecord):
+        self.records.append(dataRecord)
+
+    def Subscriptions(self):
+        return None
+
+#
+# Random values for every field of a PGN, in the form that decode gives
+# them back.  Some are left out, which is unknown.
+#
+def randomValues(generator, plan):
+    values = {}
+    for f in plan.fields:
+        if generator.random() < 0.1:
+            values[f.name] = None
+        elif f.text:
+            values[f.name] = ''.join(generator.choice('ABC xyz09') for i in range(generator.randint(1, f.bitLength // 8)))
+        elif f.enumCodes:
+            values[f.name] = generator.choice(sorted(f.enumCodes))
+        else:
+            raw = generator.randint(f.low, f.high)
+            while raw == f.unknownValue:
+                raw = generator.randint(f.low, f.high)
+            values[f.name] = raw if f.resolution is None else raw * f.resolution
+    return values
+
+class EncoderTest(unittest.TestCase):
+    def setUp(self):
+        self.encoder = Nmea2000Encoder(SOURCE)
+        self.consumer = RecordConsumer()
+        self.reader = Nmea2000Reader([ self.consumer ])
+        with open('pgns.json') as f:
+            self.pgns = sorted(set(p['PGN'] for p in json.load(f)['PGNs']))
+
+    # encode, send through the reader and return the one record
+    def roundTrip(self, pgn, values):
+        del self.consumer.records[:]
+        for (can_id, data) in self.encoder.Frames(pgn, values):
+            self.assertEqual(DecodeCanId(can_id).pgn, pgn)
+            self.assertEqual(DecodeCanId(can_id).source_address, SOURCE)
+            self.reader.HandlePacket(can_id, data, 1.0)
+        self.assertEqual(len(self.consumer.records), 1)
+        return self.consumer.records[0]
+
+    def testRoundTrip(self):
+        generator = random.Random(4)
+        table = GetPgnTable()
+        fastPackets = 0
+        for pgn in self.pgns:
+            plan = compileEncodePlan(table.GetDecodePlan(pgn))
+            fastPackets += plan.fastPacket
+            for trial in range(TRIALS):
+                values = randomValues(generator, plan)
+                record = self.roundTrip(pgn, values)
+                for f in plan.fields:
+                    expected = values[f.name]
+                    # unknown text is all padding, which decodes as empty
+                    if f.text and expected is None:
+                        expected = ''
+                    self.assertEqual(record.GetValue(f.name), expected, (pgn, f.name))
+                # and the record encodes back to the same payload
+                self.assertEqual(self.encoder.Encode(pgn, record), self.encoder.Encode(pgn, values))
+        # the fixture has both kinds
+        self.assertGreater(fastPackets, 0)
+        self.assertLess(fastPackets, len(self.pgns))
+
+    def testSingleFrame(self):
+        frames = self.encoder.Frames(130306, { 'WindSpeed': 5.0, 'WindAngle': 1.0, 'Reference': 'Apparent' })
+        self.assertEqual(len(frames), 1)
+        self.assertEqual(len(frames[0][1]), 8)
+        record = self.roundTrip(130306, { 'WindSpeed': 5.0, 'WindAngle': 1.0, 'Reference': 'Apparent' })
+        self.assertEqual(record.GetValue('Reference'), 'Apparent')
+        self.assertAlmostEqual(record.GetValue('WindAngle'), 1.0, places=4)
+
+    def testFastPacketSequence(self):
+        # each message of a fast packet PGN gets the next sequence counter
+        sequences = [ self.encoder.Frames(129029, {})[0][1][0] >> 5 for i in range(10) ]
+        self.assertEqual(sequences, [ i % 8 for i in range(10) ])
+
+    def testFastPacketFrames(self):
+        payload = bytes(range(20))
+        frames = FastPacketFrames(payload, 5)
+        self.assertEqual(frames, [
+            bytes([ 0xa0, 20, 0, 1, 2, 3, 4, 5 ]),
+            bytes([ 0xa1, 6, 7, 8, 9, 10, 11, 12 ]),
+            bytes([ 0xa2, 13, 14, 15, 16, 17, 18, 19 ]),
+        ])
+        # the last frame is padded
+        self.assertEqual(FastPacketFrames(payload[0:7], 0)[-1], bytes([ 0x01, 6, 0xff, 0xff, 0xff, 0xff, 0xff, 0xff ]))
+        with self.assertRaises(ValueError):
+            FastPacketFrames(bytes(224), 0)
+
+    def testBadValues(self):
+        with self.assertRaises(ValueError):
+            self.encoder.Encode(130306, { 'Reference': 'Sideways' })
+        with self.assertRaises(ValueError):
+            self.encoder.Encode(128267, { 'Depth': -1.0 })
+        with self.assertRaises(ValueError):
+            self.encoder.Encode(129794, { 'Callsign': 'TOOLONGCALLSIGN' })
+        with self.assertRaises(KeyError):
+            self.encoder.Encode(1, {})
+
+if __name__ == '__main__':
+    unittest.main()
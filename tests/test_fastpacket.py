@@ -0,0 +1,199 @@
+#!/usr/bin/python
+
+# system modules
+import os
+import shutil
+import random
+import tempfile
+import unittest
+
+#
+# Tests for fast packet reassembly (PacketState and FastPacket in
+# lib/nmea2000.py).  Messages are built with the encoder from the PGNs
+# in pgns-test.json, split with FastPacketFrames and checked by encoding
+# the decoded records again.
+#
+
+# local modules
+from lib.nmea2000 import Nmea2000Reader, PacketState, GetPgnTable, DecodeCanId, EncodeCanId
+from lib.encoder import Nmea2000Encoder, FastPacketFrames
+
+GNSS_PGN = 129029
+AIS_PGN = 129038
+SOURCE = 0x23
+
+#
+# The tests run in a temporary directory with pgns-test.json as
+# pgns.json, so that GetPgnTable() (and its cache) uses it
+#
+fixtureDirectory = None
+savedDirectory = None
+
+def setUpModule():
+    global fixtureDirectory, savedDirectory
+    fixtureDirectory = tempfile.mkdtemp()
+    shutil.copy(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pgns-test.json'),
+        os.path.join(fixtureDirectory, 'pgns.json'))
+    savedDirectory = os.getcwd()
+    os.chdir(fixtureDirectory)
+
+def tearDownModule():
+    os.chdir(savedDirectory)
+    shutil.rmtree(fixtureDirectory)
+
+#
+# Keeps every record it is given, without looking at them
+#
+class RecordConsumer(object):
+    def __init__(self):
+        self.records = []
+
+    def ConsumePgn(self, pgn, dataRecord, pgnRecord):
+        self.records.append(dataRecord)
+
+    def Subscriptions(self):
+        return None
+
+class FastPacketTest(unittest.TestCase):
+    def setUp(self):
+        self.encoder = Nmea2000Encoder(SOURCE)
+        self.consumer = RecordConsumer()
+
+    # a GNSS position payload, n makes it different from the others
+    def gnssPayload(self, n):
+        return self.encoder.Encode(GNSS_PGN, { 'Latitude': 47.0 + n * 0.001, 'Longitude': -122.0, 'NumberofSVs': n })
+
+    def aisPayload(self, n):
+        return self.encoder.Encode(AIS_PGN, { 'UserID': 316000000 + n, 'Longitude': -123.5, 'Latitude': 48.25 })
+
+    # (CanId, frame) for each frame of a payload
+    def frames(self, pgn, payload, sequence, source=SOURCE):
+        canId = DecodeCanId(EncodeCanId(pgn, source))
+        return [ (canId, frame) for frame in FastPacketFrames(payload, sequence) ]
+
+    def packetState(self, **kwargs):
+        return PacketState(GetPgnTable(), SOURCE, [ self.consumer ], **kwargs)
+
+    # the payloads that were received, encoded again from the records
+    def received(self):
+        return [ (r.pgn, self.encoder.Encode(r.pgn, r)) for r in self.consumer.records ]
+
+    def testInOrder(self):
+        state = self.packetState()
+        payload = self.gnssPayload(1)
+        frames = self.frames(GNSS_PGN, payload, 0)
+        self.assertGreater(len(frames), 2)
+        for (canId, frame) in frames:
+            state.ProcessPacket(canId, frame, 1.0)
+        self.assertEqual(self.received(), [ (GNSS_PGN, payload) ])
+        self.assertEqual(self.consumer.records[0].GetValue('NumberofSVs'), 1)
+
+    def testOutOfOrder(self):
+        generator = random.Random(3)
+        state = self.packetState()
+        payloads = []
+        for n in range(20):
+            payload = self.gnssPayload(n)
+            frames = self.frames(GNSS_PGN, payload, n % 8)
+            generator.shuffle(frames)
+            for (canId, frame) in frames:
+                state.ProcessPacket(canId, frame, 1.0)
+            payloads.append((GNSS_PGN, payload))
+        self.assertEqual(self.received(), payloads)
+
+    def testInterleaved(self):
+        # two PGNs and two sequences of one of them, one frame from each
+        # in turn
+        state = self.packetState()
+        messages = [
+            self.frames(GNSS_PGN, self.gnssPayload(1), 0),
+            self.frames(AIS_PGN, self.aisPayload(1), 0),
+            self.frames(GNSS_PGN, self.gnssPayload(2), 1),
+        ]
+        for i in range(max(len(m) for m in messages)):
+            for m in messages:
+                if i < len(m):
+                    state.ProcessPacket(m[i][0], m[i][1], 1.0)
+        self.assertEqual(sorted(self.received()), sorted([
+            (GNSS_PGN, self.gnssPayload(1)),
+            (AIS_PGN, self.aisPayload(1)),
+            (GNSS_PGN, self.gnssPayload(2)),
+        ]))
+        self.assertEqual(len(self.consumer.records), 3)
+
+    def testInterleavedSources(self):
+        # the same PGN and sequence from two sources
+        reader = Nmea2000Reader([ self.consumer ])
+        first = [ (canId.can_id, frame) for (canId, frame) in self.frames(GNSS_PGN, self.gnssPayload(1), 0, 0x10) ]
+        second = [ (canId.can_id, frame) for (canId, frame) in self.frames(GNSS_PGN, self.gnssPayload(2), 0, 0x11) ]
+        for (a, b) in zip(first, second):
+            reader.HandlePacket(a[0], a[1], 1.0)
+            reader.HandlePacket(b[0], b[1], 1.0)
+        self.assertEqual([ (r.source_address, self.encoder.Encode(GNSS_PGN, r)) for r in self.consumer.records ],
+            [ (0x10, self.gnssPayload(1)), (0x11, self.gnssPayload(2)) ])
+        self.assertEqual(reader.Statistics.completed, 2)
+
+    def testRepeatedFrame(self):
+        # a new message with the same sequence before the old one is done
+        # starts over
+        state = self.packetState()
+        stale = self.frames(GNSS_PGN, self.gnssPayload(1), 0)
+        state.ProcessPacket(stale[0][0], stale[0][1], 1.0)
+        state.ProcessPacket(stale[1][0], stale[1][1], 1.0)
+        for (canId, frame) in self.frames(GNSS_PGN, self.gnssPayload(2), 0):
+            state.ProcessPacket(canId, frame, 1.0)
+        self.assertEqual(self.received(), [ (GNSS_PGN, self.gnssPayload(2)) ])
+
+    def testTimeout(self):
+        state = self.packetState(timeout=1.0)
+        frames = self.frames(GNSS_PGN, self.gnssPayload(1), 0)
+        state.ProcessPacket(frames[0][0], frames[0][1], 10.0)
+        # the rest are too late, the message is thrown away
+        for (canId, frame) in frames[1:]:
+            state.ProcessPacket(canId, frame, 11.5)
+        self.assertEqual(self.consumer.records, [])
+
+        # but a message that is finished within the timeout is fine
+        frames = self.frames(GNSS_PGN, self.gnssPayload(2), 1)
+        for (i, (canId, frame)) in enumerate(frames):
+            state.ProcessPacket(canId, frame, 20.0 + i * 0.1)
+        self.assertEqual(self.received(), [ (GNSS_PGN, self.gnssPayload(2)) ])
+
+    def testSlotLimit(self):
+        # start one more message than there are slots, the oldest is
+        # dropped and the rest still complete
+        state = self.packetState(maxSlots=3)
+        messages = [ self.frames(GNSS_PGN, self.gnssPayload(n), n) for n in range(4) ]
+        for (n, m) in enumerate(messages):
+            state.ProcessPacket(m[0][0], m[0][1], 1.0 + n * 0.01)
+        for m in messages[1:]:
+            for (canId, frame) in m[1:]:
+                state.ProcessPacket(canId, frame, 1.1)
+        self.assertEqual(self.received(), [ (GNSS_PGN, self.gnssPayload(n)) for n in range(1, 4) ])
+        # the rest of the dropped message never completes
+        for (canId, frame) in messages[0][1:]:
+            state.ProcessPacket(canId, frame, 1.2)
+        self.assertEqual(len(self.consumer.records), 3)
+
+    def testStatistics(self):
+        reader = Nmea2000Reader([ self.consumer ])
+        frames = self.frames(GNSS_PGN, self.gnssPayload(1), 0)
+        for (canId, frame) in frames[0:2]:
+            reader.HandlePacket(canId.can_id, frame, 1.0)
+        for (canId, frame) in frames:
+            reader.HandlePacket(canId.can_id, frame, 5.0)
+        statistics = reader.Statistics
+        self.assertEqual((statistics.completed, statistics.dropped, statistics.expired), (1, 0, 1))
+
+    def testBufferReuse(self):
+        # records keep their data after the reassembly buffer is reused,
+        # even if nothing was decoded before then
+        state = self.packetState()
+        for n in range(10):
+            for (canId, frame) in self.frames(GNSS_PGN, self.gnssPayload(n), 0):
+                state.ProcessPacket(canId, frame, 1.0)
+        self.assertEqual([ r.GetValue('NumberofSVs') for r in self.consumer.records ], list(range(10)))
+        self.assertEqual(self.received(), [ (GNSS_PGN, self.gnssPayload(n)) for n in range(10) ])
+
+if __name__ == '__main__':
+    unittest.main()
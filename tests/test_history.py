@@ -0,0 +1,135 @@
+#!/usr/bin/python
+
+# system modules
+import math
+import random
+import unittest
+
+#
+# Tests for lib/history.py.  The running aggregates are checked against
+# the same aggregates worked out from a plain list of the samples.
+#
+
+# local modules
+from lib.history import History
+
+#
+# The (timestamp, value) samples that History should have, and the ones
+# in its running window
+#
+def expectedSamples(samples, capacity, window):
+    kept = samples[-capacity:]
+    latest = samples[-1][0]
+    return (kept, [ (t, v) for (t, v) in kept if t > latest - window ])
+
+def circularMean(values):
+    s = math.fsum(math.sin(v) for v in values)
+    c = math.fsum(math.cos(v) for v in values)
+    return math.atan2(s, c) % (2 * math.pi)
+
+class HistoryTest(unittest.TestCase):
+    def assertAggregates(self, history, samples, capacity, window):
+        (kept, inWindow) = expectedSamples(samples, capacity, window)
+        values = [ v for (t, v) in inWindow ]
+        self.assertEqual(len(history), len(kept))
+        self.assertEqual(history.WindowCount, len(inWindow))
+        self.assertEqual(history.Latest, samples[-1])
+        self.assertAlmostEqual(history.Mean(), math.fsum(values) / len(values))
+        self.assertEqual(history.Min(), min(values))
+        self.assertEqual(history.Max(), max(values))
+
+    def testBadWindow(self):
+        for window in [ 0, -1.0 ]:
+            with self.assertRaises(ValueError):
+                History(window=window)
+
+    def testEmpty(self):
+        history = History(8, 10.0)
+        self.assertEqual(len(history), 0)
+        self.assertIsNone(history.Latest)
+        self.assertIsNone(history.Mean())
+        self.assertIsNone(history.Min())
+        self.assertIsNone(history.Max())
+        self.assertIsNone(history.CircularMean())
+        self.assertIsNone(history.Mean(5.0))
+
+    def testWraparound(self):
+        history = History(4, 100.0)
+        for i in range(10):
+            history.Append(float(i), float(i * 10))
+        self.assertEqual(len(history), 4)
+        (timestamps, values) = history.Arrays()
+        self.assertEqual(timestamps.tolist(), [ 6.0, 7.0, 8.0, 9.0 ])
+        self.assertEqual(values.tolist(), [ 60.0, 70.0, 80.0, 90.0 ])
+        # the overwritten samples left the window
+        self.assertEqual(history.WindowCount, 4)
+        self.assertEqual(history.Min(), 60.0)
+        self.assertEqual(history.Mean(), 75.0)
+
+    def testWindowEviction(self):
+        history = History(100, 2.5)
+        for i in range(10):
+            history.Append(float(i), float(i))
+        # samples more than 2.5 seconds older than the newest are gone
+        self.assertEqual(history.WindowCount, 3)
+        self.assertEqual(history.Min(), 7.0)
+        self.assertEqual(history.Max(), 9.0)
+        self.assertEqual(history.Mean(), 8.0)
+        # but are still stored, and used for other windows
+        self.assertEqual(len(history), 10)
+        self.assertEqual(history.Min(5.5), 4.0)
+        self.assertEqual(history.Mean(100.0), 4.5)
+
+    def testGap(self):
+        # a gap longer than the window leaves only the newest sample
+        history = History(16, 5.0)
+        for i in range(5):
+            history.Append(float(i), 1.0)
+        history.Append(100.0, 2.0)
+        self.assertEqual(history.WindowCount, 1)
+        self.assertEqual(history.Min(), 2.0)
+        self.assertEqual(history.Max(), 2.0)
+        self.assertEqual(history.Mean(), 2.0)
+
+    def testRandom(self):
+        # uneven timestamps, repeated values and both limits, past
+        # several resums
+        generator = random.Random(1)
+        for (capacity, window) in [ (8, 3.0), (32, 1000.0), (50, 2.0) ]:
+            history = History(capacity, window)
+            samples = []
+            timestamp = 0.0
+            for i in range(500):
+                timestamp += generator.choice([ 0.0, 0.1, 0.5, 1.0, 4.0 ])
+                value = float(generator.randint(-5, 5))
+                history.Append(timestamp, value)
+                samples.append((timestamp, value))
+                self.assertAggregates(history, samples, capacity, window)
+
+    def testCircularMean(self):
+        history = History(16, 10.0, angle=True)
+        history.Append(0.0, math.radians(350))
+        history.Append(1.0, math.radians(10))
+        self.assertAlmostEqual(math.cos(history.CircularMean()), 1.0)
+        self.assertAlmostEqual(math.sin(history.CircularMean()), 0.0)
+        # the plain mean is on the wrong side
+        self.assertAlmostEqual(history.Mean(), math.radians(180))
+
+    def testRunningCircularMean(self):
+        generator = random.Random(2)
+        history = History(20, 5.0, angle=True)
+        samples = []
+        for i in range(300):
+            sample = (i * 0.5, generator.uniform(0, 2 * math.pi))
+            history.Append(*sample)
+            samples.append(sample)
+            (kept, inWindow) = expectedSamples(samples, 20, 5.0)
+            expected = circularMean([ v for (t, v) in inWindow ])
+            self.assertAlmostEqual(math.cos(history.CircularMean()), math.cos(expected))
+            self.assertAlmostEqual(math.sin(history.CircularMean()), math.sin(expected))
+            # a different window is worked out from the samples
+            expected = circularMean([ v for (t, v) in kept if t > sample[0] - 2.0 ])
+            self.assertAlmostEqual(history.CircularMean(2.0), expected)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,231 @@
+#!/usr/bin/python
+
+# system modules
+import time
+import random
+import socket
+import asyncio
+import threading
+import unittest
+from unittest import mock
+
+#
+# Tests for lib/network.py.  The servers run on their own event loop and
+# are read by ordinary sockets from the test thread.
+#
+
+# local modules
+from lib import network
+from lib.network import BroadcastRing, BroadcastServer, BroadcastClient
+
+TIMEOUT = 10.0
+
+# a port that nothing is listening on
+def freePort():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+#
+# Wraps a client socket on the server side so that each sendmsg only
+# takes a few bytes, usually stopping part way through a buffer.  While
+# stalled nothing is taken at all, without throttle sendmsg is left
+# alone.
+#
+class ThrottledSocket(object):
+    def __init__(self, sock, generator):
+        self.sock = sock
+        self.generator = generator
+        self.stalled = False
+        self.throttle = True
+        self.partial = 0
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+    def sendmsg(self, buffers):
+        if self.stalled:
+            raise BlockingIOError()
+        if not self.throttle:
+            return self.sock.sendmsg(buffers)
+        data = b''.join(bytes(b) for b in buffers)
+        sent = self.sock.send(data[0:self.generator.randint(1, 64)])
+        if sent < len(data):
+            self.partial += 1
+        return sent
+
+class BroadcastRingTest(unittest.TestCase):
+    def testGet(self):
+        ring = BroadcastRing(1000, 4)
+        for i in range(3):
+            ring.Append(b'%i' % i)
+        (buffers, sequences, end) = ring.Get(1, 10)
+        self.assertEqual(buffers, [ b'1', b'2' ])
+        self.assertEqual(list(sequences), [ 1, 2 ])
+        self.assertEqual(end, 3)
+
+    def testEntryLimit(self):
+        ring = BroadcastRing(1000, 4)
+        for i in range(10):
+            ring.Append(b'%i' % i)
+        self.assertEqual((ring.First, ring.Next, len(ring)), (6, 10, 4))
+        self.assertEqual(ring.Get(ring.First, 10)[0], [ b'6', b'7', b'8', b'9' ])
+
+    def testByteLimit(self):
+        ring = BroadcastRing(10, 16)
+        for i in range(10):
+            ring.Append(b'abcd')
+        self.assertEqual((len(ring), ring.Bytes), (2, 8))
+        # the newest output is always kept, even if it is too big
+        ring.Append(b'x' * 100)
+        self.assertEqual((len(ring), ring.Bytes), (1, 100))
+
+    def testTags(self):
+        ring = BroadcastRing(1000)
+        ring.Append(b'a', 1)
+        ring.Append(b'b', 2)
+        ring.Append(b'c')
+        ring.Append(b'd', 1)
+        (buffers, sequences, end) = ring.Get(0, 10, set([ 1 ]))
+        self.assertEqual(buffers, [ b'a', b'c', b'd' ])
+        self.assertEqual(sequences, [ 0, 2, 3 ])
+        self.assertEqual(ring.Get(0, 2, set([ 1 ]))[2], 3)
+
+class BroadcastServerTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.port = freePort()
+        self.generator = random.Random(5)
+        self.sockets = []
+        self.connected = []
+        self.servers = []
+        self.clients = []
+
+    def tearDown(self):
+        for client in self.clients:
+            client.close()
+        for server in self.servers:
+            server.Close()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+    # a BroadcastClient with a ThrottledSocket
+    def throttledClient(self, sock, address, sequence):
+        sock = ThrottledSocket(sock, self.generator)
+        self.sockets.append(sock)
+        return BroadcastClient(sock, address, sequence)
+
+    def startServer(self, **kwargs):
+        server = BroadcastServer(self.port, None, None, self.connected.append, loop=self.loop, **kwargs)
+        self.servers.append(server)
+        return server
+
+    # connect to the server and wait for it to take the connection
+    def connect(self, server):
+        client = socket.create_connection(('127.0.0.1', self.port))
+        client.settimeout(TIMEOUT)
+        self.clients.append(client)
+        self.waitFor(lambda: server.ClientCount == len(self.clients))
+        return client
+
+    def waitFor(self, condition):
+        deadline = time.monotonic() + TIMEOUT
+        while not condition():
+            self.assertLess(time.monotonic(), deadline, "timed out")
+            time.sleep(0.01)
+
+    # read until the data ends with end, slowly
+    def readUntil(self, client, end):
+        data = bytearray()
+        while not data.endswith(end):
+            chunk = client.recv(self.generator.randint(1, 512))
+            if not chunk:
+                break
+            data.extend(chunk)
+            if self.generator.random() < 0.05:
+                time.sleep(0.001)
+        return bytes(data)
+
+    def lines(self, first, last):
+        return [ b'line %i %s\n' % (i, b'x' * (i % 37)) for i in range(first, last) ]
+
+    def testPartialWrites(self):
+        # every output has to arrive once, in order, even though each
+        # send only takes part of it
+        with mock.patch.object(network, 'BroadcastClient', self.throttledClient):
+            server = self.startServer(maxBuffer=1 << 20, maxEntries=4096, maxPending=4096)
+            clients = [ self.connect(server) for i in range(3) ]
+        lines = self.lines(0, 2000)
+        for line in lines:
+            server.Send(line)
+        for client in clients:
+            self.assertEqual(self.readUntil(client, lines[-1]), b''.join(lines))
+        self.assertGreater(min(s.partial for s in self.sockets), 100)
+        self.assertEqual(server.Dropped, 0)
+
+    def testPartialWritesWithTags(self):
+        with mock.patch.object(network, 'BroadcastClient', self.throttledClient):
+            server = self.startServer(maxBuffer=1 << 20, maxEntries=4096, maxPending=4096,
+                fnCommand=lambda server, client, line: server.SetTags(client, [ int(line) ]))
+            client = self.connect(server)
+        client.sendall(b'1\n')
+        self.waitFor(lambda: server.Wants(1) and not server.Wants(2))
+        lines = self.lines(0, 1000)
+        for (i, line) in enumerate(lines):
+            server.Send(line, 1 + i % 2)
+        self.assertEqual(self.readUntil(client, lines[-2]), b''.join(lines[0::2]))
+
+    # read until the server closes the connection
+    def readAll(self, client):
+        data = bytearray()
+        while True:
+            chunk = client.recv(4096)
+            if not chunk:
+                return bytes(data)
+            data.extend(chunk)
+
+    def testDropOldest(self):
+        # a client that stops reading skips ahead to the oldest output
+        # still in the ring, and only loses whole outputs
+        with mock.patch.object(network, 'BroadcastClient', self.throttledClient):
+            server = self.startServer(maxBuffer=2048, overflow=network.OVERFLOW_DROP_OLDEST)
+            client = self.connect(server)
+        self.sockets[0].stalled = True
+        lines = self.lines(0, 1000)
+        for line in lines:
+            server.Send(line)
+        self.waitFor(lambda: server.Dropped > 0)
+        self.sockets[0].stalled = False
+        server.Send(b'end\n')
+
+        received = self.readUntil(client, b'end\n').splitlines(True)[:-1]
+        self.assertEqual(received[-1], lines[-1])
+        self.assertEqual(len(received), len(lines) - server.Dropped)
+        # in order, no duplicates and nothing cut off
+        numbers = [ int(line.split()[1]) for line in received ]
+        self.assertEqual(numbers, sorted(set(numbers)))
+        self.assertEqual(received, [ lines[n] for n in numbers ])
+        self.assertEqual(server.ClientCount, 1)
+
+    def testDisconnect(self):
+        # a client that stops reading is disconnected, the others carry on
+        with mock.patch.object(network, 'BroadcastClient', self.throttledClient):
+            server = self.startServer(maxBuffer=2048, overflow=network.OVERFLOW_DISCONNECT)
+            stalled = self.connect(server)
+            client = self.connect(server)
+        self.sockets[0].stalled = True
+        self.sockets[1].throttle = False
+        lines = self.lines(0, 1000)
+        for line in lines:
+            server.Send(line)
+        self.waitFor(lambda: server.ClientCount == 1)
+        self.assertEqual(self.connected[-1], 1)
+        self.assertEqual(self.readAll(stalled), b'')
+        self.assertEqual(self.readUntil(client, lines[-1]), b''.join(lines))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+#!/usr/bin/python
+
+# system modules
+import math
+import operator
+import unittest
+
+#
+# Tests for the NMEA 0183 field formatters in lib/nmea0183server.py
+#
+
+# local modules
+from lib.nmea0183server import formatLatitude, formatLongitude, formatTime, Nmea0183Sentence, checksum
+
+class FormatterTest(unittest.TestCase):
+    def testLatitude(self):
+        self.assertEqual(formatLatitude(47.5), "4730.0000,N")
+        self.assertEqual(formatLatitude(-0.5), "0030.0000,S")
+        self.assertEqual(formatLatitude(12.345678), "1220.7407,N")
+
+    def testLatitudeCarry(self):
+        # 59.99996 minutes rounds to 60.0000, which is the next degree
+        self.assertEqual(formatLatitude(47 + 59.99996 / 60), "4800.0000,N")
+        self.assertEqual(formatLatitude(-(47 + 59.99996 / 60)), "4800.0000,S")
+        self.assertEqual(formatLatitude(47 + 59.99994 / 60), "4759.9999,N")
+
+    def testLongitude(self):
+        self.assertEqual(formatLongitude(-122.25), "12215.0000,W")
+        self.assertEqual(formatLongitude(8.5), "00830.0000,E")
+
+    def testLongitudeCarry(self):
+        self.assertEqual(formatLongitude(-(122 + 59.99996 / 60)), "12300.0000,W")
+        self.assertEqual(formatLongitude(179 + 59.99996 / 60), "18000.0000,E")
+
+    def testTime(self):
+        self.assertEqual(formatTime(0), "000000.00")
+        self.assertEqual(formatTime(12 * 3600 + 34 * 60 + 56.789), "123456.79")
+
+    def testTimeCarry(self):
+        # 59.996 seconds rounds to 60.00, which is the next minute
+        self.assertEqual(formatTime(59.996), "000100.00")
+        self.assertEqual(formatTime(3599.996), "010000.00")
+        self.assertEqual(formatTime(59.994), "000059.99")
+        # and the last moment of the day is midnight
+        self.assertEqual(formatTime(86399.996), "000000.00")
+
+# the GPRMC template from Nmea0183Server
+GPRMC = 'GPRMC,{hhmmss,Time},{valid,Latitude},{lat,Latitude},{lon,Longitude},{%.1f,SOG,knots},{%.1f,COG,deg},{ddmmyy,Date},{ew,Variation,deg},{mode,Latitude}'
+
+UNITS = { 'SOG': 'm/s', 'COG': 'rad', 'Variation': 'rad' }
+
+class SentenceTest(unittest.TestCase):
+    def format(self, template, snapshot):
+        sentence = Nmea0183Sentence(template, operator.itemgetter, UNITS.get, 10)
+        out = sentence.Format(snapshot)
+        # the checksum covers everything between $ and *
+        (body, c) = out[1:].rstrip('\r\n').split('*')
+        self.assertEqual(int(c, 16), checksum(body))
+        return body
+
+    def testRmcNoFix(self):
+        snapshot = dict.fromkeys([ 'Time', 'Latitude', 'Longitude', 'SOG', 'COG', 'Date', 'Variation' ])
+        self.assertEqual(self.format(GPRMC, snapshot), 'GPRMC,,V,,,,,,,,,,N')
+
+    def testRmcFix(self):
+        snapshot = {
+            'Time': 12 * 3600 + 34 * 60 + 56.0,
+            'Latitude': 47.5,
+            'Longitude': -122.25,
+            'SOG': 1852.0 / 3600.0 * 5.0,
+            'COG': math.radians(90),
+            'Date': 16000,
+            'Variation': math.radians(-15),
+        }
+        self.assertEqual(self.format(GPRMC, snapshot), 'GPRMC,123456.00,A,4730.0000,N,12215.0000,W,5.0,90.0,221013,15.0,W,A')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+#!/usr/bin/python
+
+# system modules
+import os
+import time
+import threading
+import unittest
+
+#
+# Tests for lib/pipeline.py.  These need pgns.json in the current
+# directory (see updatepgns.sh), run them from the top of the tree:
+#   python -m unittest discover tests
+#
+
+# local modules
+from lib.pipeline import Nmea2000Pipeline, ConsumerQueue, OVERFLOW_BLOCK
+
+# AIS class A position report, a bulk fast packet PGN
+AIS_PGN = 129038
+# wind data, a normal single frame PGN
+WIND_PGN = 130306
+
+#
+# Remembers the PGNs that it is given.  The first normal record blocks
+# until release is set, which holds up the decode thread once the
+# consumer's queue is full.
+#
+class BlockingConsumer(object):
+    def __init__(self):
+        self.release = threading.Event()
+        self.pgns = []
+
+    def ConsumePgn(self, pgn, dataRecord, pgnRecord):
+        if pgn == WIND_PGN:
+            self.release.wait()
+        self.pgns.append(pgn)
+
+    def Subscriptions(self):
+        return None
+
+@unittest.skipUnless(os.path.exists('pgns.json'), "needs pgns.json")
+class PipelineTest(unittest.TestCase):
+    def setUp(self):
+        from lib.encoder import Nmea2000Encoder
+        encoder = Nmea2000Encoder(0x23)
+        self.aisFrames = encoder.Frames(AIS_PGN, { 'Longitude': -122.5, 'Latitude': 47.5 })
+        self.windFrames = [ encoder.Frames(WIND_PGN, { 'WindSpeed': 5.0, 'Reference': 'Apparent' })[0] for i in range(3) ]
+
+    #
+    # A bulk fast packet whose frames arrive together, but are decoded more
+    # than the fast packet timeout apart because the normal ring kept the
+    # decode thread busy, must still be reassembled.
+    #
+    def testStarvedBulkFastPacket(self):
+        consumer = BlockingConsumer()
+        pipeline = Nmea2000Pipeline([ ConsumerQueue(consumer, maxSize=1, overflow=OVERFLOW_BLOCK) ], batchSize=1)
+        try:
+            # the first frame is decoded straight away
+            pipeline.HandlePacket(*self.aisFrames[0])
+            pipeline.Drain()
+
+            # the consumer blocks on the first wind record, the second one
+            # fills its queue and the decode thread waits on the third, so
+            # the rest of the AIS frames wait in the bulk ring
+            for (can_id, data) in self.windFrames + self.aisFrames[1:]:
+                pipeline.HandlePacket(can_id, data)
+            time.sleep(1.5)
+            consumer.release.set()
+            pipeline.Drain()
+        finally:
+            consumer.release.set()
+            pipeline.Close()
+
+        self.assertEqual(consumer.pgns.count(WIND_PGN), 3)
+        self.assertEqual(consumer.pgns.count(AIS_PGN), 1)
+        self.assertEqual(pipeline.Statistics.expired, 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,251 @@
+#!/usr/bin/python
+
+# system modules
+import io
+import time
+import heapq
+import itertools
+import unittest
+import contextlib
+
+#
+# Tests for lib/scheduler.py.  AsyncScheduler is run on a fake event loop
+# whose clock only moves when the test (or a task) moves it, so the
+# deadlines can be checked exactly.  Scheduler has its own thread on the
+# real clock, so it is tested with short intervals.
+#
+
+# local modules
+from lib.scheduler import Scheduler, AsyncScheduler, ScheduledTask
+
+TIMEOUT = 10.0
+
+class FakeHandle(object):
+    def __init__(self):
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+#
+# Just enough of an asyncio event loop for AsyncScheduler
+#
+class FakeLoop(object):
+    def __init__(self):
+        self.now = 0.0
+        self.__heap = []
+        self.__counter = itertools.count()
+
+    def time(self):
+        return self.now
+
+    def call_soon_threadsafe(self, fn, *args):
+        fn(*args)
+
+    def call_at(self, when, fn, *args):
+        handle = FakeHandle()
+        heapq.heappush(self.__heap, (when, next(self.__counter), handle, fn, args))
+        return handle
+
+    #
+    # Run everything that is due up to the time until, in order
+    #
+    def RunUntil(self, until):
+        while self.__heap and self.__heap[0][0] <= until:
+            (when, n, handle, fn, args) = heapq.heappop(self.__heap)
+            if handle.cancelled:
+                continue
+            # a task that ran long may have moved the clock past when
+            self.now = max(self.now, when)
+            fn(*args)
+        self.now = max(self.now, until)
+
+class NextDeadlineTest(unittest.TestCase):
+    def testOnTime(self):
+        task = ScheduledTask(None, None, 1.0)
+        self.assertEqual(task.nextDeadline(10.0, 10.2), 11.0)
+        self.assertEqual(task.Statistics().missed, 0)
+
+    def testBehind(self):
+        # the deadlines that have already passed are skipped, the next one
+        # is still on the same grid
+        task = ScheduledTask(None, None, 1.0)
+        self.assertEqual(task.nextDeadline(10.0, 13.5), 14.0)
+        self.assertEqual(task.Statistics().missed, 3)
+        self.assertEqual(task.nextDeadline(14.0, 14.9), 15.0)
+        self.assertEqual(task.Statistics().missed, 3)
+
+class AsyncSchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = FakeLoop()
+        self.scheduler = AsyncScheduler(self.loop)
+        self.times = []
+
+    def record(self):
+        self.times.append(self.loop.time())
+
+    def testDeadlines(self):
+        task = self.scheduler.Every(1.0, self.record)
+        self.loop.RunUntil(5.5)
+        self.assertEqual(self.times, [ 1.0, 2.0, 3.0, 4.0, 5.0 ])
+        statistics = task.Statistics()
+        self.assertEqual((statistics.runs, statistics.missed, statistics.maxLateness), (5, 0, 0.0))
+
+    def testDelay(self):
+        self.scheduler.Every(1.0, self.record, delay=0.25)
+        self.loop.RunUntil(3.0)
+        self.assertEqual(self.times, [ 0.25, 1.25, 2.25 ])
+
+    def testCatchUp(self):
+        # the second run takes 2.5 seconds, the runs at 3 and 4 are
+        # skipped and the rest stay on whole seconds
+        def slow():
+            self.record()
+            if len(self.times) == 2:
+                self.loop.now += 2.5
+        task = self.scheduler.Every(1.0, slow)
+        self.loop.RunUntil(7.0)
+        self.assertEqual(self.times, [ 1.0, 2.0, 5.0, 6.0, 7.0 ])
+        self.assertEqual(task.Statistics().missed, 2)
+
+    def testLateness(self):
+        # a run that starts late doesn't move the later deadlines
+        def late():
+            self.record()
+            if len(self.times) == 1:
+                self.loop.now += 0.75
+        task = self.scheduler.Every(1.0, late)
+        self.loop.RunUntil(3.0)
+        self.assertEqual(self.times, [ 1.0, 2.0, 3.0 ])
+        self.assertEqual(task.Statistics().missed, 0)
+
+    def testCancel(self):
+        task = self.scheduler.Every(1.0, self.record)
+        self.loop.RunUntil(2.5)
+        self.assertEqual(self.scheduler.Tasks, [ task ])
+        task.Cancel()
+        self.loop.RunUntil(10.0)
+        self.assertEqual(self.times, [ 1.0, 2.0 ])
+        self.assertEqual(self.scheduler.Tasks, [])
+
+    def testCancelWhileRunning(self):
+        # the run finishes but there are no more
+        def cancel():
+            self.record()
+            task.Cancel()
+        task = self.scheduler.Every(1.0, cancel)
+        self.loop.RunUntil(10.0)
+        self.assertEqual(self.times, [ 1.0 ])
+        self.assertEqual(self.scheduler.Tasks, [])
+
+    def testCancelBeforeStart(self):
+        task = self.scheduler.After(1.0, self.record)
+        task.Cancel()
+        self.loop.RunUntil(10.0)
+        self.assertEqual(self.times, [])
+        self.assertEqual(task.Statistics().runs, 0)
+
+    def testAfter(self):
+        task = self.scheduler.After(1.5, self.record)
+        self.assertEqual(self.scheduler.Tasks, [ task ])
+        self.loop.RunUntil(10.0)
+        self.assertEqual(self.times, [ 1.5 ])
+        self.assertEqual(self.scheduler.Tasks, [])
+
+    def testErrors(self):
+        # exceptions are counted and printed, and the task keeps running
+        def fail():
+            self.record()
+            if len(self.times) % 2 == 0:
+                raise RuntimeError("broken")
+        task = self.scheduler.Every(1.0, fail)
+        stderr = io.StringIO()
+        with contextlib.redirect_stderr(stderr):
+            self.loop.RunUntil(6.0)
+        self.assertEqual(len(self.times), 6)
+        statistics = task.Statistics()
+        self.assertEqual((statistics.runs, statistics.errors), (6, 3))
+        self.assertEqual(stderr.getvalue().count('RuntimeError: broken'), 3)
+
+class SchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.scheduler = Scheduler('TestScheduler')
+        self.times = []
+
+    def tearDown(self):
+        self.scheduler.Close()
+
+    def record(self):
+        self.times.append(time.monotonic())
+
+    def waitFor(self, condition):
+        deadline = time.monotonic() + TIMEOUT
+        while not condition():
+            self.assertLess(time.monotonic(), deadline, "timed out")
+            time.sleep(0.005)
+
+    def testEvery(self):
+        task = self.scheduler.Every(0.01, self.record)
+        self.waitFor(lambda: len(self.times) >= 5)
+        # each run is at least an interval after the one before it
+        start = self.times[0]
+        for (i, t) in enumerate(self.times[1:5]):
+            self.assertGreaterEqual(t - start, (i + 1) * 0.01 - 0.001)
+        task.Cancel()
+
+    def testCancel(self):
+        task = self.scheduler.Every(0.01, self.record)
+        self.waitFor(lambda: len(self.times) >= 3)
+        task.Cancel()
+        self.assertEqual(self.scheduler.Tasks, [])
+        # a run that had already started can still finish
+        time.sleep(0.02)
+        runs = len(self.times)
+        time.sleep(0.1)
+        self.assertEqual(len(self.times), runs)
+
+    def testCancelBeforeStart(self):
+        task = self.scheduler.After(0.05, self.record)
+        other = self.scheduler.After(0.1, self.record)
+        task.Cancel()
+        self.assertEqual(self.scheduler.Tasks, [ other ])
+        self.waitFor(lambda: other.Statistics().runs == 1)
+        self.assertEqual(len(self.times), 1)
+        self.assertEqual(task.Statistics().runs, 0)
+
+    def testCatchUp(self):
+        # the first run takes at least three intervals, so at least three
+        # runs are skipped rather than run back to back
+        def slow():
+            self.record()
+            if len(self.times) == 1:
+                time.sleep(0.07)
+        task = self.scheduler.Every(0.02, slow)
+        self.waitFor(lambda: len(self.times) >= 2)
+        task.Cancel()
+        self.assertGreaterEqual(task.Statistics().missed, 3)
+        self.assertGreaterEqual(self.times[1] - self.times[0], 0.07)
+
+    def testErrors(self):
+        def fail():
+            self.record()
+            raise RuntimeError("broken")
+        stderr = io.StringIO()
+        with contextlib.redirect_stderr(stderr):
+            task = self.scheduler.Every(0.01, fail)
+            self.waitFor(lambda: task.Statistics().runs >= 3)
+            task.Cancel()
+            time.sleep(0.05)
+        statistics = task.Statistics()
+        self.assertEqual(statistics.errors, statistics.runs)
+        self.assertEqual(statistics.runs, len(self.times))
+        self.assertIn('RuntimeError: broken', stderr.getvalue())
+
+    def testClose(self):
+        self.scheduler.After(0.05, self.record)
+        self.scheduler.Close()
+        time.sleep(0.1)
+        self.assertEqual(self.times, [])
+
+if __name__ == '__main__':
+    unittest.main()